@@ -6,7 +6,6 @@ Supports greedy, nucleus, and best-of-n decoding with persona-aware re-ranking.
 from __future__ import annotations
 
 import argparse
-import copy
 import json
 import os
 import pickle
@@ -30,6 +29,11 @@ try:
 except ImportError:
     AutoTokenizer = None
 
+try:
+    import tiktoken  # type: ignore[import]
+except ImportError:
+    tiktoken = None
+
 from utils import (
     ENGINE_MAP,
     llama_v2_prompt,
@@ -38,11 +42,17 @@ from utils import (
     topics,
 )
 from selected_personas import get_persona_by_id, NUM_PERSONAS
+from response_cache import ResponseCache, is_deterministic
+from final.src.utils import rate_limit, tracing
+from final.src.utils.tracing import span
 
 
 SELFCHAT_DIR = Path(os.environ.get("SELFCHAT_DIR", "selfchat"))
 SELFCHAT_DIR.mkdir(parents=True, exist_ok=True)
 
+# Point at a local stub (see stub_llm.py) for offline benchmarking.
+REPLICATE_BASE_URL = os.environ.get("REPLICATE_BASE_URL", "https://api.replicate.com").rstrip("/")
+
 
 @dataclass
 class DecodingStrategy:
@@ -103,26 +113,80 @@ class SentenceEmbeddingHelper:
 
 
 class TokenCounter:
-    def __init__(self, tokenizer_name: Optional[str] = None):
+    """
+    Incremental token accounting for re-rendered chat prompts.
+
+    Each distinct text is tokenized once (new texts in one batch call) and
+    cached, so a prompt's count is the sum of its cached message counts plus
+    the chat-template overhead instead of a full re-encode every turn.
+    Uses the Hugging Face fast tokenizer if given, otherwise tiktoken's
+    cl100k_base as an approximation, otherwise ~4 characters per token.
+    """
+
+    def __init__(self, tokenizer_name: Optional[str] = None, max_cached: int = 65536):
         self.tokenizer_name = tokenizer_name
         self.tokenizer = None
+        self.encoding = None
+        self.max_cached = max_cached
+        self._counts: Dict[str, int] = {}
+        self._template_counts: Dict[Tuple[str, ...], int] = {}
         if tokenizer_name and AutoTokenizer is not None:
             try:
-                self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+                self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
                 print(f"[TokenCounter] Using tokenizer '{tokenizer_name}' for token counting.")
             except Exception as exc:  # pragma: no cover - warning path
-                print(f"[TokenCounter] Failed to load tokenizer '{tokenizer_name}': {exc}. Falling back to word counts.")
+                print(f"[TokenCounter] Failed to load tokenizer '{tokenizer_name}': {exc}. Falling back to an approximation.")
                 self.tokenizer = None
         elif tokenizer_name:
-            print("[TokenCounter] transformers not installed; falling back to word counts.")
+            print("[TokenCounter] transformers not installed; falling back to an approximation.")
+        if self.tokenizer is None and tiktoken is not None:
+            self.encoding = tiktoken.get_encoding("cl100k_base")
 
-    def count(self, text: str) -> int:
+    @property
+    def name(self) -> str:
+        """Identifies the counting backend, so persisted counts are only reused with the same one."""
+        if self.tokenizer is not None:
+            return f"hf:{self.tokenizer_name}"
+        return "tiktoken:cl100k_base" if self.encoding is not None else "chars/4"
+
+    def _encode_lengths(self, texts: List[str]) -> List[int]:
         if self.tokenizer is not None:
             try:
-                return len(self.tokenizer.encode(text, add_special_tokens=False))
+                return [len(ids) for ids in self.tokenizer(texts, add_special_tokens=False)["input_ids"]]
             except Exception:
                 pass
-        return len(text.split())
+        if self.encoding is not None:
+            return [len(ids) for ids in self.encoding.encode_batch(texts, disallowed_special=())]
+        return [max(1, len(text) // 4) if text else 0 for text in texts]
+
+    def _store(self, text: str, count: int) -> None:
+        if len(self._counts) >= self.max_cached:
+            self._counts.pop(next(iter(self._counts)))  # oldest entry
+        self._counts[text] = count
+
+    def seed(self, texts: List[str], counts: List[int]) -> None:
+        """Primes the cache with counts persisted by an earlier run."""
+        for text, count in zip(texts, counts):
+            self._store(text, count)
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        missing = list(dict.fromkeys(text for text in texts if text not in self._counts))
+        if missing:
+            for text, count in zip(missing, self._encode_lengths(missing)):
+                self._store(text, count)
+        return [self._counts[text] for text in texts]
+
+    def count(self, text: str) -> int:
+        return self.count_batch([text])[0]
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        """Tokens in llama_v2_prompt(messages), from cached per-message counts."""
+        roles = tuple(message["role"] for message in messages)
+        if roles not in self._template_counts:
+            # Template markers only; counted once per message layout.
+            empty = [{"role": role, "content": ""} for role in roles]
+            self._template_counts[roles] = self._encode_lengths([llama_v2_prompt(empty)])[0]
+        return sum(self.count_batch([message["content"] for message in messages])) + self._template_counts[roles]
 
 
 def cosine_similarity(vec_a: np.ndarray, vec_b: np.ndarray) -> float:
@@ -148,7 +212,7 @@ def replicate_generate(
         raise EnvironmentError("REPLICATE_API_TOKEN environment variable must be set.")
 
     replicate_model = ENGINE_MAP.get(model_name, model_name)
-    create_url = f"https://api.replicate.com/v1/models/{replicate_model}/predictions"
+    create_url = f"{REPLICATE_BASE_URL}/v1/models/{replicate_model}/predictions"
     headers = {
         "Authorization": f"Token {replicate_api_token}",
         "Content-Type": "application/json",
@@ -165,10 +229,22 @@ def replicate_generate(
         }
     }
 
-    req = urllib_request.Request(create_url, data=json.dumps(payload).encode("utf-8"), headers=headers, method="POST")
+    def send(url: str, method: str, data: Optional[bytes] = None, timeout: float = 120) -> Dict[str, Any]:
+        req = urllib_request.Request(url, data=data, headers=headers, method=method)
+        with urllib_request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read().decode("utf-8"))
+
+    # Creates and polls are paced by adaptive limiters that back off on 429s and honour Retry-After.
+    create_limiter = rate_limit.get_limiter("replicate", replicate_model)
+    poll_limiter = rate_limit.get_limiter("replicate", "predictions.get")
+
     try:
-        with urllib_request.urlopen(req, timeout=120) as resp:
-            prediction = json.loads(resp.read().decode("utf-8"))
+        with span("llm.request", "network", provider="replicate", model=model_name):
+            prediction = rate_limit.call_with_limiter(
+                create_limiter,
+                lambda: send(create_url, "POST", json.dumps(payload).encode("utf-8")),
+                label="replicate",
+            )
     except HTTPError as err:
         error_body = err.read().decode("utf-8", errors="ignore")
         raise RuntimeError(f"Replicate API request failed: {error_body}") from err
@@ -178,16 +254,18 @@ def replicate_generate(
     prediction_id = prediction["id"]
     status = prediction.get("status", "")
 
-    while status not in {"succeeded", "failed", "canceled"}:
-        time.sleep(poll_interval)
-        status_req = urllib_request.Request(
-            f"https://api.replicate.com/v1/predictions/{prediction_id}",
-            headers=headers,
-            method="GET",
-        )
-        with urllib_request.urlopen(status_req, timeout=60) as resp:
-            prediction = json.loads(resp.read().decode("utf-8"))
-        status = prediction.get("status", "")
+    with span("llm.poll_wait", "network", provider="replicate", model=model_name) as poll_span:
+        polls = 0
+        while status not in {"succeeded", "failed", "canceled"}:
+            time.sleep(poll_interval)
+            prediction = rate_limit.call_with_limiter(
+                poll_limiter,
+                lambda: send(f"{REPLICATE_BASE_URL}/v1/predictions/{prediction_id}", "GET", timeout=60),
+                label="replicate",
+            )
+            status = prediction.get("status", "")
+            polls += 1
+        poll_span.set(polls=polls, status=status)
 
     if status != "succeeded":
         error_message = prediction.get("error", "unknown error")
@@ -231,8 +309,9 @@ def best_of_n_generate(
         candidates.append(text)
 
     context_text = " ".join(history) or persona_desc
-    context_embedding = embedding_helper.encode([context_text])[0]
-    candidate_embeddings = embedding_helper.encode(candidates)
+    with span("embedding", "cpu", batch_size=len(candidates) + 1):
+        context_embedding = embedding_helper.encode([context_text])[0]
+        candidate_embeddings = embedding_helper.encode(candidates)
 
     scored_candidates: List[Dict[str, Any]] = []
     for idx, cand_text in enumerate(candidates):
@@ -321,12 +400,25 @@ def main(argv: Optional[List[str]] = None) -> None:
         "--tokenizer_name",
         type=str,
         default=None,
-        help="Optional Hugging Face tokenizer for token counting.",
+        help="Optional Hugging Face tokenizer for token counting (default: tiktoken cl100k_base approximation).",
     )
     parser.add_argument("--log_every", type=int, default=2, help="Persist conversation after this many turns.")
+    parser.add_argument("--trace_file", type=str, default=None, help="Write per-stage spans to this file.")
+    parser.add_argument("--trace_format", type=str, default="jsonl", choices=["jsonl", "otlp"])
+    parser.add_argument(
+        "--response_cache",
+        type=str,
+        default=None,
+        help="SQLite file caching deterministic (temperature 0) generations; disabled by default.",
+    )
+    parser.add_argument("--cache_ttl_days", type=float, default=30.0, help="Expire cached responses after this many days.")
+    parser.add_argument("--cache_max_mb", type=float, default=512.0, help="Evict least-recently-used responses above this size.")
 
     args = parser.parse_args(argv)
 
+    if args.trace_file:
+        tracing.configure(args.trace_file, fmt=args.trace_format, script="baseline_run.py")
+
     random.seed(args.seed)
 
     if args.agent < 0 or args.agent >= NUM_PERSONAS:
@@ -358,6 +450,13 @@ def main(argv: Optional[List[str]] = None) -> None:
         persona_embedding = embedding_helper.encode([persona_desc])[0]
 
     token_counter = TokenCounter(args.tokenizer_name)
+    response_cache = None
+    if args.response_cache:
+        response_cache = ResponseCache(
+            args.response_cache,
+            ttl_sec=args.cache_ttl_days * 24 * 3600,
+            max_bytes=int(args.cache_max_mb * 1024 * 1024),
+        )
     output_path = prepare_output_file(
         args.model_name,
         args.agent,
@@ -405,6 +504,12 @@ def main(argv: Optional[List[str]] = None) -> None:
 
     pkl.setdefault("turn_stats", [])
     pkl.setdefault("best_of_n_logs", [])
+    # Per-message token counts are stored next to the history so a resumed run does not re-tokenize it.
+    if pkl.get("token_counter") == token_counter.name and len(pkl.get("history_token_counts", [])) == len(pkl["history"]):
+        token_counter.seed(pkl["history"], pkl["history_token_counts"])
+    else:
+        pkl["history_token_counts"] = token_counter.count_batch(pkl["history"])
+    pkl["token_counter"] = token_counter.name
 
     print(f"Model: {args.model_name} (Replicate)")
     print(f"Agent persona [{args.agent}]: {persona_desc}")
@@ -413,73 +518,112 @@ def main(argv: Optional[List[str]] = None) -> None:
     print(f"Decoding strategy: {strategy.name}")
     print(f"Turns: {args.turns}")
 
+    # Agent and user turns alternate system prompts, so each side's prompt is compared
+    # with that side's previous prompt to estimate what a provider prefix cache could reuse.
+    last_messages_by_system: Dict[str, List[Dict[str, str]]] = {}
+
     for turn in range(len(pkl["history"]), args.turns + 1):
-        pkl_copy = copy.deepcopy(pkl)
-        messages = pkl2dict(pkl_copy)
-        prompt_text = llama_v2_prompt(messages)
-
-        print(f"\n{'=' * 80}")
-        print(f"Turn {turn}/{args.turns}")
-        print(f"{'=' * 80}")
-
-        turn_start = time.time()
-
-        if isinstance(strategy, BestOfNDecoding):
-            sequence, metadata = best_of_n_generate(
-                prompt_text,
-                strategy,
-                model_name=args.model_name,
-                max_tokens=args.max_tokens,
-                poll_interval=args.poll_interval,
-                persona_desc=persona_desc,
-                history=pkl["history"],
-                embedding_helper=embedding_helper,
-                persona_embedding=persona_embedding,
-            )
-            metadata["turn"] = turn
-            pkl["best_of_n_logs"].append(metadata)
-        else:
-            params = strategy.get_generation_params()
-            sequence = replicate_generate(
-                prompt_text,
-                model_name=args.model_name,
-                max_tokens=args.max_tokens,
-                temperature=params["temperature"],
-                top_p=params["top_p"],
-                poll_interval=args.poll_interval,
+        with span("turn", model=args.model_name, persona_id=args.agent, user_id=args.user, turn=turn, decoding=strategy.name):
+            with span("prompt.build", "cpu"):
+                # pkl2dict only reads these keys, so a shallow view replaces the per-turn deepcopy.
+                messages = pkl2dict({"persona": pkl["persona"], "user": pkl["user"], "history": pkl["history"]})
+                prompt_text = llama_v2_prompt(messages)
+
+            print(f"\n{'=' * 80}")
+            print(f"Turn {turn}/{args.turns}")
+            print(f"{'=' * 80}")
+
+            turn_start = time.time()
+            cache_hit = False
+
+            if isinstance(strategy, BestOfNDecoding):
+                sequence, metadata = best_of_n_generate(
+                    prompt_text,
+                    strategy,
+                    model_name=args.model_name,
+                    max_tokens=args.max_tokens,
+                    poll_interval=args.poll_interval,
+                    persona_desc=persona_desc,
+                    history=pkl["history"],
+                    embedding_helper=embedding_helper,
+                    persona_embedding=persona_embedding,
+                )
+                metadata["turn"] = turn
+                pkl["best_of_n_logs"].append(metadata)
+            else:
+                params = strategy.get_generation_params()
+
+                def generate() -> str:
+                    return replicate_generate(
+                        prompt_text,
+                        model_name=args.model_name,
+                        max_tokens=args.max_tokens,
+                        temperature=params["temperature"],
+                        top_p=params["top_p"],
+                        poll_interval=args.poll_interval,
+                    )
+
+                if response_cache is not None and is_deterministic(params):
+                    hits_before = response_cache.hits
+                    sequence = response_cache.get_or_generate(
+                        "replicate",
+                        ENGINE_MAP.get(args.model_name, args.model_name),
+                        prompt_text,
+                        dict(params, max_tokens=args.max_tokens),
+                        generate,
+                    )
+                    cache_hit = response_cache.hits > hits_before
+                else:
+                    sequence = generate()
+
+            latency = time.time() - turn_start
+            response_text = process_answer(sequence)
+            pkl["history"].append(response_text)
+
+            pkl["history_token_counts"].append(token_counter.count(response_text))
+            prompt_tokens = token_counter.count_messages(messages)
+            response_tokens = pkl["history_token_counts"][-1]
+            previous_messages = last_messages_by_system.get(messages[0]["content"], [])
+            shared = 0
+            while shared < min(len(previous_messages), len(messages)) and previous_messages[shared] == messages[shared]:
+                shared += 1
+            prefix_tokens = token_counter.count_messages(messages[:shared]) if shared else 0
+            last_messages_by_system[messages[0]["content"]] = messages
+            pkl["turn_stats"].append(
+                {
+                    "turn": turn,
+                    "prompt_tokens_est": prompt_tokens,
+                    "response_tokens_est": response_tokens,
+                    "prefix_tokens_est": prefix_tokens,
+                    "latency_sec": latency,
+                    "cache_hit": cache_hit,
+                }
             )
 
-        latency = time.time() - turn_start
-        response_text = process_answer(sequence)
-        pkl["history"].append(response_text)
-
-        prompt_tokens = token_counter.count(prompt_text)
-        response_tokens = token_counter.count(response_text)
-        pkl["turn_stats"].append(
-            {
-                "turn": turn,
-                "prompt_tokens_est": prompt_tokens,
-                "response_tokens_est": response_tokens,
-                "latency_sec": latency,
-            }
-        )
-
-        print(f"Response: {response_text[:200]}{'...' if len(response_text) > 200 else ''}")
-        print(f"Latency: {latency:.2f}s | prompt tokens≈{prompt_tokens} | response tokens≈{response_tokens}")
+            print(f"Response: {response_text[:200]}{'...' if len(response_text) > 200 else ''}")
+            print(
+                f"Latency: {latency:.2f}s | prompt tokens≈{prompt_tokens} (shared prefix≈{prefix_tokens}) | "
+                f"response tokens≈{response_tokens}"
+            )
 
-        if turn % max(args.log_every, 1) == 0:
-            with output_path.open("wb") as handle:
-                pickle.dump(pkl, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            if turn % max(args.log_every, 1) == 0:
+                with span("checkpoint.write", "disk"), output_path.open("wb") as handle:
+                    pickle.dump(pkl, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
     total_latency = sum(stat["latency_sec"] for stat in pkl["turn_stats"])
     total_prompt_tokens = sum(stat["prompt_tokens_est"] for stat in pkl["turn_stats"])
     total_response_tokens = sum(stat["response_tokens_est"] for stat in pkl["turn_stats"])
+    # Older pkls resumed here have no prefix estimate for their first turns.
+    total_prefix_tokens = sum(stat.get("prefix_tokens_est", 0) for stat in pkl["turn_stats"])
     pkl["summary"] = {
         "total_turns": len(pkl["history"]) - 1,
         "total_latency_sec": total_latency,
         "total_prompt_tokens_est": total_prompt_tokens,
         "total_response_tokens_est": total_response_tokens,
+        "total_prefix_tokens_est": total_prefix_tokens,
     }
+    if response_cache is not None:
+        pkl["summary"]["response_cache"] = response_cache.stats()
 
     with output_path.open("wb") as handle:
         pickle.dump(pkl, handle, protocol=pickle.HIGHEST_PROTOCOL)
@@ -487,9 +631,12 @@ def main(argv: Optional[List[str]] = None) -> None:
     print(f"\n{'=' * 80}")
     print(f"Conversation complete! Saved to: {output_path}")
     print(
-        f"Total latency: {total_latency:.2f}s | prompt tokens≈{total_prompt_tokens} | "
-        f"response tokens≈{total_response_tokens}"
+        f"Total latency: {total_latency:.2f}s | prompt tokens≈{total_prompt_tokens} "
+        f"(shared prefix≈{total_prefix_tokens}) | response tokens≈{total_response_tokens}"
     )
+    if response_cache is not None:
+        stats = response_cache.stats()
+        print(f"Response cache: {stats['hits']} hits / {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)")
     print(f"{'=' * 80}")
 
 
@@ -0,0 +1,6 @@
+"""
+Offline benchmark suite for the generation and evaluation pipelines.
+
+    python -m benchmarks run --output bench/HEAD.json
+    python -m benchmarks compare bench/base.json bench/HEAD.json
+"""
@@ -0,0 +1,160 @@
+"""
+CLI for the benchmark suite.
+
+`run` starts the stub backend (stub_llm.py) in-process, points the Replicate
+and OpenAI clients at it, runs the selected scenarios against the fixture
+transcripts and writes a JSON report. `compare` diffs two reports and exits
+non-zero if any scenario regressed beyond the threshold.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+from typing import List, Optional
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from benchmarks.harness import (  # noqa: E402
+    ScenarioResult,
+    build_report,
+    compare_reports,
+    format_comparison,
+    format_report,
+    load_report,
+)
+
+
+def point_clients_at(base_url: str, workdir: Path, poll_interval: float) -> None:
+    # Must happen before run.py / baseline_run.py / llm_client are imported:
+    # they read these at import time.
+    os.environ["REPLICATE_BASE_URL"] = base_url
+    os.environ["REPLICATE_API_TOKEN"] = "stub"
+    os.environ["REPLICATE_POLL_INTERVAL"] = str(poll_interval)
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    os.environ["OPENAI_API_KEY"] = "stub"
+    os.environ["SELFCHAT_DIR"] = str(workdir / "selfchat")
+    # Measure the code, not our own client-side pacing.
+    os.environ["RATE_LIMIT_DISABLE"] = "1"
+
+
+def cmd_run(args: argparse.Namespace) -> int:
+    from stub_llm import StubLLM, StubLLMServer
+
+    llm = StubLLM(
+        seed=args.seed,
+        latency=args.latency,
+        tokens_per_sec=args.tokens_per_sec,
+        error_rate=args.error_rate,
+        response_words=args.response_words,
+    )
+    server = StubLLMServer(llm, port=0)
+    server.start_in_thread()
+
+    workdir = Path(tempfile.mkdtemp(prefix="persona-drift-bench-"))
+    point_clients_at(server.base_url, workdir, poll_interval=0.01)
+
+    from benchmarks.scenarios import SCENARIOS, BenchContext, load_fixtures
+
+    selected = args.scenarios or list(SCENARIOS)
+    unknown = sorted(set(selected) - set(SCENARIOS))
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(unknown)} (available: {', '.join(SCENARIOS)})")
+        return 2
+
+    ctx = BenchContext(
+        workdir=workdir,
+        records=load_fixtures(),
+        iterations=args.iterations,
+        backend=args.backend,
+        verbose=args.verbose,
+    )
+    results: List[ScenarioResult] = []
+    for name in selected:
+        print(f"[bench] {name} ...", flush=True)
+        tick = time.perf_counter()
+        try:
+            results.extend(SCENARIOS[name](ctx))
+        except (ImportError, EnvironmentError, KeyError) as exc:
+            results.append(ScenarioResult(name, "", status="skipped", reason=f"{type(exc).__name__}: {exc}"))
+        except Exception as exc:
+            if args.verbose:
+                traceback.print_exc()
+            results.append(ScenarioResult(name, "", status="error", reason=f"{type(exc).__name__}: {exc}"))
+        print(f"[bench] {name} done in {time.perf_counter() - tick:.1f}s", flush=True)
+
+    server.shutdown()
+    stub_config = {
+        "seed": args.seed,
+        "latency": args.latency,
+        "tokens_per_sec": args.tokens_per_sec,
+        "error_rate": args.error_rate,
+        "response_words": args.response_words,
+        "requests": llm.stats["requests"],
+        "injected_errors": llm.stats["errors"],
+    }
+    report = build_report(results, stub_config)
+    report["iterations"] = args.iterations
+    report["backend"] = args.backend
+
+    print()
+    print(format_report(report))
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=2)
+        print(f"\nWrote {args.output}")
+    return 0
+
+
+def cmd_compare(args: argparse.Namespace) -> int:
+    base, new = load_report(args.base), load_report(args.new)
+    for key in ("stub", "iterations", "backend"):
+        if key in base and base.get(key) != new.get(key):
+            print(f"Warning: reports differ in '{key}' ({base.get(key)} vs {new.get(key)}); deltas may not be comparable.")
+    rows = compare_reports(base, new, threshold=args.threshold)
+    print(f"base {base['git']['commit']}  ->  new {new['git']['commit']}")
+    print(format_comparison(rows, args.threshold))
+    return 1 if any(row["regression"] for row in rows) else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Persona drift benchmark suite")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="Run scenarios against the local stub backend.")
+    run.add_argument("--scenarios", nargs="*", default=None, help="Subset of scenarios to run (default: all).")
+    run.add_argument("--iterations", type=int, default=4, help="Workload size per scenario (conversations / runs).")
+    run.add_argument("--output", type=str, default=None, help="Write the JSON report here.")
+    run.add_argument("--backend", type=str, default="torch", choices=["torch", "onnx"], help="Local inference backend.")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--latency", type=str, default="fixed:0.02", help="Stub latency distribution (see stub_llm.py).")
+    run.add_argument("--tokens_per_sec", type=float, default=0.0)
+    run.add_argument("--error_rate", type=float, default=0.0)
+    run.add_argument("--response_words", type=int, default=60)
+    run.add_argument("--verbose", action="store_true", help="Show script output and tracebacks.")
+    run.set_defaults(func=cmd_run)
+
+    compare = sub.add_parser("compare", help="Compare two JSON reports.")
+    compare.add_argument("base", type=str)
+    compare.add_argument("new", type=str)
+    compare.add_argument("--threshold", type=float, default=0.10, help="Relative change counted as a regression.")
+    compare.set_defaults(func=cmd_compare)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""
+Result bookkeeping for the benchmark suite: latency percentiles, run
+metadata (git commit, interpreter, stub settings) and regression comparison
+between two result files.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import platform
+import subprocess
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Linear-interpolated percentile (q in [0, 100]) of a non-empty list."""
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * q / 100.0
+    low, high = math.floor(rank), math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def latency_summary(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    return {
+        "n": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": percentile(samples, 50),
+        "p95": percentile(samples, 95),
+        "p99": percentile(samples, 99),
+        "max": max(samples),
+    }
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    unit: str
+    status: str = "ok"
+    count: int = 0
+    wall_sec: float = 0.0
+    samples: List[float] = field(default_factory=list)
+    extra: Dict[str, Any] = field(default_factory=dict)
+    reason: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        if self.status != "ok":
+            return {"status": self.status, "reason": self.reason}
+        return {
+            "status": self.status,
+            "unit": self.unit,
+            "count": self.count,
+            "wall_sec": self.wall_sec,
+            "throughput": self.count / self.wall_sec if self.wall_sec > 0 else None,
+            "latency_sec": latency_summary(self.samples),
+            **self.extra,
+        }
+
+
+def git_info() -> Dict[str, Any]:
+    def git(*args: str) -> str:
+        return subprocess.run(
+            ["git", *args], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+
+    try:
+        return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+def build_report(results: List[ScenarioResult], stub_config: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git": git_info(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "stub": stub_config,
+        "scenarios": {result.name: result.to_dict() for result in results},
+    }
+
+
+def compare_reports(base: Dict[str, Any], new: Dict[str, Any], threshold: float = 0.10) -> List[Dict[str, Any]]:
+    """
+    Per-scenario deltas between two reports. A scenario regresses when its
+    throughput drops, or its p95 latency grows, by more than `threshold`.
+    """
+    rows = []
+    for name, new_stats in new["scenarios"].items():
+        base_stats = base["scenarios"].get(name)
+        if not base_stats or base_stats.get("status") != "ok" or new_stats.get("status") != "ok":
+            continue
+        row: Dict[str, Any] = {"scenario": name, "regression": False}
+        for key, higher_is_better in (("throughput", True), ("p50", False), ("p95", False)):
+            if key == "throughput":
+                old_value, new_value = base_stats.get("throughput"), new_stats.get("throughput")
+            else:
+                old_value = base_stats["latency_sec"].get(key)
+                new_value = new_stats["latency_sec"].get(key)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value
+            row[key] = {"base": old_value, "new": new_value, "change": change}
+            worse = -change if higher_is_better else change
+            if key != "p50" and worse > threshold:
+                row["regression"] = True
+        rows.append(row)
+    return rows
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    lines = [f"commit {report['git']['commit']}{' (dirty)' if report['git']['dirty'] else ''}"]
+    lines.append(f"{'scenario':<28}{'count':>7}{'throughput':>16}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, stats in report["scenarios"].items():
+        if stats["status"] != "ok":
+            lines.append(f"{name:<28}  {stats['status']}: {stats['reason']}")
+            continue
+        lat = stats["latency_sec"]
+        throughput = f"{stats['throughput']:.2f} {stats['unit']}/s" if stats["throughput"] else "-"
+        lines.append(
+            f"{name:<28}{stats['count']:>7}{throughput:>16}"
+            f"{lat.get('p50', 0):>10.3f}{lat.get('p95', 0):>10.3f}{lat.get('p99', 0):>10.3f}"
+        )
+    return "\n".join(lines)
+
+
+def format_comparison(rows: List[Dict[str, Any]], threshold: float) -> str:
+    lines = [f"{'scenario':<28}{'throughput':>14}{'p50':>10}{'p95':>10}  (regression > {threshold:.0%})"]
+    for row in rows:
+        cells = []
+        for key in ("throughput", "p50", "p95"):
+            cells.append(f"{row[key]['change']:+.1%}" if key in row else "-")
+        flag = "  REGRESSION" if row["regression"] else ""
+        lines.append(f"{row['scenario']:<28}{cells[0]:>14}{cells[1]:>10}{cells[2]:>10}{flag}")
+    return "\n".join(lines)
+
+
+def load_report(path: str) -> Dict[str, Any]:
+    with open(path, "r") as handle:
+        return json.load(handle)
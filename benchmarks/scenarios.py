@@ -0,0 +1,219 @@
+"""
+Benchmark scenarios. Each one drives the real code path (run.py,
+baseline_run.py, final/) against the local stub backend and the fixture
+transcripts, and returns a ScenarioResult with per-item latencies.
+
+Scenarios whose optional dependencies are missing (models, `src.config`,
+nltk data, ...) are reported as skipped rather than failing the whole suite.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import io
+import json
+import pickle
+import re
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+from benchmarks.harness import REPO_ROOT, ScenarioResult
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures" / "transcripts.jsonl"
+FINAL_DIR = REPO_ROOT / "final"
+STUB_MODEL = "stub/llm"
+
+
+@dataclass
+class BenchContext:
+    workdir: Path
+    records: List[Dict[str, Any]]
+    iterations: int
+    backend: str
+    verbose: bool
+
+    def quiet(self):
+        return contextlib.nullcontext() if self.verbose else contextlib.redirect_stdout(io.StringIO())
+
+
+def load_fixtures(path: Path = FIXTURES) -> List[Dict[str, Any]]:
+    with path.open("r") as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+def fixture_history(record: Dict[str, Any]) -> List[str]:
+    # run.py / baseline_run.py keep the conversation as a flat list starting with the topic.
+    return [record["topic"]] + [m["content"] for m in record["turns"][1:]]
+
+
+def fixture_messages(record: Dict[str, Any], upto: int) -> List[Dict[str, str]]:
+    return [{"role": "system", "content": record["system_prompt"]}] + record["turns"][:upto]
+
+
+def _import_final(module: str):
+    if str(FINAL_DIR) not in sys.path:
+        sys.path.insert(0, str(FINAL_DIR))
+    return __import__(module, fromlist=["_"])
+
+
+def bench_selfchat(ctx: BenchContext) -> List[ScenarioResult]:
+    """Greedy self-chat via baseline_run.main; latency per generated turn."""
+    import baseline_run
+
+    turns = 2 + ctx.iterations
+    start = time.perf_counter()
+    with ctx.quiet():
+        baseline_run.main([
+            "--model_name", STUB_MODEL, "--agent", "0", "--user", "1", "--topic", "0",
+            "--turns", str(turns), "--decoding", "greedy", "--poll_interval", "0.01", "--seed", "0",
+        ])
+    wall = time.perf_counter() - start
+    output_path = baseline_run.prepare_output_file(STUB_MODEL, 0, 1, turns, "greedy", 0)
+    with output_path.open("rb") as handle:
+        stats = pickle.load(handle)["turn_stats"]
+    return [ScenarioResult("selfchat", "turns", count=len(stats), wall_sec=wall,
+                           samples=[s["latency_sec"] for s in stats])]
+
+
+_PROBE_LINE = re.compile(r"Time taken for probe turn \d+ \(\d+/\d+\): ([\d.]+) seconds")
+
+
+def bench_probe_fanout(ctx: BenchContext) -> List[ScenarioResult]:
+    """run.py probe phase over a fixture conversation; latency per probe."""
+    import run
+
+    record = ctx.records[0]
+    history = fixture_history(record)
+    turns = len(history)
+    output_path = run.SELFCHAT_DIR / f"{STUB_MODEL}_agent_0_user_1_turn_{turns}.pkl"
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with output_path.open("wb") as handle:
+        pickle.dump({"history": history, "probed_history_per_turn": defaultdict(list)}, handle)
+
+    log = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        run.main([
+            "--model_name", STUB_MODEL, "--agent", "0", "--user", "1", "--topic", "0",
+            "--turns", str(turns), "--runs", str(ctx.iterations), "--seed", "0",
+        ])
+    wall = time.perf_counter() - start
+    if ctx.verbose:
+        print(log.getvalue())
+    samples = [float(m) for m in _PROBE_LINE.findall(log.getvalue())]
+    return [ScenarioResult("probe_fanout", "probes", count=len(samples), wall_sec=wall, samples=samples,
+                           extra={"runs_per_turn": ctx.iterations, "probed_turns": turns // 2})]
+
+
+def bench_best_of_n(ctx: BenchContext, ns=(1, 2, 4, 8)) -> List[ScenarioResult]:
+    """baseline_run.best_of_n_generate at several n; latency per selected turn."""
+    import baseline_run
+    from utils import llama_v2_prompt, pkl2dict
+
+    helper = baseline_run.SentenceEmbeddingHelper()
+    results = []
+    for n in ns:
+        strategy = baseline_run.BestOfNDecoding(n=n)
+        samples: List[float] = []
+        start = time.perf_counter()
+        for record in ctx.records[: ctx.iterations]:
+            # Odd-length history, so the next turn is the persona's.
+            history = fixture_history(record)[:-1]
+            persona_embedding = helper.encode([record["system_prompt"]])[0]
+            pkl = {"history": history, "persona": record["system_prompt"], "user": "", "topic": history[0]}
+            prompt = llama_v2_prompt(pkl2dict(pkl))
+            tick = time.perf_counter()
+            baseline_run.best_of_n_generate(
+                prompt, strategy, model_name=STUB_MODEL, max_tokens=200, poll_interval=0.01,
+                persona_desc=record["system_prompt"], history=history,
+                embedding_helper=helper, persona_embedding=persona_embedding,
+            )
+            samples.append(time.perf_counter() - tick)
+        wall = time.perf_counter() - start
+        results.append(ScenarioResult(f"best_of_n[n={n}]", "turns", count=len(samples), wall_sec=wall,
+                                      samples=samples, extra={"n": n}))
+    return results
+
+
+def bench_igrc_overhead(ctx: BenchContext) -> List[ScenarioResult]:
+    """
+    Per-turn cost IGRC adds on top of a plain completion: samples are
+    (guarded - unguarded) seconds for the same fixture context.
+    """
+    llm_client = _import_final("src.utils.llm_client")
+    IGRCGuardrail = _import_final("src.igrc.igrc").IGRCGuardrail
+
+    with ctx.quiet():
+        guard = IGRCGuardrail(backend=ctx.backend)
+    base, guarded, overhead, retries = [], [], [], 0
+    start = time.perf_counter()
+    for record in ctx.records[: ctx.iterations]:
+        for upto in range(1, len(record["turns"]), 2):
+            messages = fixture_messages(record, upto)
+            tick = time.perf_counter()
+            llm_client.get_completion(messages, "gpt-4o-mini", provider="openai")
+            plain = time.perf_counter() - tick
+            tick = time.perf_counter()
+            with ctx.quiet():
+                _, meta = guard.recursive_generate(messages, record["system_prompt"], "gpt-4o-mini", "openai")
+            full = time.perf_counter() - tick
+            base.append(plain)
+            guarded.append(full)
+            overhead.append(full - plain)
+            retries += meta.get("retries", 0)
+    wall = time.perf_counter() - start
+    return [ScenarioResult("igrc_overhead", "turns", count=len(overhead), wall_sec=wall, samples=overhead,
+                           extra={"unguarded_p50": sorted(base)[len(base) // 2],
+                                  "guarded_p50": sorted(guarded)[len(guarded) // 2],
+                                  "retries": retries})]
+
+
+def bench_drift_evaluator(ctx: BenchContext) -> List[ScenarioResult]:
+    """measure_baseline.DriftEvaluator.evaluate_conversation; latency per conversation."""
+    DriftEvaluator = _import_final("measure_baseline").DriftEvaluator
+
+    with ctx.quiet():
+        evaluator = DriftEvaluator(backend=ctx.backend)
+    records = ctx.records * ctx.iterations
+    samples = []
+    start = time.perf_counter()
+    for record in records:
+        tick = time.perf_counter()
+        evaluator.evaluate_conversation(record)
+        samples.append(time.perf_counter() - tick)
+    wall = time.perf_counter() - start
+    return [ScenarioResult("drift_evaluator", "conversations", count=len(samples), wall_sec=wall, samples=samples)]
+
+
+def bench_judge_rescoring(ctx: BenchContext) -> List[ScenarioResult]:
+    """DriftMeter.check_hypocrisy over every fixture assistant turn; latency per row."""
+    DriftMeter = _import_final("src.analysis.metrics").DriftMeter
+
+    meter = DriftMeter()
+    rows = [
+        (m["content"], record["facts"])
+        for record in ctx.records
+        for m in record["turns"] if m["role"] == "assistant"
+    ][: ctx.iterations * 6]
+    samples = []
+    start = time.perf_counter()
+    for response, facts in rows:
+        tick = time.perf_counter()
+        meter.check_hypocrisy(response, facts)
+        samples.append(time.perf_counter() - tick)
+    wall = time.perf_counter() - start
+    return [ScenarioResult("judge_rescoring", "rows", count=len(samples), wall_sec=wall, samples=samples)]
+
+
+SCENARIOS: Dict[str, Callable[[BenchContext], List[ScenarioResult]]] = {
+    "selfchat": bench_selfchat,
+    "probe_fanout": bench_probe_fanout,
+    "best_of_n": bench_best_of_n,
+    "igrc_overhead": bench_igrc_overhead,
+    "drift_evaluator": bench_drift_evaluator,
+    "judge_rescoring": bench_judge_rescoring,
+}
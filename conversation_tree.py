@@ -0,0 +1,145 @@
+"""
+Persistent conversation-prefix tree shared by self-chat runs and probes.
+
+Every turn is a node whose key hashes its parent's key and its text, so a
+prefix is stored once no matter how many runs or probes pass through it.
+Generated turns are also recorded as edges (parent, tag) -> child, where the
+tag names the sampling stream (model, decoding params and, for stochastic
+decoding, the seed/run). A later request for the same edge reuses the stored
+turn instead of calling the model again. Deterministic decoding uses an empty
+sample id, so every run with the same prefix shares the same continuation.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+def _hash(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()[:32]
+
+
+def generation_tag(model: str, params: Dict[str, Any], sample_id: str = "") -> str:
+    """Edge label for a generation; `sample_id` separates independent stochastic samples."""
+    return json.dumps({"model": model, "params": params, "sample": sample_id}, sort_keys=True, separators=(",", ":"))
+
+
+class ConversationTree:
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.generated = 0
+        self.reused = 0
+        self._texts: Dict[str, str] = {}
+        self._parents: Dict[str, Optional[str]] = {}
+        self._depths: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS nodes (key TEXT PRIMARY KEY, parent TEXT, text TEXT NOT NULL, depth INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS edges (parent TEXT NOT NULL, tag TEXT NOT NULL, child TEXT NOT NULL,"
+            " PRIMARY KEY (parent, tag))"
+        )
+        self._conn.commit()
+
+    def root(self, *context: str) -> str:
+        """Root node for a conversation context (e.g. model, persona and user prompts)."""
+        key = _hash("root", *context)
+        self._insert(key, None, "", 0)
+        return key
+
+    def append(self, parent: str, text: str) -> str:
+        """Node for `text` following `parent` (created if new). Never calls a model."""
+        key = _hash(parent, text)
+        depth = self._depth(parent) + 1
+        self._insert(key, parent, text, depth)
+        return key
+
+    def extend(self, parent: str, tag: str, generate: Callable[[], str]) -> Tuple[str, str, bool]:
+        """
+        Continuation of `parent` along `tag`. Returns (key, text, reused); calls
+        `generate` only if this edge has not been generated before.
+        """
+        existing = self.child(parent, tag)
+        if existing is not None:
+            self.reused += 1
+            return existing, self.text(existing), True
+        text = generate()
+        self.generated += 1
+        return self.record(parent, tag, text), text, False
+
+    def record(self, parent: str, tag: str, text: str) -> str:
+        """Registers an already generated turn as the continuation of `parent` along `tag`."""
+        key = self.append(parent, text)
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO edges (parent, tag, child) VALUES (?, ?, ?)", (parent, tag, key))
+            self._conn.commit()
+        return key
+
+    def child(self, parent: str, tag: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT child FROM edges WHERE parent = ? AND tag = ?", (parent, tag)).fetchone()
+        return row[0] if row else None
+
+    def text(self, key: str) -> str:
+        if key not in self._texts:
+            self._load(key)
+        return self._texts[key]
+
+    def history(self, key: str) -> List[str]:
+        """Turn texts from the first turn after the root down to `key`."""
+        texts = []
+        while key is not None:
+            if key not in self._parents:
+                self._load(key)
+            parent = self._parents[key]
+            if parent is None:
+                break
+            texts.append(self._texts[key])
+            key = parent
+        return texts[::-1]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            nodes = self._conn.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+        return {"nodes": nodes, "generated": self.generated, "reused": self.reused}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _insert(self, key: str, parent: Optional[str], text: str, depth: int) -> None:
+        if key in self._texts:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO nodes (key, parent, text, depth) VALUES (?, ?, ?, ?)", (key, parent, text, depth)
+            )
+            self._conn.commit()
+        self._texts[key] = text
+        self._parents[key] = parent
+        self._depths[key] = depth
+
+    def _load(self, key: str) -> None:
+        with self._lock:
+            row = self._conn.execute("SELECT parent, text, depth FROM nodes WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown conversation node {key}")
+        self._parents[key], self._texts[key], self._depths[key] = row
+
+    def _depth(self, key: str) -> int:
+        if key not in self._depths:
+            self._load(key)
+        return self._depths[key]
@@ -1,33 +1,77 @@
 import json
+import os
+import shutil
+import time
 import argparse
+import multiprocessing as mp
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-from sentence_transformers import SentenceTransformer, CrossEncoder, util
+import torch
+from sentence_transformers import util
 from tqdm import tqdm
+from src.utils.onnx_backend import load_sim_model, load_nli_model, validate_backend
+from src.utils.tracing import span
+from src.utils import profiler
+
+
+_WORKER_EVALUATOR = None
 
 class DriftEvaluator:
-    def __init__(self, sim_model_name="all-MiniLM-L6-v2", nli_model_name="cross-encoder/nli-deberta-v3-base"):
-        print("Loading Evaluation Models...")
+    def __init__(self, sim_model_name="all-MiniLM-L6-v2", nli_model_name="cross-encoder/nli-deberta-v3-base", backend="torch", num_threads=None, load_models=True):
         self.device = "cpu" 
+        self.sim_model_name = sim_model_name
+        self.nli_model_name = nli_model_name
+        self.backend = backend
+        self.num_threads = num_threads
+        self.sim_model = None
+        self.nli_model = None
+        if load_models:
+            self.load_models()
         
         
-        self.sim_model = SentenceTransformer(sim_model_name, device=self.device)
+        self.LABEL_CONTRADICTION = 0 
+
+    def load_models(self):
+        """Loads both encoders once; run() calls it only where this process uses them."""
+        if self.sim_model is not None:
+            return
+        print(f"Loading Evaluation Models ({self.backend} backend)...")
         
         
-        self.nli_model = CrossEncoder(nli_model_name, device=self.device)
+        self.sim_model = load_sim_model(self.sim_model_name, device=self.device, backend=self.backend, num_threads=self.num_threads)
         
         
-        self.LABEL_CONTRADICTION = 0 
+        self.nli_model = load_nli_model(self.nli_model_name, device=self.device, backend=self.backend, num_threads=self.num_threads)
 
     def load_conversations(self, filepath):
-        data = []
+        return list(self.iter_conversations(filepath))
+
+    def iter_conversations(self, filepath, skip_ids=None):
+        """
+        Lazily yields records from a JSONL file, one line at a time.
+        Records whose id is in `skip_ids` are not parsed into the evaluation.
+        Malformed lines (e.g. a record torn by an interrupted writer) are skipped,
+        and a record without an id is keyed by its line number.
+        """
         with open(filepath, 'r') as f:
-            for line in f:
-                if line.strip():
-                    data.append(json.loads(line))
-        return data
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    print(f"  [Skip] {filepath}:{line_no} is not valid JSON ({e})")
+                    continue
+                if record.get('id') is None:
+                    record['id'] = f"line_{line_no}"
+                if skip_ids and record['id'] in skip_ids:
+                    continue
+                yield record
 
     def evaluate_conversation(self, record):
         """
@@ -40,7 +84,9 @@ class DriftEvaluator:
             return None
 
         
-        emb_anchor = self.sim_model.encode(system_prompt, convert_to_tensor=True)
+        conversation_id = record.get('id')
+        with span("embedding", "cpu", conversation_id=conversation_id):
+            emb_anchor = self.sim_model.encode(system_prompt, convert_to_tensor=True)
         
         metrics = []
         turn_idx = 1
@@ -50,18 +96,20 @@ class DriftEvaluator:
         
         for response in assistant_turns:
             
-            emb_resp = self.sim_model.encode(response, convert_to_tensor=True)
-            similarity = util.cos_sim(emb_anchor, emb_resp).item()
+            with span("embedding", "cpu", conversation_id=conversation_id, turn=turn_idx):
+                emb_resp = self.sim_model.encode(response, convert_to_tensor=True)
+                similarity = util.cos_sim(emb_anchor, emb_resp).item()
             
             
             
             
-            nli_scores = self.nli_model.predict([(system_prompt, response)])
+            with span("nli", "cpu", conversation_id=conversation_id, turn=turn_idx):
+                nli_scores = self.nli_model.predict([(system_prompt, response)])
             pred_label = nli_scores[0].argmax()
             is_contradiction = 1 if pred_label == self.LABEL_CONTRADICTION else 0
             
             metrics.append({
-                "conversation_id": record['id'],
+                "conversation_id": conversation_id,
                 "role": record['role'],
                 "turn": turn_idx,
                 "fidelity": similarity,
@@ -71,22 +119,131 @@ class DriftEvaluator:
             
         return metrics
 
-    def run(self, input_file, output_csv="drift_results.csv"):
-        conversations = self.load_conversations(input_file)
-        print(f"Loaded {len(conversations)} conversations.")
-        
-        all_results = []
-        
+    def run(self, input_file, output_path="drift_results.csv", chunk_size=50, fmt=None, overwrite=False, workers=1):
+        """
+        Runs evaluate_to_file() and returns all results as a DataFrame.
+        Use evaluate_to_file() directly to keep the results out of memory.
+        """
+        output_path = self.evaluate_to_file(input_file, output_path, chunk_size, fmt, overwrite, workers)
+        return ResultWriter(output_path, fmt=fmt).read_all()
+
+    def evaluate_to_file(self, input_file, output_path="drift_results.csv", chunk_size=50, fmt=None, overwrite=False, workers=1):
+        """
+        Streams conversations from `input_file` and appends per-turn metrics to
+        `output_path` every `chunk_size` conversations.
+
+        A watermark file next to the output keeps the ids of every conversation
+        already evaluated, so re-running on a generator file that has grown in
+        append mode only evaluates the newly appended conversations.
+        With `workers` > 1 conversations are evaluated in a process pool.
+        Returns the path of the results; nothing is held in memory.
+        """
+        writer = ResultWriter(output_path, fmt=fmt, overwrite=overwrite)
+        done_ids = writer.load_watermark()
+        if done_ids:
+            print(f"Watermark: {len(done_ids)} conversations already evaluated, skipping them.")
+
+        records = self.iter_conversations(input_file, skip_ids=done_ids)
         print("Calculating Drift Metrics...")
-        for conv in tqdm(conversations):
+        if workers > 1:
+            n_new = self._run_parallel(records, writer, chunk_size, workers)
+        else:
+            n_new = self._run_serial(records, writer, chunk_size)
+
+        print(f"Evaluated {n_new} new conversations.")
+        return writer.output_path
+
+    def _run_serial(self, records, writer, chunk_size):
+        self.load_models()
+        chunk_rows, chunk_ids = [], []
+        n_new = 0
+        for conv in tqdm(records):
             results = self.evaluate_conversation(conv)
             if results:
-                all_results.extend(results)
-        
-        
-        df = pd.DataFrame(all_results)
-        df.to_csv(output_csv, index=False)
-        return df
+                chunk_rows.extend(results)
+            chunk_ids.append(conv['id'])
+            n_new += 1
+
+            if len(chunk_ids) >= chunk_size:
+                writer.write_chunk(chunk_rows, chunk_ids)
+                chunk_rows, chunk_ids = [], []
+
+        if chunk_ids:
+            writer.write_chunk(chunk_rows, chunk_ids)
+        return n_new
+
+    def _run_parallel(self, records, writer, chunk_size, workers):
+        """
+        Shards conversations across a process pool. With the 'fork' start
+        method and the torch backend the workers inherit this process's
+        already-loaded models copy-on-write; otherwise each worker loads its
+        own copy once. Each worker gets an equal slice of the CPU's intra-op
+        threads. At most `workers * 2` shards are in flight and a new one is
+        submitted as soon as any finishes, so one slow shard never idles the
+        other workers.
+        """
+        global _WORKER_EVALUATOR
+
+        ctx_name = "fork" if "fork" in mp.get_all_start_methods() else "spawn"
+        ctx = mp.get_context(ctx_name)
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+        shard_size = max(1, chunk_size // workers)
+        print(f"Starting {workers} workers ({ctx_name}, {threads_per_worker} threads each)...")
+
+        # Only torch models are shared copy-on-write with forked workers; ONNX sessions
+        # are not fork-safe and fix their thread pool at creation, so workers load their own.
+        share_models = ctx_name == "fork" and self.backend == "torch"
+        if share_models:
+            self.load_models()
+        _WORKER_EVALUATOR = self if share_models else None
+        worker_stats = defaultdict(lambda: {"conversations": 0, "turns": 0, "busy_sec": 0.0})
+        chunk_rows, chunk_ids = [], []
+        n_new = 0
+        start = time.time()
+
+        with ProcessPoolExecutor(
+            workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(self.sim_model_name, self.nli_model_name, self.backend, threads_per_worker),
+        ) as pool:
+            shards = _batched(records, shard_size)
+            # Bounded in-flight window so a huge input is never fully in memory.
+            pending = {pool.submit(_evaluate_shard, shard) for shard in islice(shards, workers * 2)}
+            last_report = start
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    pid, rows, ids, busy = future.result()
+                    stats = worker_stats[pid]
+                    stats["conversations"] += len(ids)
+                    stats["turns"] += len(rows)
+                    stats["busy_sec"] += busy
+
+                    chunk_rows.extend(rows)
+                    chunk_ids.extend(ids)
+                    n_new += len(ids)
+                    if len(chunk_ids) >= chunk_size:
+                        writer.write_chunk(chunk_rows, chunk_ids)
+                        chunk_rows, chunk_ids = [], []
+                pending.update(pool.submit(_evaluate_shard, shard) for shard in islice(shards, len(finished)))
+
+                if time.time() - last_report >= 10:
+                    last_report = time.time()
+                    print(f"  {n_new} conversations evaluated ({n_new / (last_report - start):.2f} conv/s)")
+
+        if chunk_ids:
+            writer.write_chunk(chunk_rows, chunk_ids)
+        _WORKER_EVALUATOR = None
+
+        elapsed = time.time() - start
+        print(f"Worker throughput ({elapsed:.1f}s wall clock):")
+        for pid, stats in sorted(worker_stats.items()):
+            rate = stats["conversations"] / stats["busy_sec"] if stats["busy_sec"] else 0.0
+            print(f"  worker {pid}: {stats['conversations']} conversations, {stats['turns']} turns, {rate:.2f} conv/s")
+        if elapsed > 0:
+            print(f"  total: {n_new / elapsed:.2f} conv/s")
+        return n_new
 
     def visualize(self, df, output_img="drift_curve.png"):
         """
@@ -119,11 +276,117 @@ class DriftEvaluator:
         
         contradiction_rate = df['is_contradiction'].mean() * 100
 
+
+class ResultWriter:
+    """
+    Appends metric rows to a CSV file or to a directory of Parquet part files,
+    and tracks the conversation ids written so far in a watermark file.
+    """
+
+    def __init__(self, output_path, fmt=None, overwrite=False):
+        self.output_path = output_path
+        self.fmt = fmt or ("parquet" if output_path.endswith(".parquet") else "csv")
+        self.watermark_path = output_path.rstrip(os.sep) + ".watermark"
+
+        if overwrite:
+            if os.path.isdir(output_path):
+                shutil.rmtree(output_path)
+            elif os.path.exists(output_path):
+                os.remove(output_path)
+            if os.path.exists(self.watermark_path):
+                os.remove(self.watermark_path)
+
+    def load_watermark(self):
+        if not os.path.exists(self.watermark_path):
+            return set()
+        with open(self.watermark_path, 'r') as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def write_chunk(self, rows, conversation_ids):
+        """
+        Rows are persisted before their ids are added to the watermark, so an
+        interrupted run re-evaluates at most the chunk in flight.
+        """
+        with span("checkpoint.write", "disk", rows=len(rows), fmt=self.fmt):
+            if rows:
+                df = pd.DataFrame(rows)
+                if self.fmt == "parquet":
+                    os.makedirs(self.output_path, exist_ok=True)
+                    part_idx = len([p for p in os.listdir(self.output_path) if p.endswith(".parquet")])
+                    df.to_parquet(os.path.join(self.output_path, f"part-{part_idx:05d}.parquet"), index=False)
+                else:
+                    write_header = not os.path.exists(self.output_path) or os.path.getsize(self.output_path) == 0
+                    df.to_csv(self.output_path, mode='a', header=write_header, index=False)
+
+            with open(self.watermark_path, 'a') as f:
+                for conv_id in conversation_ids:
+                    f.write(f"{conv_id}\n")
+
+    def read_all(self, columns=None):
+        if not os.path.exists(self.output_path):
+            return pd.DataFrame()
+        if self.fmt == "parquet":
+            return pd.read_parquet(self.output_path, columns=columns)
+        return pd.read_csv(self.output_path, usecols=columns)
+
+
+def _batched(iterable, n):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, n))
+        if not batch:
+            return
+        yield batch
+
+
+def _init_worker(sim_model_name, nli_model_name, backend, num_threads):
+    global _WORKER_EVALUATOR
+    torch.set_num_threads(num_threads)
+    profiler.install_signal_handler(f"profiles/measure_baseline_{os.getpid()}")
+    profiler.resume_in_worker()
+    if _WORKER_EVALUATOR is None:
+        _WORKER_EVALUATOR = DriftEvaluator(sim_model_name, nli_model_name, backend=backend, num_threads=num_threads)
+
+
+def _evaluate_shard(records):
+    start = time.time()
+    rows, ids = [], []
+    with torch.inference_mode():
+        for record in records:
+            results = _WORKER_EVALUATOR.evaluate_conversation(record)
+            if results:
+                rows.extend(results)
+            ids.append(record['id'])
+    return os.getpid(), rows, ids, time.time() - start
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", type=str, required=True, help="Path to baseline jsonl")
+    parser.add_argument("--output", type=str, default="drift_results.csv", help="Results file (.csv) or directory (.parquet)")
+    parser.add_argument("--format", type=str, default=None, choices=["csv", "parquet"], help="Defaults to the output extension")
+    parser.add_argument("--chunk_size", type=int, default=50, help="Conversations evaluated between writes")
+    parser.add_argument("--overwrite", action="store_true", help="Discard previous results and watermark")
+    parser.add_argument("--workers", type=int, default=1, help="Evaluation processes (1 = in-process)")
+    parser.add_argument("--backend", type=str, default="torch", choices=["torch", "onnx"], help="Encoder inference backend")
+    parser.add_argument("--validate_backend", action="store_true", help="Check ONNX outputs against PyTorch before evaluating")
+    parser.add_argument("--profile", type=str, default=None, help="Sample stacks into <profile>.collapsed / .speedscope.json")
+    parser.add_argument("--profile_hz", type=float, default=profiler.DEFAULT_HZ, help="Profiler sampling rate")
     args = parser.parse_args()
+
+    # `kill -USR1 <pid>` toggles profiling of a run that was started without --profile.
+    profiler.install_signal_handler(args.profile or f"profiles/measure_baseline_{os.getpid()}", hz=args.profile_hz)
+    if args.profile:
+        profiler.start(args.profile, hz=args.profile_hz)
     
-    evaluator = DriftEvaluator()
-    df_results = evaluator.run(args.input)
-    evaluator.visualize(df_results)
\ No newline at end of file
+    if args.backend == "onnx" and args.validate_backend:
+        print(f"ONNX validation: {validate_backend()}")
+
+    # Models are loaded by evaluate_to_file() only where this process uses them.
+    evaluator = DriftEvaluator(backend=args.backend, load_models=False)
+    results_path = evaluator.evaluate_to_file(args.input, output_path=args.output, chunk_size=args.chunk_size, fmt=args.format, overwrite=args.overwrite, workers=args.workers)
+    # Only the columns the drift curve needs are loaded for plotting.
+    df_results = ResultWriter(results_path, fmt=args.format).read_all(columns=["conversation_id", "turn", "fidelity", "is_contradiction"])
+    if df_results.empty:
+        print("No results to plot.")
+    else:
+        evaluator.visualize(df_results)
\ No newline at end of file
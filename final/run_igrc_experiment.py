@@ -2,92 +2,26 @@ import json
 import os
 import argparse
 from dotenv import load_dotenv
-from datasets import load_dataset
 from tqdm import tqdm
 
 
 load_dotenv()
 
-from src.utils.llm_client import get_completion
+from src.utils.llm_client import CompletionError
+from src.utils.checkpoint import load_completed_ids, ConversationCheckpoint
+from src.utils.tracing import span
 from src.generation.simulator import UserSimulator
 from src.config import CONFIG
 from src.igrc import IGRCGuardrail
+from src.data.rolebench import ROLE_PROFILES, load_rolebench, load_profiles, construct_authentic_prompt
 
 
 OUTPUT_FILE = "rolebench_igrc.jsonl"
 MAX_TURNS = 20
-PROFILE_DIR = "data/profiles/profiles-eng"  
 guardrail = IGRCGuardrail(device="cpu") 
 
 
-ROLE_PROFILES = {}
-
-def load_profiles():
-    """Loads the side-loaded JSON files into a dictionary"""
-    global ROLE_PROFILES
-    
-    desc_path = os.path.join(PROFILE_DIR, "desc.json")
-    scripts_path = os.path.join(PROFILE_DIR, "scripts.json")
-    
-    if not os.path.exists(desc_path):
-        raise FileNotFoundError(
-            f"Profile metadata not found!\n"
-            f"   Run: python download_profiles.py\n"
-            f"   Missing: {desc_path}"
-        )
-    
-    print(f"📂 Loading profiles from {PROFILE_DIR}...")
-    
-    with open(desc_path, 'r') as f:
-        descriptions = json.load(f)  
-        
-    with open(scripts_path, 'r') as f:
-        scripts = json.load(f)  
-        
-    
-    all_roles = set(descriptions.keys()) | set(scripts.keys())
-    for role in all_roles:
-        catchphrases = scripts.get(role, [])
-        
-        if isinstance(catchphrases, str):
-            catchphrases = [catchphrases] if catchphrases else []
-        
-        ROLE_PROFILES[role] = {
-            "desc": descriptions.get(role, ""),
-            "catchphrases": catchphrases
-        }
-    
-    print(f"Loaded profiles for {len(ROLE_PROFILES)} characters.\n")
-
-def construct_authentic_prompt(role_name):
-    """
-    Constructs the System Prompt using the side-loaded metadata.
-    This follows the RoleBench formula for authentic persona prompts.
-    """
-    if not ROLE_PROFILES:
-        load_profiles()
-        
-    meta = ROLE_PROFILES.get(role_name, {})
-    desc = meta.get("desc", "")
-    phrases = meta.get("catchphrases", [])
-    
-    
-    
-    prompt = f"You are {role_name}. {desc}"
-    
-    
-    if phrases and len(phrases) > 0:
-        prompt += "\n\nHere are some examples of how you speak:"
-        for p in phrases[:5]:  
-            if p:  
-                prompt += f"\n- {p}"
-            
-    
-    prompt += "\n\nStay in character at all times. Do not reveal you are an AI."
-    
-    return prompt
-
-def process_rolebench(limit=None, turns=MAX_TURNS, model_persona=None, model_simulator=None):
+def process_rolebench(limit=None, turns=MAX_TURNS, model_persona=None, model_simulator=None, speculative_k=0):
     
     model_persona = model_persona or CONFIG["persona_model"]
     model_simulator = model_simulator or CONFIG["simulator_model"]
@@ -98,8 +32,7 @@ def process_rolebench(limit=None, turns=MAX_TURNS, model_persona=None, model_sim
     print(f"Loading RoleBench (English Test Split)...")
     try:
         
-        data_url = "hf://datasets/ZenMoore/RoleBench/rolebench-eng/instruction-generalization/role_specific/test.jsonl"
-        dataset = load_dataset("json", data_files=data_url, split="train") 
+        dataset = load_rolebench()
     except Exception as e:
         print(f"Error loading dataset: {e}")
         return
@@ -109,14 +42,19 @@ def process_rolebench(limit=None, turns=MAX_TURNS, model_persona=None, model_sim
 
     print(f"Starting generation for {limit if limit else 'all'} samples...")
     
-    
-    dataset = dataset.shuffle(seed=42)
+    completed_ids = load_completed_ids(OUTPUT_FILE)
+    if completed_ids:
+        print(f"Resuming: {len(completed_ids)} conversations already in {OUTPUT_FILE}")
     
     with open(OUTPUT_FILE, 'a') as f:
         for i, sample in tqdm(enumerate(dataset)):
             if limit and i >= limit:
                 break
             
+            record_id = f"rb_base_{i}"
+            if record_id in completed_ids:
+                continue
+            
             role_name = sample['role']
             initial_instruction = sample['question']
             
@@ -133,10 +71,20 @@ def process_rolebench(limit=None, turns=MAX_TURNS, model_persona=None, model_sim
             anchor_profile = f"{meta.get('desc', '')}\nCatchphrases: {', '.join(meta.get('catchphrases', []))}"            
             
             
-            conversation = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": initial_instruction}
-            ]
+            checkpoint = ConversationCheckpoint(OUTPUT_FILE, record_id)
+            state = checkpoint.load()
+            if state:
+                conversation = state["conversation"]
+                igrc_metadata = state.get("igrc_metadata", [])
+                start_turn = state["turn"]
+                print(f"Resuming {record_id} at turn {start_turn + 1}")
+            else:
+                conversation = [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": initial_instruction}
+                ]
+                igrc_metadata = []
+                start_turn = 0
             
             simulator = UserSimulator(
                 role_name, 
@@ -148,34 +96,47 @@ def process_rolebench(limit=None, turns=MAX_TURNS, model_persona=None, model_sim
             print(f"\n=== Conversation {i+1}: {role_name} ===")
             
             
-            for turn in range(turns):
-                
-                persona_response, metadata = guardrail.recursive_generate(
-                    conversation_history=conversation,
-                    anchor_profile=anchor_profile,
-                    model_name=model_persona,
-                    provider=provider_persona
-                )
-                
-                if metadata['corrected']:
-                    print(f"  --> IGRC Intervened! (Retries: {metadata['retries']})")
-                conversation.append({"role": "assistant", "content": persona_response})
-                
-                
-                if turn < turns - 1:
-                    user_followup = simulator.generate_followup(conversation)
-                    conversation.append({"role": "user", "content": user_followup})
+            try:
+                for turn in range(start_turn, turns):
+                    with span("turn", persona_id=record_id, role=role_name, model=model_persona, turn=turn + 1):
+                        persona_response, metadata = guardrail.recursive_generate(
+                            conversation_history=conversation,
+                            anchor_profile=anchor_profile,
+                            model_name=model_persona,
+                            provider=provider_persona,
+                            speculative_k=speculative_k
+                        )
+
+                        if metadata['corrected']:
+                            print(f"  --> IGRC Intervened! (Retries: {metadata['retries']})")
+                        elif metadata.get('speculative', {}).get('alternative_selected'):
+                            print(f"  --> Speculative draft {metadata['speculative']['selected_index']} selected")
+                        igrc_metadata.append(dict(metadata, turn=turn + 1))
+                        conversation.append({"role": "assistant", "content": persona_response})
+
+
+                        if turn < turns - 1:
+                            user_followup = simulator.generate_followup(conversation)
+                            conversation.append({"role": "user", "content": user_followup})
+
+                        checkpoint.save({"conversation": conversation, "igrc_metadata": igrc_metadata, "turn": turn + 1})
+            except CompletionError as e:
+                # Completed turns are checkpointed; a later run resumes this conversation from there.
+                print(f"  [Error] {record_id} stopped at turn {turn + 1}: {e}. Will resume from checkpoint.")
+                continue
             
             
             record = {
-                "id": f"rb_base_{i}",
+                "id": record_id,
                 "role": role_name,
                 "system_prompt": system_prompt,  
                 "base_instruction": initial_instruction,
-                "turns": conversation
+                "turns": conversation,
+                "igrc_metadata": igrc_metadata
             }
             f.write(json.dumps(record) + "\n")
             f.flush()
+            checkpoint.clear()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -183,6 +144,7 @@ if __name__ == "__main__":
     parser.add_argument("--turns", type=int, default=MAX_TURNS, help="Number of turns per conversation")
     parser.add_argument("--persona_model", type=str, default=None, help="Model for Persona")
     parser.add_argument("--sim_model", type=str, default=None, help="Model for User Simulator")
+    parser.add_argument("--speculative_k", type=int, default=0, help="Alternative drafts generated in parallel with each persona turn")
     args = parser.parse_args()
     
-    process_rolebench(limit=args.limit, turns=args.turns, model_persona=args.persona_model, model_simulator=args.sim_model)
\ No newline at end of file
+    process_rolebench(limit=args.limit, turns=args.turns, model_persona=args.persona_model, model_simulator=args.sim_model, speculative_k=args.speculative_k)
\ No newline at end of file
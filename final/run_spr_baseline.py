@@ -1,60 +1,25 @@
 import json
 import os
 import argparse
-import copy
-from datasets import load_dataset
+import time
 from tqdm import tqdm
-from src.utils.llm_client import get_completion
+from src.utils.llm_client import CompletionError, get_completion_with_usage
+from src.utils.checkpoint import load_completed_ids, ConversationCheckpoint
+from src.utils.tracing import span
 from src.generation.simulator import UserSimulator
+from src.generation.spr_context import SPRContextBuilder, REINJECTION_LAYOUTS
+from src.data.rolebench import ROLE_PROFILES, load_rolebench, load_profiles
 from src.config import CONFIG
 
 
 OUTPUT_FILE = "rolebench_spr.jsonl"
-PROFILE_DIR = "data/profiles/profiles-eng"  
 
 
-ROLE_PROFILES = {}
-
-def load_profiles():
-    """
-    Loads authentic RoleBench profiles (descriptions + catchphrases).
-    Required because the instruction dataset is missing this metadata.
-    """
-    global ROLE_PROFILES
-    
-    desc_path = os.path.join(PROFILE_DIR, "desc.json")
-    scripts_path = os.path.join(PROFILE_DIR, "scripts.json")
-    
-    
-    if not os.path.exists(desc_path):
-        raise FileNotFoundError(f"Missing profiles! Please run 'download_profiles.py' first. Path not found: {desc_path}")
-        
-    with open(desc_path, 'r') as f:
-        descriptions = json.load(f)
-    with open(scripts_path, 'r') as f:
-        scripts = json.load(f)
-        
-    all_roles = set(descriptions.keys()) | set(scripts.keys())
-    for role in all_roles:
-        catchphrases = scripts.get(role, [])
-        
-        if isinstance(catchphrases, str):
-            catchphrases = [catchphrases] if catchphrases else []
-        
-        ROLE_PROFILES[role] = {
-            "desc": descriptions.get(role, ""),
-            "catchphrases": catchphrases
-        }
-    print(f"✅ Profiles loaded for {len(ROLE_PROFILES)} characters.")
-
 def construct_authentic_prompt(role_name):
     """
     Builds the 'Source of Truth' system prompt.
     """
-    if not ROLE_PROFILES:
-        load_profiles()
-        
-    meta = ROLE_PROFILES.get(role_name, {})
+    meta = load_profiles().get(role_name, {})
     desc = meta.get("desc", "")
     phrases = meta.get("catchphrases", [])
     
@@ -71,7 +36,7 @@ def construct_authentic_prompt(role_name):
     prompt += "\nStay in character. Do not reveal you are an AI."
     return prompt
 
-def process_rolebench_spr(limit=None, turns=20, model_persona=None, model_simulator=None):
+def process_rolebench_spr(limit=None, turns=20, model_persona=None, model_simulator=None, layout="inline"):
     
     model_persona = model_persona or CONFIG["persona_model"]
     model_simulator = model_simulator or CONFIG["simulator_model"]
@@ -80,18 +45,24 @@ def process_rolebench_spr(limit=None, turns=20, model_persona=None, model_simula
     
     
     print(f"Loading RoleBench Instructions...")
-    data_url = "hf://datasets/ZenMoore/RoleBench/rolebench-eng/instruction-generalization/role_specific/test.jsonl"
-    dataset = load_dataset("json", data_files=data_url, split="train")
-    dataset = dataset.shuffle(seed=42)  
+    dataset = load_rolebench()
     load_profiles()
 
     print(f"Starting SYSTEM PROMPT REPETITION (SPR) Run...")
     print(f"Output will be saved to: {OUTPUT_FILE}")
     
+    completed_ids = load_completed_ids(OUTPUT_FILE)
+    if completed_ids:
+        print(f"Resuming: {len(completed_ids)} conversations already in {OUTPUT_FILE}")
+    
     with open(OUTPUT_FILE, 'a') as f:
         for i, sample in tqdm(enumerate(dataset)):
             if limit and i >= limit: break
             
+            record_id = f"rb_spr_{i}"
+            if record_id in completed_ids:
+                continue
+            
             role_name = sample['role']
             
             
@@ -103,12 +74,24 @@ def process_rolebench_spr(limit=None, turns=20, model_persona=None, model_simula
             initial_instruction = sample['question']
             
             
-            conversation_log = [
-                {"role": "system", "content": core_system_prompt},
-                {"role": "user", "content": initial_instruction}
-            ]
+            checkpoint = ConversationCheckpoint(OUTPUT_FILE, record_id)
+            state = checkpoint.load()
+            if state:
+                conversation_log = state["conversation"]
+                turn_stats = state.get("turn_stats", [])
+                start_turn = state["turn"]
+                print(f"Resuming {record_id} at turn {start_turn + 1}")
+            else:
+                conversation_log = [
+                    {"role": "system", "content": core_system_prompt},
+                    {"role": "user", "content": initial_instruction}
+                ]
+                turn_stats = []
+                start_turn = 0
             
             
+            context_builder = SPRContextBuilder(core_system_prompt, layout=layout)
+            
             simulator = UserSimulator(
                 role_name, 
                 initial_instruction, 
@@ -117,57 +100,63 @@ def process_rolebench_spr(limit=None, turns=20, model_persona=None, model_simula
             )
             
             
-            for turn in range(turns):
-                
-                
-                
-                
-                spr_context = copy.deepcopy(conversation_log)
-                
-                
-                
-                if spr_context[-1]['role'] == 'user':
-                    original_user_content = spr_context[-1]['content']
-                    
-                    
-                    reinjection_text = (
-                        f"SYSTEM REMINDER: {core_system_prompt}\n"
-                        f"--------------------------------------------------\n"
-                        f"USER QUERY: {original_user_content}"
-                    )
-                    
-                    spr_context[-1]['content'] = reinjection_text
-                
-                
-                persona_response = get_completion(
-                    spr_context, 
-                    model_persona, 
-                    provider=provider_persona
-                )
-                
-                
-                conversation_log.append({"role": "assistant", "content": persona_response})
-                
-                
-                if turn < turns - 1:
-                    user_followup = simulator.generate_followup(conversation_log)
-                    conversation_log.append({"role": "user", "content": user_followup})
+            try:
+                for turn in range(start_turn, turns):
+                    with span("turn", persona_id=record_id, role=role_name, model=model_persona, turn=turn + 1):
+                        with span("prompt.build", "cpu", layout=layout):
+                            spr_context = context_builder.build(conversation_log)
+
+                        turn_start = time.time()
+                        persona_response, usage = get_completion_with_usage(
+                            spr_context, 
+                            model_persona, 
+                            provider=provider_persona,
+                            conversation_id=record_id
+                        )
+                        turn_stats.append({
+                            "turn": turn + 1,
+                            "latency_sec": time.time() - turn_start,
+                            "prompt_tokens": usage.get("prompt_tokens"),
+                            "cached_tokens": usage.get("cached_tokens"),
+                            "uncached_tokens": usage.get("uncached_tokens"),
+                            "prefix_tokens": usage.get("prefix_tokens"),
+                        })
+                        if usage.get("prompt_tokens"):
+                            print(f"  [SPR] turn {turn + 1}: {usage['cached_tokens']}/{usage['prompt_tokens']} prompt tokens cached")
+
+
+                        conversation_log.append({"role": "assistant", "content": persona_response})
+
+
+                        if turn < turns - 1:
+                            user_followup = simulator.generate_followup(conversation_log)
+                            conversation_log.append({"role": "user", "content": user_followup})
+
+                        checkpoint.save({"conversation": conversation_log, "turn_stats": turn_stats, "turn": turn + 1})
+            except CompletionError as e:
+                # Completed turns are checkpointed; a later run resumes this conversation from there.
+                print(f"  [Error] {record_id} stopped at turn {turn + 1}: {e}. Will resume from checkpoint.")
+                continue
             
             
             record = {
-                "id": f"rb_spr_{i}",
+                "id": record_id,
                 "role": role_name,
                 "method": "SPR (System Prompt Repetition)",
                 "system_prompt": core_system_prompt,
-                "turns": conversation_log
+                "reinjection_layout": layout,
+                "turns": conversation_log,
+                "turn_stats": turn_stats
             }
             f.write(json.dumps(record) + "\n")
             f.flush()
+            checkpoint.clear()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--limit", type=int, default=None, help="Test with fewer samples (e.g. 10)")
     parser.add_argument("--turns", type=int, default=20, help="Turns per conversation")
+    parser.add_argument("--layout", type=str, default="inline", choices=REINJECTION_LAYOUTS, help="Where the system reminder is reinjected")
     args = parser.parse_args()
     
-    process_rolebench_spr(limit=args.limit, turns=args.turns)
\ No newline at end of file
+    process_rolebench_spr(limit=args.limit, turns=args.turns, layout=args.layout)
\ No newline at end of file
@@ -1,6 +1,7 @@
 import numpy as np
-from src.utils.llm_client import get_embedding, get_completion
+from src.utils.llm_client import CompletionError, get_embedding, get_completion
 from src.config import CONFIG
+from src.utils.tracing import traced
 
 class DriftMeter:
     def __init__(self):
@@ -24,6 +25,8 @@ class DriftMeter:
         fidelity = dot_product / norm_sys
         return float(fidelity)
 
+    # The judge call itself is traced as llm.request ("network").
+    @traced("judge")
     def check_hypocrisy(self, response, facts):
         """
         Checks if the response contradicts any of the known facts.
@@ -46,11 +49,16 @@ Does the statement CONTRADICT any of the established facts?
 Reply with only "YES" or "NO". If YES, explain which fact is contradicted.
 """
         
-        check_result = get_completion(
-            [{"role": "user", "content": prompt}], 
-            model=CONFIG["judge_model"],
-            provider=CONFIG["judge_provider"]
-        )
+        try:
+            check_result = get_completion(
+                [{"role": "user", "content": prompt}], 
+                model=CONFIG["judge_model"],
+                provider=CONFIG["judge_provider"]
+            )
+        except CompletionError as e:
+            # A failed judge call marks this check only; it does not stop the generation run.
+            print(f"  [Judge] Hypocrisy check failed: {e}")
+            return "ERROR", str(e)
         
         if "YES" in check_result.upper():
             return "FAIL", check_result
@@ -58,6 +66,86 @@ Reply with only "YES" or "NO". If YES, explain which fact is contradicted.
             return "PASS", check_result
 
 
+class OnlineDriftTracker:
+    """
+    Incremental counterpart of PersonaDriftMetrics.drift_index for live runs.
+
+    Each update() takes one response embedding and costs O(d): the baseline is
+    the running mean of the first `early_turns` embeddings (frozen afterwards),
+    and drift is the cosine distance of the new embedding from that baseline.
+    Alongside it keeps an EWMA of drift, the least-squares slope of drift over
+    turns and a Page-Hinkley change-point flag for sustained upward shifts.
+    """
+
+    def __init__(self, early_turns=3, ewma_alpha=0.3, ph_delta=0.01, ph_threshold=0.15):
+        self.early_turns = early_turns
+        self.ewma_alpha = ewma_alpha
+        self.ph_delta = ph_delta
+        self.ph_threshold = ph_threshold
+
+        self.turn = 0
+        self._baseline_sum = None
+        self._baseline_n = 0
+        self.ewma = None
+
+        self._sum_t = 0.0
+        self._sum_d = 0.0
+        self._sum_tt = 0.0
+        self._sum_td = 0.0
+
+        self._ph_sum = 0.0
+        self._ph_min = 0.0
+
+    @property
+    def baseline(self):
+        if self._baseline_sum is None:
+            return None
+        return self._baseline_sum / self._baseline_n
+
+    def update(self, embedding):
+        v = np.asarray(embedding, dtype=float)
+        self.turn += 1
+
+        if self._baseline_n < self.early_turns:
+            self._baseline_sum = v.copy() if self._baseline_sum is None else self._baseline_sum + v
+            self._baseline_n += 1
+
+        baseline = self.baseline
+        denom = np.linalg.norm(baseline) * np.linalg.norm(v)
+        drift = 1.0 - float(np.dot(baseline, v) / denom) if denom else 0.0
+
+        if self.ewma is None:
+            self.ewma = drift
+        else:
+            self.ewma = self.ewma_alpha * drift + (1 - self.ewma_alpha) * self.ewma
+
+        t = float(self.turn)
+        self._sum_t += t
+        self._sum_d += drift
+        self._sum_tt += t * t
+        self._sum_td += t * drift
+        var_t = self.turn * self._sum_tt - self._sum_t ** 2
+        slope = (self.turn * self._sum_td - self._sum_t * self._sum_d) / var_t if var_t else 0.0
+
+        change_point = False
+        if self._baseline_n >= self.early_turns:
+            mean_d = self._sum_d / self.turn
+            self._ph_sum += drift - mean_d - self.ph_delta
+            self._ph_min = min(self._ph_min, self._ph_sum)
+            if self._ph_sum - self._ph_min > self.ph_threshold:
+                change_point = True
+                self._ph_sum = 0.0
+                self._ph_min = 0.0
+
+        return {
+            "turn": self.turn,
+            "drift": drift,
+            "drift_ewma": self.ewma,
+            "drift_slope": slope,
+            "change_point": change_point,
+        }
+
+
 def get_text_embedding(text):
     return get_embedding(
         text, 
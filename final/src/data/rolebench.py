@@ -0,0 +1,132 @@
+"""
+Shared RoleBench data layer for the generation scripts.
+
+The English role-specific test split is fetched from the Hub once and saved as
+a memory-mapped Arrow dataset, together with a prebuilt shuffled index and a
+normalised copy of the side-loaded profiles. Later runs start instantly,
+work offline, and every script sees the same sample order.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+from datasets import load_dataset, load_from_disk
+
+
+ROLEBENCH_URL = "hf://datasets/ZenMoore/RoleBench/rolebench-eng/instruction-generalization/role_specific/test.jsonl"
+PROFILE_DIR = "data/profiles/profiles-eng"
+CACHE_DIR = os.getenv("ROLEBENCH_CACHE_DIR", "data/cache")
+SHUFFLE_SEED = 42
+
+
+ROLE_PROFILES = {}
+_profiles_source = None
+
+
+def load_rolebench(seed=SHUFFLE_SEED, cache_dir=CACHE_DIR):
+    """
+    Returns the RoleBench test split in shuffled order.
+
+    The order is identical to `load_dataset(...).shuffle(seed=seed)`, which the
+    scripts used before, so record ids (rb_*_{i}) stay comparable across runs.
+    """
+    split_dir = os.path.join(cache_dir, "rolebench_eng_test")
+    index_path = os.path.join(cache_dir, f"rolebench_eng_test_shuffle_{seed}.npy")
+
+    if os.path.exists(split_dir):
+        dataset = load_from_disk(split_dir)
+    else:
+        print(f"Materializing RoleBench into {split_dir} (one-time)...")
+        dataset = load_dataset("json", data_files=ROLEBENCH_URL, split="train")
+        dataset.save_to_disk(split_dir)
+        dataset = load_from_disk(split_dir)
+
+    if os.path.exists(index_path):
+        indices = np.load(index_path)
+    else:
+        rows = dataset.add_column("_row", list(range(len(dataset))))
+        indices = np.asarray(rows.shuffle(seed=seed)["_row"], dtype=np.int64)
+        np.save(index_path, indices)
+
+    return dataset.select(indices)
+
+
+def load_profiles(profile_dir=PROFILE_DIR, cache_dir=CACHE_DIR):
+    """
+    Loads the side-loaded desc.json / scripts.json profiles into ROLE_PROFILES.
+    The merged result is cached per source directory and only rebuilt when the
+    source files change.
+    """
+    global _profiles_source
+    source = os.path.realpath(profile_dir)
+    if ROLE_PROFILES and _profiles_source == source:
+        return ROLE_PROFILES
+    ROLE_PROFILES.clear()
+    _profiles_source = source
+
+    desc_path = os.path.join(profile_dir, "desc.json")
+    scripts_path = os.path.join(profile_dir, "scripts.json")
+    source_key = hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"profiles_{source_key}.json")
+
+    if not os.path.exists(desc_path):
+        raise FileNotFoundError(
+            f"Profile metadata not found!\n"
+            f"   Run: python download_profiles.py\n"
+            f"   Missing: {desc_path}"
+        )
+
+    source_mtime = max(os.path.getmtime(desc_path), os.path.getmtime(scripts_path))
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= source_mtime:
+        with open(cache_path, 'r') as f:
+            ROLE_PROFILES.update(json.load(f))
+        return ROLE_PROFILES
+
+    print(f"📂 Loading profiles from {profile_dir}...")
+
+    with open(desc_path, 'r') as f:
+        descriptions = json.load(f)
+
+    with open(scripts_path, 'r') as f:
+        scripts = json.load(f)
+
+    all_roles = set(descriptions.keys()) | set(scripts.keys())
+    for role in all_roles:
+        catchphrases = scripts.get(role, [])
+
+        if isinstance(catchphrases, str):
+            catchphrases = [catchphrases] if catchphrases else []
+
+        ROLE_PROFILES[role] = {
+            "desc": descriptions.get(role, ""),
+            "catchphrases": catchphrases
+        }
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path, 'w') as f:
+        json.dump(ROLE_PROFILES, f)
+
+    print(f"✅ Loaded profiles for {len(ROLE_PROFILES)} characters.\n")
+    return ROLE_PROFILES
+
+
+def construct_authentic_prompt(role_name):
+    """
+    Constructs the System Prompt using the side-loaded metadata.
+    This follows the RoleBench formula for authentic persona prompts.
+    """
+    meta = load_profiles().get(role_name, {})
+    desc = meta.get("desc", "")
+    phrases = meta.get("catchphrases", [])
+
+    prompt = f"You are {role_name}. {desc}"
+
+    if phrases and len(phrases) > 0:
+        prompt += "\n\nHere are some examples of how you speak:"
+        for p in phrases[:5]:
+            if p:
+                prompt += f"\n- {p}"
+
+    prompt += "\n\nStay in character at all times. Do not reveal you are an AI."
+
+    return prompt
@@ -1,91 +1,174 @@
 import json
 import os
 import argparse
+import asyncio
+import time
 from dotenv import load_dotenv
-from datasets import load_dataset
 from tqdm import tqdm
 
 
 load_dotenv()
 
-from src.utils.llm_client import get_completion
+from src.utils.llm_client import CompletionError, get_completion_with_usage
+from src.utils.completion_client import AsyncCompletionClient
+from src.utils.checkpoint import load_completed_ids, ConversationCheckpoint
+from src.utils.tracing import span
 from src.generation.simulator import UserSimulator
+from src.data.rolebench import ROLE_PROFILES, load_rolebench, load_profiles, construct_authentic_prompt
 from src.config import CONFIG
 
 
 OUTPUT_FILE = "rolebench_baseline.jsonl"
 MAX_TURNS = 20
-PROFILE_DIR = "data/profiles/profiles-eng"  
 
 
-ROLE_PROFILES = {}
+def start_conversation(i, sample, model_simulator, provider_simulator):
+    """
+    Starts conversation `i`, or resumes it from its per-turn checkpoint, and
+    returns the state shared by run_conversation and run_conversation_async.
+    """
+    record_id = f"rb_base_{i}"
+    role_name = sample['role']
+    initial_instruction = sample['question']
+    
+    system_prompt = construct_authentic_prompt(role_name)
+    
+    
+    checkpoint = ConversationCheckpoint(OUTPUT_FILE, record_id)
+    state = checkpoint.load()
+    if state:
+        conversation = state["conversation"]
+        turn_stats = state.get("turn_stats", [])
+        start_turn = state["turn"]
+        print(f"Resuming {record_id} at turn {start_turn + 1}")
+    else:
+        conversation = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": initial_instruction}
+        ]
+        turn_stats = []
+        start_turn = 0
+    
+    simulator = UserSimulator(
+        role_name, 
+        initial_instruction, 
+        model_name=model_simulator,
+        provider=provider_simulator
+    )
+    
+    print(f"\n=== Conversation {i+1}: {role_name} ===")
+    return {
+        "record_id": record_id,
+        "role": role_name,
+        "system_prompt": system_prompt,
+        "base_instruction": initial_instruction,
+        "conversation": conversation,
+        "turn_stats": turn_stats,
+        "start_turn": start_turn,
+        "checkpoint": checkpoint,
+        "simulator": simulator,
+    }
 
-def load_profiles():
-    """Loads the side-loaded JSON files into a dictionary"""
-    global ROLE_PROFILES
-    
-    desc_path = os.path.join(PROFILE_DIR, "desc.json")
-    scripts_path = os.path.join(PROFILE_DIR, "scripts.json")
-    
-    if not os.path.exists(desc_path):
-        raise FileNotFoundError(
-            f"❌ Profile metadata not found!\n"
-            f"   Run: python download_profiles.py\n"
-            f"   Missing: {desc_path}"
-        )
-    
-    print(f"📂 Loading profiles from {PROFILE_DIR}...")
-    
-    with open(desc_path, 'r') as f:
-        descriptions = json.load(f)  
-        
-    with open(scripts_path, 'r') as f:
-        scripts = json.load(f)  
-        
-    
-    all_roles = set(descriptions.keys()) | set(scripts.keys())
-    for role in all_roles:
-        catchphrases = scripts.get(role, [])
-        
-        if isinstance(catchphrases, str):
-            catchphrases = [catchphrases] if catchphrases else []
-        
-        ROLE_PROFILES[role] = {
-            "desc": descriptions.get(role, ""),
-            "catchphrases": catchphrases
-        }
-    
-    print(f"✅ Loaded profiles for {len(ROLE_PROFILES)} characters.\n")
+def turn_stat(turn, turn_start, usage):
+    return {
+        "turn": turn + 1,
+        "latency_sec": time.time() - turn_start,
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "cached_tokens": usage.get("cached_tokens"),
+        "uncached_tokens": usage.get("uncached_tokens"),
+        "prefix_tokens": usage.get("prefix_tokens"),
+    }
+
+def conversation_record(state):
+    return {
+        "id": state["record_id"],
+        "role": state["role"],
+        "system_prompt": state["system_prompt"],  
+        "base_instruction": state["base_instruction"],
+        "turns": state["conversation"],
+        "turn_stats": state["turn_stats"],
+    }
 
-def construct_authentic_prompt(role_name):
+def run_conversation(i, sample, turns, model_persona, model_simulator, provider_persona, provider_simulator):
     """
-    Constructs the System Prompt using the side-loaded metadata.
-    This follows the RoleBench formula for authentic persona prompts.
+    Runs one persona/simulator conversation to completion and returns its record.
+    Progress is checkpointed after every turn and resumed from there on restart.
     """
-    if not ROLE_PROFILES:
-        load_profiles()
-        
-    meta = ROLE_PROFILES.get(role_name, {})
-    desc = meta.get("desc", "")
-    phrases = meta.get("catchphrases", [])
-    
-    
-    
-    prompt = f"You are {role_name}. {desc}"
-    
-    
-    if phrases and len(phrases) > 0:
-        prompt += "\n\nHere are some examples of how you speak:"
-        for p in phrases[:5]:  
-            if p:  
-                prompt += f"\n- {p}"
-            
+    state = start_conversation(i, sample, model_simulator, provider_simulator)
+    conversation = state["conversation"]
+    
+    for turn in range(state["start_turn"], turns):
+        with span("turn", persona_id=state["record_id"], role=state["role"], model=model_persona, turn=turn + 1):
+            turn_start = time.time()
+            persona_response, usage = get_completion_with_usage(
+                conversation, 
+                model_persona, 
+                provider=provider_persona,
+                conversation_id=state["record_id"]
+            )
+            state["turn_stats"].append(turn_stat(turn, turn_start, usage))
+            conversation.append({"role": "assistant", "content": persona_response})
+
+
+            if turn < turns - 1:
+                user_followup = state["simulator"].generate_followup(conversation)
+                conversation.append({"role": "user", "content": user_followup})
+
+            state["checkpoint"].save({"conversation": conversation, "turn_stats": state["turn_stats"], "turn": turn + 1})
     
-    prompt += "\n\nStay in character at all times. Do not reveal you are an AI."
+    return conversation_record(state)
+
+async def run_conversation_async(i, sample, client, turns, model_persona, model_simulator, provider_persona, provider_simulator):
+    """run_conversation with both speakers' requests sent through an AsyncCompletionClient."""
+    state = start_conversation(i, sample, model_simulator, provider_simulator)
+    conversation = state["conversation"]
+    
+    for turn in range(state["start_turn"], turns):
+        with span("turn", persona_id=state["record_id"], role=state["role"], model=model_persona, turn=turn + 1):
+            turn_start = time.time()
+            persona_response, usage = await client.complete_with_usage(
+                conversation, 
+                model_persona, 
+                provider=provider_persona,
+                conversation_id=state["record_id"]
+            )
+            state["turn_stats"].append(turn_stat(turn, turn_start, usage))
+            conversation.append({"role": "assistant", "content": persona_response})
+
+
+            if turn < turns - 1:
+                user_followup = await state["simulator"].generate_followup_async(conversation, client)
+                conversation.append({"role": "user", "content": user_followup})
+
+            state["checkpoint"].save({"conversation": conversation, "turn_stats": state["turn_stats"], "turn": turn + 1})
     
-    return prompt
+    return conversation_record(state)
+
+async def run_concurrently(samples, concurrency, conversation_args, write_record):
+    """
+    Each conversation still alternates turns serially; up to `concurrency`
+    conversations are in flight on one AsyncCompletionClient, and records are
+    written as they finish. Errors other than CompletionError propagate.
+    """
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run(i, sample):
+        async with slots:
+            try:
+                return await run_conversation_async(i, sample, client, *conversation_args)
+            except CompletionError as e:
+                # Completed turns are checkpointed; a later run resumes this conversation from there.
+                print(f"Conversation {i+1} stopped: {e}. Will resume from checkpoint.")
+                return None
 
-def process_rolebench(limit=None, turns=MAX_TURNS, model_persona=None, model_simulator=None):
+    async with AsyncCompletionClient(max_concurrency=concurrency) as client:
+        tasks = [asyncio.create_task(run(i, sample)) for i, sample in samples]
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            record = await task
+            if record is not None:
+                write_record(record)
+
+def process_rolebench(limit=None, turns=MAX_TURNS, model_persona=None, model_simulator=None, concurrency=1):
     
     model_persona = model_persona or CONFIG["persona_model"]
     model_simulator = model_simulator or CONFIG["simulator_model"]
@@ -96,8 +179,7 @@ def process_rolebench(limit=None, turns=MAX_TURNS, model_persona=None, model_sim
     print(f"Loading RoleBench (English Test Split)...")
     try:
         
-        data_url = "hf://datasets/ZenMoore/RoleBench/rolebench-eng/instruction-generalization/role_specific/test.jsonl"
-        dataset = load_dataset("json", data_files=data_url, split="train") 
+        dataset = load_rolebench()
     except Exception as e:
         print(f"Error loading dataset: {e}")
         return
@@ -107,65 +189,42 @@ def process_rolebench(limit=None, turns=MAX_TURNS, model_persona=None, model_sim
 
     print(f"Starting generation for {limit if limit else 'all'} samples...")
     
+    completed_ids = load_completed_ids(OUTPUT_FILE)
+    if completed_ids:
+        print(f"Resuming: {len(completed_ids)} conversations already in {OUTPUT_FILE}")
     
-    dataset = dataset.shuffle(seed=42)
-    
-    with open(OUTPUT_FILE, 'a') as f:
-        for i, sample in tqdm(enumerate(dataset)):
+    def pending_samples():
+        for i, sample in enumerate(dataset):
             if limit and i >= limit:
                 break
-            
-            role_name = sample['role']
-            initial_instruction = sample['question']
-            
-            
-            if role_name not in ROLE_PROFILES:
-                print(f"⚠️  Skipping {role_name} (No profile found)")
+            if f"rb_base_{i}" in completed_ids:
                 continue
-                
-            
-            system_prompt = construct_authentic_prompt(role_name)
-            
-            
-            conversation = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": initial_instruction}
-            ]
-            
-            simulator = UserSimulator(
-                role_name, 
-                initial_instruction, 
-                model_name=model_simulator,
-                provider=provider_simulator
-            )
-            
-            print(f"\n=== Conversation {i+1}: {role_name} ===")
-            
-            
-            for turn in range(turns):
-                
-                persona_response = get_completion(
-                    conversation, 
-                    model_persona, 
-                    provider=provider_persona
-                )
-                conversation.append({"role": "assistant", "content": persona_response})
-                
-                
-                if turn < turns - 1:
-                    user_followup = simulator.generate_followup(conversation)
-                    conversation.append({"role": "user", "content": user_followup})
-            
-            
-            record = {
-                "id": f"rb_base_{i}",
-                "role": role_name,
-                "system_prompt": system_prompt,  
-                "base_instruction": initial_instruction,
-                "turns": conversation
-            }
+            if sample['role'] not in ROLE_PROFILES:
+                print(f"⚠️  Skipping {sample['role']} (No profile found)")
+                continue
+            yield i, sample
+    
+    conversation_args = (turns, model_persona, model_simulator, provider_persona, provider_simulator)
+    
+    with open(OUTPUT_FILE, 'a') as f:
+        def write_record(record):
             f.write(json.dumps(record) + "\n")
             f.flush()
+            ConversationCheckpoint(OUTPUT_FILE, record["id"]).clear()
+
+        if concurrency <= 1:
+            for i, sample in tqdm(pending_samples()):
+                try:
+                    record = run_conversation(i, sample, *conversation_args)
+                except CompletionError as e:
+                    # Completed turns are checkpointed; a later run resumes this conversation from there.
+                    print(f"Conversation {i+1} stopped: {e}. Will resume from checkpoint.")
+                    continue
+                write_record(record)
+            return
+        
+        print(f"Running up to {concurrency} conversations concurrently...")
+        asyncio.run(run_concurrently(pending_samples(), concurrency, conversation_args, write_record))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -173,6 +232,7 @@ if __name__ == "__main__":
     parser.add_argument("--turns", type=int, default=MAX_TURNS, help="Number of turns per conversation")
     parser.add_argument("--persona_model", type=str, default=None, help="Model for Persona")
     parser.add_argument("--sim_model", type=str, default=None, help="Model for User Simulator")
+    parser.add_argument("--concurrency", type=int, default=1, help="Conversations to run at once")
     args = parser.parse_args()
     
-    process_rolebench(limit=args.limit, turns=args.turns, model_persona=args.persona_model, model_simulator=args.sim_model)
\ No newline at end of file
+    process_rolebench(limit=args.limit, turns=args.turns, model_persona=args.persona_model, model_simulator=args.sim_model, concurrency=args.concurrency)
\ No newline at end of file
@@ -1,11 +1,13 @@
 import json
 import argparse
 import numpy as np
-from datasets import load_dataset
 from tqdm import tqdm
-from src.utils.llm_client import get_completion, get_embedding
+from src.utils.llm_client import CompletionError, get_completion, get_embeddings, get_embedding_batcher
+from src.utils.checkpoint import load_completed_ids, ConversationCheckpoint
+from src.utils.tracing import span
 from src.generation.simulator import UserSimulator
-from src.analysis.metrics import DriftMeter
+from src.analysis.metrics import DriftMeter, OnlineDriftTracker
+from src.data.rolebench import load_rolebench
 from src.config import CONFIG
 
 
@@ -24,21 +26,29 @@ def process_monitored(limit=None, turns=MAX_TURNS, model_persona=None, model_sim
     print(f"Loading RoleBench (English Test Split)...")
     try:
         
-        data_url = "hf://datasets/ZenMoore/RoleBench/rolebench-eng/instruction-generalization/role_specific/test.jsonl"
-        dataset = load_dataset("json", data_files=data_url, split="train")
+        dataset = load_rolebench()
     except Exception as e:
         print(f"Error loading dataset: {e}")
         return
 
     meter = DriftMeter()
+    embedder = get_embedding_batcher(model=CONFIG["embedding_model"], provider=CONFIG["embedding_provider"])
     
     print(f"Starting MONITORED generation for {limit if limit else 'all'} samples...")
     
-    with open(OUTPUT_FILE, 'w') as f:
+    completed_ids = load_completed_ids(OUTPUT_FILE)
+    if completed_ids:
+        print(f"Resuming: {len(completed_ids)} conversations already in {OUTPUT_FILE}")
+    
+    with open(OUTPUT_FILE, 'a') as f:
         for i, sample in tqdm(enumerate(dataset)):
             if limit and i >= limit:
                 break
             
+            record_id = f"rb_monitored_{i}"
+            if record_id in completed_ids:
+                continue
+            
             role_name = sample['role']
             desc = sample.get('desc', '')
             profile = sample.get('profile', '')
@@ -54,19 +64,31 @@ def process_monitored(limit=None, turns=MAX_TURNS, model_persona=None, model_sim
 
             system_prompt = f"You are {role_name}. {desc} {profile}"
             initial_instruction = sample['question']
-            
-            
-            
-            sys_embedding = get_embedding(
-                system_prompt, 
-                model=CONFIG["embedding_model"], 
-                provider=CONFIG["embedding_provider"]
-            )
-            
-            conversation = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": initial_instruction}
-            ]
+            sys_embedding = None
+            
+            checkpoint = ConversationCheckpoint(OUTPUT_FILE, record_id)
+            state = checkpoint.load()
+            tracker = OnlineDriftTracker()
+            if state:
+                conversation = state["conversation"]
+                turn_metrics = state["metrics"]
+                start_turn = state["turn"]
+                print(f"Resuming {record_id} at turn {start_turn + 1}")
+                
+                # Rebuild the online tracker from the persona turns already generated.
+                past_responses = [m['content'] for m in conversation if m['role'] == 'assistant']
+                embeddings = get_embeddings([system_prompt] + past_responses, model=CONFIG["embedding_model"], provider=CONFIG["embedding_provider"])
+                sys_embedding = embeddings[0]
+                for emb in embeddings[1:]:
+                    if len(emb):
+                        tracker.update(emb)
+            else:
+                conversation = [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": initial_instruction}
+                ]
+                turn_metrics = []
+                start_turn = 0
             
             simulator = UserSimulator(
                 role_name, 
@@ -79,52 +101,68 @@ def process_monitored(limit=None, turns=MAX_TURNS, model_persona=None, model_sim
             print(f"Role: {role_name}")
             print(f"[Simulator (Seed)]: {initial_instruction}")
             
-            turn_metrics = []
-            
-            
-            for turn in range(turns):
-                
-                persona_response = get_completion(
-                    conversation, 
-                    model_persona, 
-                    provider=provider_persona
-                )
-                print(f"  [Persona]: {persona_response[:100]}...")
-                conversation.append({"role": "assistant", "content": persona_response})
-                
-                
-                
-                resp_embedding = get_embedding(
-                    persona_response,
-                    model=CONFIG["embedding_model"], 
-                    provider=CONFIG["embedding_provider"]
-                )
-                drift_score = meter.calculate_orthogonal_drift(sys_embedding, resp_embedding)
-                
-                
-                
-                hypocrisy_status = "SKIPPED"
-                hypocrisy_reason = ""
-                if (turn + 1) % 5 == 0 or turn == turns - 1:
-                    hypocrisy_status, hypocrisy_reason = meter.check_hypocrisy(persona_response, facts)
-                
-                metrics = {
-                    "turn": turn + 1,
-                    "drift_score": drift_score,
-                    "hypocrisy_status": hypocrisy_status,
-                    "hypocrisy_reason": hypocrisy_reason
-                }
-                turn_metrics.append(metrics)
-                
-                
-                if turn < turns - 1:
-                    user_followup = simulator.generate_followup(conversation)
-                    print(f"  [Simulator]: {user_followup[:100]}...")
-                    conversation.append({"role": "user", "content": user_followup})
+            try:
+                for turn in range(start_turn, turns):
+                    with span("turn", persona_id=record_id, role=role_name, model=model_persona, turn=turn + 1):
+                        persona_response = get_completion(
+                            conversation, 
+                            model_persona, 
+                            provider=provider_persona
+                        )
+                        print(f"  [Persona]: {persona_response[:100]}...")
+                        conversation.append({"role": "assistant", "content": persona_response})
+
+
+                        # The embedding request runs in the background while the judge and simulator are called.
+                        # The first one also carries the system prompt, so both are embedded in one call.
+                        if sys_embedding is None:
+                            sys_embedding_future, resp_embedding_future = embedder.submit_many([system_prompt, persona_response])
+                        else:
+                            resp_embedding_future = embedder.submit(persona_response)
+
+
+                        hypocrisy_status = "SKIPPED"
+                        hypocrisy_reason = ""
+                        if (turn + 1) % 5 == 0 or turn == turns - 1:
+                            hypocrisy_status, hypocrisy_reason = meter.check_hypocrisy(persona_response, facts)
+
+
+                        if turn < turns - 1:
+                            user_followup = simulator.generate_followup(conversation)
+                            print(f"  [Simulator]: {user_followup[:100]}...")
+                            conversation.append({"role": "user", "content": user_followup})
+
+
+                        with span("embedding.wait", "wait"):
+                            if sys_embedding is None:
+                                sys_embedding = sys_embedding_future.result()
+                            resp_embedding = resp_embedding_future.result()
+                        drift_score = meter.calculate_orthogonal_drift(sys_embedding, resp_embedding)
+                        online = tracker.update(resp_embedding) if len(resp_embedding) else {}
+                        if online.get("change_point"):
+                            print(f"  [Drift] Change point at turn {turn + 1} (drift={online['drift']:.3f})")
+
+                        metrics = {
+                            "turn": turn + 1,
+                            "drift_score": drift_score,
+                            "online_drift": online.get("drift"),
+                            "drift_ewma": online.get("drift_ewma"),
+                            "drift_slope": online.get("drift_slope"),
+                            "change_point": online.get("change_point", False),
+                            "hypocrisy_status": hypocrisy_status,
+                            "hypocrisy_reason": hypocrisy_reason
+                        }
+                        turn_metrics.append(metrics)
+
+                        checkpoint.save({"conversation": conversation, "metrics": turn_metrics, "turn": turn + 1})
+            except CompletionError as e:
+                # Completed turns are checkpointed; a later run resumes this conversation from there.
+                print(f"  [Error] {record_id} stopped at turn {turn + 1}: {e}. Will resume from checkpoint.")
+                continue
             
             
             record = {
-                "id": f"rb_monitored_{i}",
+                "id": record_id,
                 "role": role_name,
                 "base_instruction": initial_instruction,
                 "turns": conversation,
@@ -132,6 +170,7 @@ def process_monitored(limit=None, turns=MAX_TURNS, model_persona=None, model_sim
             }
             f.write(json.dumps(record) + "\n")
             f.flush()
+            checkpoint.clear()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -1,5 +1,6 @@
 from src.utils.llm_client import get_completion
 from src.config import CONFIG
+from src.utils.tracing import span, traced
 
 class UserSimulator:
     """The Agent designed to make the Persona drift."""
@@ -9,8 +10,18 @@ class UserSimulator:
         self.model_name = model_name or CONFIG["simulator_model"]
         self.provider = provider or CONFIG["simulator_provider"]
     
+    # Neutral category: the request time is attributed to the child llm.request span ("network").
+    @traced("simulator")
     def generate_followup(self, conversation_history):
         """Looks at the last response and asks a probing question."""
+        return get_completion(self.followup_messages(conversation_history), self.model_name, provider=self.provider)
+
+    async def generate_followup_async(self, conversation_history, client):
+        """generate_followup through an AsyncCompletionClient."""
+        with span("simulator"):
+            return await client.complete(self.followup_messages(conversation_history), self.model_name, provider=self.provider)
+
+    def followup_messages(self, conversation_history):
         last_response = ""
         for msg in reversed(conversation_history):
             if msg['role'] == 'assistant':
@@ -46,6 +57,4 @@ class UserSimulator:
 
               
         clean_history = [m for m in conversation_history if m['role'] != 'system']
-        messages = [{"role": "system", "content": system_prompt}] + clean_history
-        
-        return get_completion(messages, self.model_name, provider=self.provider)
+        return [{"role": "system", "content": system_prompt}] + clean_history
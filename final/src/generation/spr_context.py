@@ -0,0 +1,61 @@
+"""
+Context construction for System Prompt Repetition (SPR) runs.
+
+Instead of deep-copying the whole conversation log every turn, the builder
+returns a new list that shares the log's message dicts and only creates the
+messages that carry the reminder. Three reinjection layouts are available:
+
+- "inline":   the reminder is prepended to the latest user message only
+              (the original SPR setup). Earlier user messages are sent
+              verbatim, so the prompt diverges from the previous turn's
+              prompt at the previous user message.
+- "trailing": the history is sent verbatim and the reminder is appended as a
+              final system message, so everything up to the latest user
+              message is a stable prefix.
+- "sticky":   every user message is sent in its reinjected form, so each
+              turn's prompt extends the previous one exactly and the whole
+              history is reusable by provider-side prompt caching.
+"""
+
+REINJECTION_LAYOUTS = ("inline", "trailing", "sticky")
+
+
+def reinject(core_system_prompt, user_content):
+    return (
+        f"SYSTEM REMINDER: {core_system_prompt}\n"
+        f"--------------------------------------------------\n"
+        f"USER QUERY: {user_content}"
+    )
+
+
+class SPRContextBuilder:
+    def __init__(self, core_system_prompt, layout="inline"):
+        if layout not in REINJECTION_LAYOUTS:
+            raise ValueError(f"Unknown SPR layout '{layout}' (expected one of {REINJECTION_LAYOUTS})")
+        self.core_system_prompt = core_system_prompt
+        self.layout = layout
+        self._reinjected = {}
+
+    def _reinjected_message(self, msg):
+        # Memoised per message object so sticky contexts don't rebuild old reminders.
+        key = id(msg)
+        cached = self._reinjected.get(key)
+        if cached is None or cached[0] is not msg:
+            cached = (msg, {"role": "user", "content": reinject(self.core_system_prompt, msg['content'])})
+            self._reinjected[key] = cached
+        return cached[1]
+
+    def build(self, conversation_log):
+        """Messages to send for the next persona turn; `conversation_log` is never mutated."""
+        if self.layout == "inline":
+            if conversation_log[-1]['role'] != 'user':
+                return list(conversation_log)
+            return conversation_log[:-1] + [self._reinjected_message(conversation_log[-1])]
+
+        if self.layout == "trailing":
+            return conversation_log + [{"role": "system", "content": f"SYSTEM REMINDER: {self.core_system_prompt}"}]
+
+        return [
+            self._reinjected_message(msg) if msg['role'] == 'user' else msg
+            for msg in conversation_log
+        ]
@@ -1,6 +1,10 @@
 import numpy as np
-from sentence_transformers import SentenceTransformer, CrossEncoder, util
-from src.utils.llm_client import get_completion
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sentence_transformers import util
+from src.utils.llm_client import CompletionError, get_completion
+from src.utils.onnx_backend import load_sim_model, load_nli_model
+from src.config import CONFIG
+from src.utils.tracing import span
 
 class IGRCGuardrail:
     """
@@ -10,71 +14,157 @@ class IGRCGuardrail:
     
     def __init__(self, nli_model="cross-encoder/nli-deberta-v3-base", 
                  sim_model="all-MiniLM-L6-v2", 
-                 device="cpu"):
+                 device="cpu",
+                 backend=None):
         """
         Initializes the lightweight local models for drift detection.
+        backend: "torch" or "onnx" (int8 ONNX Runtime); defaults to CONFIG["inference_backend"].
         """
-        print(f"Loading IGRC Guardrail models on {device}...")
+        backend = backend or CONFIG.get("inference_backend", "torch")
+        print(f"Loading IGRC Guardrail models on {device} ({backend} backend)...")
         
         
-        self.nli_model = CrossEncoder(nli_model, device=device)
+        self.nli_model = load_nli_model(nli_model, device=device, backend=backend)
         
         
-        self.sim_model = SentenceTransformer(sim_model, device=device)
+        self.sim_model = load_sim_model(sim_model, device=device, backend=backend)
         
         
         self.NLI_THRESHOLD = 0.7  
         self.SIM_THRESHOLD = 0.4  
         
+        self._anchor_cache = {}
+        
         print("IGRC System Ready.")
 
+    def anchor_embedding(self, anchor_profile):
+        """
+        The anchor is fixed for a whole conversation, so its embedding is
+        computed once per role profile and reused for every draft and retry.
+        """
+        emb = self._anchor_cache.get(anchor_profile)
+        if emb is None:
+            emb = self.sim_model.encode(anchor_profile, convert_to_tensor=True)
+            self._anchor_cache[anchor_profile] = emb
+        return emb
+
+    def check_drafts(self, drafts, anchor_profile):
+        """
+        Batched 'Divergence Monitor': scores several candidate drafts with one
+        NLI pass and one similarity pass.
+        Returns a list of (is_drifting: bool, reason: str), one per draft.
+        """
+        with span("nli", "cpu", batch_size=len(drafts)):
+            nli_scores = self.nli_model.predict([(anchor_profile, d) for d in drafts])
+        pred_labels = nli_scores.argmax(axis=1)
+
+        with span("embedding", "cpu", batch_size=len(drafts)):
+            emb_drafts = self.sim_model.encode(drafts, convert_to_tensor=True)
+            cosine_sims = util.cos_sim(self.anchor_embedding(anchor_profile), emb_drafts)[0].tolist()
+
+        results = []
+        for pred_label, cosine_sim in zip(pred_labels, cosine_sims):
+            if pred_label == 0: 
+                results.append((True, "Factual Contradiction detected against persona profile."))
+            elif cosine_sim < self.SIM_THRESHOLD:
+                results.append((True, f"Stylistic Drift detected (Similarity: {cosine_sim:.2f} < {self.SIM_THRESHOLD})"))
+            else:
+                results.append((False, "Pass"))
+        return results
+
     def check_drift(self, draft_response, anchor_profile):
         """
         The 'Divergence Monitor'.
         Returns: (is_drifting: bool, reason: str)
         """
-        
-        
-        
-        nli_scores = self.nli_model.predict([(anchor_profile, draft_response)])
-        
-        
-        
-        
-        
-        
-        
-        
-        pred_label = nli_scores[0].argmax()
-        
-        
-        if pred_label == 0: 
-             return True, "Factual Contradiction detected against persona profile."
+        return self.check_drafts([draft_response], anchor_profile)[0]
 
-        
-        emb_anchor = self.sim_model.encode(anchor_profile, convert_to_tensor=True)
-        emb_draft = self.sim_model.encode(draft_response, convert_to_tensor=True)
-        
-        cosine_sim = util.cos_sim(emb_anchor, emb_draft).item()
-        
-        if cosine_sim < self.SIM_THRESHOLD:
-            return True, f"Stylistic Drift detected (Similarity: {cosine_sim:.2f} < {self.SIM_THRESHOLD})"
-            
-        return False, "Pass"
+    def speculative_drafts(self, conversation_history, anchor_profile, model_name, provider, k):
+        """
+        Fires the original draft and `k` higher-temperature alternatives
+        concurrently and scores each one as soon as it arrives, stopping at the
+        first that passes; requests still in flight are abandoned.
+        Returns (draft, (is_drifting, reason), metadata) for that draft, or for
+        the original draft if none pass. Drafts whose request failed are
+        skipped; CompletionError is raised only if every request failed.
+
+        Running HTTP calls cannot be cancelled, so abandoned drafts are still
+        generated and billed; metadata counts them under "abandoned", next to
+        "launched" (requests sent) and "failed".
+        """
+        temperatures = [0.7] + [min(0.7 + 0.2 * (j + 1), 1.5) for j in range(k)]
+        pool = ThreadPoolExecutor(max_workers=len(temperatures))
+        futures = {
+            pool.submit(get_completion, conversation_history, model_name, provider=provider, temperature=t): i
+            for i, t in enumerate(temperatures)
+        }
+        scored = {}
+        error = None
+        failed = 0
+        try:
+            for future in as_completed(futures):
+                try:
+                    draft = future.result()
+                except CompletionError as e:
+                    error = e
+                    failed += 1
+                    continue
+                index = futures[future]
+                scored[index] = (draft, self.check_drafts([draft], anchor_profile)[0])
+                if not scored[index][1][0]:
+                    break
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        launched = sum(1 for f in futures if not f.cancelled())
+
+        if not scored:
+            raise error
+        passing = [i for i, (_, (is_drifting, _)) in scored.items() if not is_drifting]
+        selected = passing[0] if passing else min(scored)
 
-    def recursive_generate(self, conversation_history, anchor_profile, model_name, provider, max_retries=2):
+        metadata = {
+            "candidates": len(scored),
+            "passed": len(passing),
+            "selected_index": selected if passing else None,
+            "alternative_selected": bool(passing) and selected > 0,
+            "launched": launched,
+            "failed": failed,
+            "abandoned": launched - len(scored) - failed,
+            "temperatures": temperatures,
+        }
+        return scored[selected][0], scored[selected][1], metadata
+
+    def recursive_generate(self, conversation_history, anchor_profile, model_name, provider, max_retries=2, speculative_k=0):
         """
         The Main Loop: Generate -> Check -> Refine
+        
+        With speculative_k > 0 the first step generates k alternatives alongside
+        the original draft in parallel; the critique loop only runs if all fail.
+        Picking a passing alternative is reported as speculative
+        "alternative_selected", not as "corrected", so correction rates stay
+        comparable with the non-speculative path.
         """
         
-        draft = get_completion(conversation_history, model_name, provider=provider)
+        first_check = None
+        spec_meta = None
+        if speculative_k > 0:
+            draft, first_check, spec_meta = self.speculative_drafts(
+                conversation_history, anchor_profile, model_name, provider, speculative_k
+            )
+            if not first_check[0]:
+                return draft, {"corrected": False, "retries": 0, "speculative": spec_meta}
+        else:
+            draft = get_completion(conversation_history, model_name, provider=provider)
         
         
         for attempt in range(max_retries + 1):
-            is_drifting, reason = self.check_drift(draft, anchor_profile)
+            if attempt == 0 and first_check is not None:
+                is_drifting, reason = first_check
+            else:
+                is_drifting, reason = self.check_drift(draft, anchor_profile)
             
             if not is_drifting:
-                return draft, {"corrected": attempt > 0, "retries": attempt}
+                return draft, self._metadata({"corrected": attempt > 0, "retries": attempt}, spec_meta)
             
             
             print(f"  [IGRC TRIGGERED]: {reason} | Attempt {attempt+1}/{max_retries}")
@@ -98,4 +188,10 @@ class IGRCGuardrail:
             draft = get_completion(correction_messages, model_name, provider=provider)
             
         
-        return draft, {"corrected": True, "retries": max_retries, "failed_to_fix": True}
\ No newline at end of file
+        return draft, self._metadata({"corrected": True, "retries": max_retries, "failed_to_fix": True}, spec_meta)
+
+    @staticmethod
+    def _metadata(metadata, spec_meta):
+        if spec_meta is not None:
+            metadata["speculative"] = spec_meta
+        return metadata
@@ -0,0 +1,85 @@
+"""
+Resume support for the RoleBench generators.
+
+Finished conversations are identified by the ids already present in the
+output JSONL; an in-flight conversation is checkpointed after every turn to
+a small JSON file in a sidecar directory, so a preempted run loses at most the
+turn that was being generated.
+"""
+import json
+import os
+
+from src.utils.tracing import traced
+
+
+def truncate_torn_tail(output_file, chunk_size=65536):
+    """
+    Cuts a partial last line (left by a crash mid-write) off `output_file`, so
+    the next appended record starts on its own line. Returns the bytes removed.
+    """
+    with open(output_file, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - chunk_size)
+            f.seek(start)
+            chunk = f.read(end - start)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+        return size - end
+
+
+def load_completed_ids(output_file):
+    """
+    Ids of all records already written to `output_file`. A torn last line is
+    truncated away first, since the caller is about to append to the file.
+    """
+    completed = set()
+    if not os.path.exists(output_file):
+        return completed
+    torn = truncate_torn_tail(output_file)
+    if torn:
+        print(f"Removed a {torn}-byte partial record from the end of {output_file}")
+    with open(output_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                completed.add(json.loads(line)['id'])
+            except (json.JSONDecodeError, KeyError):
+                continue
+    return completed
+
+
+class ConversationCheckpoint:
+    """Per-turn state of one in-flight conversation, stored as <output_file>.inflight/<record_id>.json."""
+
+    def __init__(self, output_file, record_id):
+        self.dir = f"{output_file}.inflight"
+        self.path = os.path.join(self.dir, f"{record_id}.json")
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            return None
+
+    @traced("checkpoint.write", "disk")
+    def save(self, state):
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,115 @@
+"""
+Async counterpart of llm_client.get_completion for high-throughput generation.
+
+One AsyncCompletionClient holds a pooled HTTP connection to OpenAI, a
+concurrency cap shared by every in-flight request, the same per-(provider,
+model) adaptive rate limiters as the sync path, and retries transient failures
+with jittered exponential backoff instead of returning an empty turn.
+baseline.py --concurrency N drives its conversations through one client.
+"""
+import asyncio
+import os
+
+import httpx
+import replicate
+from openai import AsyncOpenAI
+
+from src.config import CONFIG
+from src.utils.llm_client import CompletionError, truncate_history, replicate_input, openai_cache_hints, openai_usage
+from src.utils.prompt_cache import shared_prefix_tokens
+from src.utils.rate_limit import get_limiter, call_with_limiter_async
+from src.utils.tracing import span
+
+
+class AsyncCompletionClient:
+    def __init__(self, max_concurrency=16, max_retries=None, rate_limits=None, timeout=120.0):
+        self.max_retries = max_retries if max_retries is not None else CONFIG.get("max_retries", 5)
+        self.rate_limits = rate_limits if rate_limits is not None else CONFIG.get("rate_limits")
+        self.max_concurrency = max_concurrency
+        # Created on first use, so it belongs to the loop that runs the requests.
+        self._semaphore = None
+        self._http = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+        )
+        self._openai = None
+        if os.getenv("OPENAI_API_KEY"):
+            self._openai = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=self._http, max_retries=0)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._http.aclose()
+
+    async def _openai_completion(self, messages, model, temperature):
+        if self._openai is None:
+            raise CompletionError("OpenAI client not initialized. Check OPENAI_API_KEY.")
+        response = await self._openai.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            **openai_cache_hints(messages, model, self._openai.base_url)
+        )
+        return response.choices[0].message.content, openai_usage(response)
+
+    async def _replicate_completion(self, messages, model, temperature):
+        if not os.getenv("REPLICATE_API_TOKEN"):
+            raise CompletionError("REPLICATE_API_TOKEN not set.")
+        output = await replicate.async_run(model, input=replicate_input(messages, temperature))
+        if hasattr(output, "__aiter__"):
+            return "".join([chunk async for chunk in output]), {}
+        return "".join(output), {}
+
+    async def complete(self, messages, model, provider="openai", temperature=0.7):
+        """Awaitable llm_client.get_completion; raises CompletionError when a request cannot succeed."""
+        return (await self.complete_with_usage(messages, model, provider=provider, temperature=temperature))[0]
+
+    async def complete_with_usage(self, messages, model, provider="openai", temperature=0.7, conversation_id=None):
+        """Awaitable llm_client.get_completion_with_usage: returns (text, usage) with the same usage keys."""
+        with span("prompt.build", "cpu", model=model):
+            messages, context = truncate_history(messages, model, provider)
+            prefix_tokens = shared_prefix_tokens(messages, model, conversation_id)
+        if provider == "openai":
+            call = self._openai_completion
+        elif provider == "replicate":
+            call = self._replicate_completion
+        else:
+            raise CompletionError(f"Unknown provider {provider}")
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def request():
+            async with self._semaphore:
+                with span("llm.request", "network", model=model, provider=provider) as sp:
+                    text, usage = await call(messages, model, temperature)
+                    sp.set(**usage)
+                return text, usage
+
+        try:
+            text, usage = await call_with_limiter_async(
+                get_limiter(provider, model, self.rate_limits),
+                request,
+                max_retries=self.max_retries,
+                label=provider,
+            )
+        except CompletionError:
+            raise
+        except Exception as e:
+            raise CompletionError(f"{provider} completion failed: {e}") from e
+        return text, dict(usage, prefix_tokens=prefix_tokens, context=context)
+
+    async def complete_many(self, requests):
+        """
+        Runs many completions concurrently (bounded by max_concurrency).
+        requests: iterable of dicts with the keyword arguments of complete().
+        Returns results in input order; failed requests yield their CompletionError.
+        """
+        return await asyncio.gather(
+            *(self.complete(**request) for request in requests),
+            return_exceptions=True,
+        )
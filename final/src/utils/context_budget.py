@@ -0,0 +1,76 @@
+"""
+Token-budget-aware history truncation for chat requests.
+
+Messages are counted once with a cached tokenizer and the history is filled
+newest-first until the configured prompt budget is reached, always keeping
+the system message and the latest message. With block > 1 the oldest kept
+message moves forward only in steps of `block` messages, so consecutive turns
+re-send an identical prefix that provider-side prompt caches can reuse. OpenAI models are counted with
+their own tiktoken encoding; other providers (e.g. Llama on Replicate) use
+cl100k_base as an approximation.
+"""
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# Per-message framing overhead in the chat format (role and separators).
+MESSAGE_OVERHEAD_TOKENS = 4
+DEFAULT_ENCODING = "cl100k_base"
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+@lru_cache(maxsize=65536)
+def count_tokens(text, model=DEFAULT_ENCODING):
+    """Token count of `text`; memoised, so re-sent history is only tokenized once."""
+    encoding = _encoding(model)
+    if encoding is None:
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(msg, model=DEFAULT_ENCODING):
+    return count_tokens(msg['content'] or "", model) + MESSAGE_OVERHEAD_TOKENS
+
+
+def fit_to_budget(messages, budget, model=DEFAULT_ENCODING, block=1):
+    """
+    Returns (kept_messages, decision). The leading system message and the
+    latest message are always kept; earlier messages are added newest-first
+    while they fit in `budget` tokens. The number of dropped messages is
+    rounded up to a multiple of `block` (while the latest message remains).
+    """
+    counts = [message_tokens(m, model) for m in messages]
+    total = sum(counts)
+    decision = {"budget": budget, "total_tokens": total, "kept_tokens": total, "dropped_messages": 0}
+    if total <= budget or len(messages) <= 2:
+        return messages, decision
+
+    head = 1 if messages[0]['role'] == 'system' else 0
+    used = sum(counts[:head]) + counts[-1]
+    start = len(messages) - 1
+    while start - 1 >= head and used + counts[start - 1] <= budget:
+        start -= 1
+        used += counts[start]
+
+    if block > 1:
+        aligned = head + -(-(start - head) // block) * block
+        start = min(aligned, len(messages) - 1)
+        used = sum(counts[:head]) + sum(counts[start:])
+
+    kept = messages[:head] + messages[start:]
+    decision["kept_tokens"] = used
+    decision["dropped_messages"] = len(messages) - len(kept)
+    return kept, decision
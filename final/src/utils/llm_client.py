@@ -1,11 +1,45 @@
 import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
 import replicate
 from openai import OpenAI
+from src.config import CONFIG
+from src.utils.rate_limit import get_limiter, call_with_limiter
+from src.utils.context_budget import fit_to_budget
+from src.utils.prompt_cache import prompt_cache_key, shared_prefix_tokens, supports_prompt_cache_key
+from src.utils.tracing import span
 
 
 
+# Context windows in tokens, matched against the model name (longest key first).
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "llama-2": 4096,
+    "llama-3": 8192,
+    "llama-3.1": 131072,
+    "llama-3.2": 131072,
+    "llama-3.3": 131072,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+REPLICATE_MAX_NEW_TOKENS = 512
+# OpenAI requests do not cap completion length, so this much room is left for the reply.
+OPENAI_COMPLETION_RESERVE = 1024
+# Prompts are counted with tiktoken; for non-OpenAI models (e.g. Llama) that undercounts,
+# so this fraction of the window is kept free as a safety margin.
+TOKENIZER_MISMATCH_MARGIN = 0.15
+# History is dropped this many messages at a time, so the kept prefix (and the
+# provider's prompt cache) stays unchanged for several turns after each cut.
+DEFAULT_TRUNCATION_BLOCK = 8
+
 try:
-    openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    # Retries are handled below so that 429s reach the adaptive rate limiter.
+    openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 except:
     openai_client = None
     print("Warning: OpenAI client could not be initialized. Check OPENAI_API_KEY.")
@@ -26,81 +60,286 @@ def format_replicate_prompt(messages):
     prompt += "<|start_header_id|>assistant<|end_header_id|>\n\n"
     return prompt
 
+class CompletionError(RuntimeError):
+    """A completion request failed after all retries; callers must not treat it as an empty turn."""
+
+
+def context_window(model):
+    name = model.lower()
+    for key in sorted(MODEL_CONTEXT_WINDOWS, key=len, reverse=True):
+        if key in name:
+            return MODEL_CONTEXT_WINDOWS[key]
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def context_token_budget(model, provider):
+    """
+    Prompt-token budget for `model`: its context window minus the completion
+    reserve, minus a tokenizer-mismatch margin for non-OpenAI models.
+    CONFIG["context_token_budget"] overrides it, either as one number or as a
+    {model: budget} dict.
+    """
+    override = CONFIG.get("context_token_budget")
+    if isinstance(override, dict):
+        override = override.get(model)
+    if override:
+        return override
+    window = context_window(model)
+    reserve = REPLICATE_MAX_NEW_TOKENS if provider == "replicate" else OPENAI_COMPLETION_RESERVE
+    margin = 0 if provider == "openai" else int(window * TOKENIZER_MISMATCH_MARGIN)
+    return max(window - reserve - margin, 0)
+
+
+def truncate_history(messages, model, provider="openai"):
+    """
+    Keeps the system message plus as much recent history as fits in
+    context_token_budget(model, provider) prompt tokens. Returns
+    (messages, decision) and logs the turn whenever messages had to be dropped.
+    """
+    budget = context_token_budget(model, provider)
+    block = CONFIG.get("truncation_block", DEFAULT_TRUNCATION_BLOCK)
+    kept, decision = fit_to_budget(messages, budget, model=model, block=block)
+    if decision["dropped_messages"]:
+        print(
+            f"  [Context] Dropped {decision['dropped_messages']} oldest message(s): "
+            f"{decision['kept_tokens']}/{decision['total_tokens']} tokens kept (budget {budget})"
+        )
+    return kept, decision
+
+def replicate_input(messages, temperature):
+    return {
+        "prompt": format_replicate_prompt(messages),
+        "temperature": temperature,
+        "max_new_tokens": REPLICATE_MAX_NEW_TOKENS
+    }
+
+def openai_usage(response):
+    """Token counts from an OpenAI response, including provider-side cached prompt tokens."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return {}
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", None) or 0) if details else 0
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "cached_tokens": cached,
+        "uncached_tokens": usage.prompt_tokens - cached,
+    }
+
+def openai_cache_hints(messages, model, base_url=None):
+    """
+    Extra request fields that help OpenAI's prefix cache: a prompt_cache_key
+    shared by every request with the same model and system prompt.
+    CONFIG["prompt_cache_hints"]: "auto" (default) sends it only to OpenAI's own
+    API, since compatible servers may reject unknown fields; True always, False never.
+    """
+    setting = CONFIG.get("prompt_cache_hints", "auto")
+    if not setting or (setting == "auto" and not supports_prompt_cache_key(base_url)):
+        return {}
+    return {"extra_body": {"prompt_cache_key": prompt_cache_key(messages, model)}}
+
+def _openai_completion(messages, model, temperature):
+    response = openai_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        **openai_cache_hints(messages, model, openai_client.base_url)
+    )
+    return response.choices[0].message.content, openai_usage(response)
+
+def _replicate_completion(messages, model, temperature):
+    print(f"  [Replicate] Requesting {model}... (May take time if cold booting)")
+    output = replicate.run(
+        model,
+        input=replicate_input(messages, temperature)
+    )
+    print(f"  [Replicate] Response received.")
+    
+    
+    return "".join(output), {}
+
 def get_completion(messages, model, provider="openai", temperature=0.7):
     """
     Unified wrapper for API calls.
+    Requests are paced by the per-(provider, model) adaptive rate limiter,
+    which backs off on 429s and honours Retry-After; rate limits, timeouts
+    and 5xx errors are retried.
+    Raises CompletionError once retries are exhausted, on a non-retryable error,
+    or when the provider is unknown or not configured.
+    """
+    return get_completion_with_usage(messages, model, provider=provider, temperature=temperature)[0]
+
+def get_completion_with_usage(messages, model, provider="openai", temperature=0.7, conversation_id=None):
+    """
+    Same as get_completion, but returns (text, usage). usage holds prompt,
+    completion and provider-cached prompt token counts when the provider
+    reports them, "prefix_tokens" (prompt tokens shared with the previous
+    request of `conversation_id`, i.e. what a prefix cache can serve),
+    plus the history truncation decision under "context".
     """
     
-    if len(messages) > 11:
-        
-        if messages[0]['role'] == 'system':
-            messages = [messages[0]] + messages[-10:]
-        else:
-            messages = messages[-11:]
+    with span("prompt.build", "cpu", model=model):
+        messages, context = truncate_history(messages, model, provider)
+        prefix_tokens = shared_prefix_tokens(messages, model, conversation_id)
 
     if provider == "openai":
         if not openai_client:
-            return "Error: OpenAI client not initialized."
-        try:
-            response = openai_client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            print(f"Error in OpenAI get_completion: {e}")
-            return ""
+            raise CompletionError("OpenAI client not initialized. Check OPENAI_API_KEY.")
+        call = _openai_completion
             
     elif provider == "replicate":
         
         if not os.getenv("REPLICATE_API_TOKEN"):
-            print("Error: REPLICATE_API_TOKEN not set.")
-            return ""
-            
-        try:
-            
-            
-            prompt_str = format_replicate_prompt(messages)
-            
-            input_args = {
-                "prompt": prompt_str,
-                "temperature": temperature,
-                "max_new_tokens": 512
-            }
-            
-            print(f"  [Replicate] Requesting {model}... (May take time if cold booting)")
-            output = replicate.run(
-                model,
-                input=input_args
-            )
-            print(f"  [Replicate] Response received.")
-            
-            
-            return "".join(output)
-            
-        except Exception as e:
-            print(f"Error in Replicate get_completion: {e}")
-            return ""
+            raise CompletionError("REPLICATE_API_TOKEN not set.")
+        call = _replicate_completion
             
     else:
-        return f"Error: Unknown provider {provider}"
+        raise CompletionError(f"Unknown provider {provider}")
+
+    def request():
+        with span("llm.request", "network", model=model, provider=provider) as sp:
+            text, usage = call(messages, model, temperature)
+            sp.set(**usage)
+        return text, usage
+
+    try:
+        text, usage = call_with_limiter(
+            get_limiter(provider, model, CONFIG.get("rate_limits")),
+            request,
+            max_retries=CONFIG.get("max_retries", 5),
+            label=provider,
+        )
+    except Exception as e:
+        raise CompletionError(f"{provider} completion failed: {e}") from e
+    return text, dict(usage, prefix_tokens=prefix_tokens, context=context)
 
 def get_embedding(text, model="text-embedding-3-small", provider="openai"):
     """
     Get embedding for a text string.
-    Currently only supports OpenAI for embeddings as it's the standard for this project.
+    provider: "openai" (remote API) or "local" (in-process SentenceTransformer).
+    """
+    return get_embeddings([text], model=model, provider=provider)[0]
+
+def get_embeddings(texts, model="text-embedding-3-small", provider="openai", max_batch_size=512):
+    """
+    Bulk embedding: sends up to `max_batch_size` texts per request.
+    Returns one vector per input text ([] for texts that failed).
     """
+    if provider in LOCAL_EMBEDDING_PROVIDERS:
+        return _get_local_embeddings(texts, model)
+
     if provider != "openai":
-        print("Warning: Only OpenAI embeddings are currently supported.")
-        return []
+        print(f"Warning: Unknown embedding provider {provider} (expected 'openai' or 'local').")
+        return [[] for _ in texts]
 
     if not openai_client:
-        return []
-        
-    text = text.replace("\n", " ")
+        return [[] for _ in texts]
+
+    results = []
+    for start in range(0, len(texts), max_batch_size):
+        batch = [t.replace("\n", " ") for t in texts[start:start + max_batch_size]]
+        try:
+            with span("embedding", "network", model=model, provider=provider, batch_size=len(batch)):
+                response = openai_client.embeddings.create(input=batch, model=model)
+            ordered = sorted(response.data, key=lambda d: d.index)
+            results.extend(d.embedding for d in ordered)
+        except Exception as e:
+            print(f"Error in get_embeddings: {e}")
+            results.extend([] for _ in batch)
+    return results
+
+
+LOCAL_EMBEDDING_PROVIDERS = ("local", "sentence-transformers")
+DEFAULT_LOCAL_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+_LOCAL_MODELS = {}
+_LOCAL_MODELS_LOCK = threading.Lock()
+
+def _get_local_embeddings(texts, model, batch_size=64):
+    """
+    Embeds texts in-process with a SentenceTransformer, loaded once per model.
+    OpenAI model names (e.g. the "text-embedding-3-small" default) fall back
+    to all-MiniLM-L6-v2, the encoder already used by IGRC and the evaluator.
+    """
+    if not model or model.startswith("text-embedding-"):
+        model = DEFAULT_LOCAL_EMBEDDING_MODEL
+
+    with _LOCAL_MODELS_LOCK:
+        if model not in _LOCAL_MODELS:
+            from src.utils.onnx_backend import load_sim_model
+            print(f"Loading local embedding model {model}...")
+            _LOCAL_MODELS[model] = load_sim_model(model, device="cpu")
+        encoder = _LOCAL_MODELS[model]
+
+    # Encoding runs outside the lock, so concurrent callers are not serialized.
     try:
-        return openai_client.embeddings.create(input=[text], model=model).data[0].embedding
+        with span("embedding", "cpu", model=model, provider="local", batch_size=len(texts)):
+            vectors = encoder.encode(list(texts), batch_size=batch_size, convert_to_numpy=True)
+        return [v.tolist() for v in vectors]
     except Exception as e:
-        print(f"Error in get_embedding: {e}")
-        return []
+        print(f"Error in local get_embeddings: {e}")
+        return [[] for _ in texts]
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent single-text embedding requests into bulk calls.
+
+    submit() returns a concurrent.futures.Future immediately; a background
+    thread sends whatever has queued up once `max_batch_size` texts are
+    waiting or `max_wait` seconds have passed since the first one arrived.
+    submit_many() queues several texts as one unit, so they share a request.
+    """
+
+    def __init__(self, model="text-embedding-3-small", provider="openai", max_batch_size=64, max_wait=0.05):
+        self.model = model
+        self.provider = provider
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        return self.submit_many([text])[0]
+
+    def submit_many(self, texts):
+        futures = [Future() for _ in texts]
+        self._queue.put(list(zip(texts, futures)))
+        return futures
+
+    def embed(self, text):
+        return self.submit(text).result()
+
+    def _worker(self):
+        while True:
+            pending = list(self._queue.get())
+            deadline = time.monotonic() + self.max_wait
+            while len(pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.extend(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                vectors = get_embeddings([t for t, _ in pending], model=self.model, provider=self.provider)
+                for (_, future), vector in zip(pending, vectors):
+                    future.set_result(vector)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+
+
+_BATCHERS = {}
+_BATCHERS_LOCK = threading.Lock()
+
+def get_embedding_batcher(model="text-embedding-3-small", provider="openai"):
+    """Process-wide batcher per (provider, model), so all callers share batches."""
+    with _BATCHERS_LOCK:
+        key = (provider, model)
+        if key not in _BATCHERS:
+            _BATCHERS[key] = EmbeddingBatcher(model=model, provider=provider)
+        return _BATCHERS[key]
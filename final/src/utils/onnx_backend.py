@@ -0,0 +1,302 @@
+"""
+Optional ONNX Runtime backend for the CPU encoders used in evaluation and IGRC.
+
+The MiniLM sentence encoder and the DeBERTa NLI cross-encoder are exported to
+ONNX once, dynamically quantized to int8 and cached on disk. The int8 model is
+checked against the PyTorch model the first time it is produced and is only
+used if it stays within tolerance; otherwise the fp32 export is loaded. The wrappers below
+expose the small subset of the SentenceTransformer / CrossEncoder API the
+project uses (`encode` and `predict`) so they can be swapped in by config.
+"""
+import os
+import json
+import argparse
+import numpy as np
+
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+except ImportError:
+    ort = None
+
+try:
+    import torch
+    from transformers import AutoTokenizer, AutoModel, AutoModelForSequenceClassification
+except ImportError:
+    torch = None
+
+
+ONNX_CACHE_DIR = os.getenv("ONNX_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "persona-drift-onnx"))
+INPUT_NAMES = ("input_ids", "attention_mask", "token_type_ids")
+
+VALIDATION_TEXTS = [
+    "You are Sherlock Holmes. You are a brilliant detective living at 221B Baker Street.",
+    "Elementary, my dear Watson. The mud on your boots tells me you came from the south.",
+    "As an AI language model, I don't have personal experiences.",
+    "I have never been to London and I dislike solving mysteries.",
+]
+MIN_EMBEDDING_COSINE = 0.98
+NLI_LOGIT_ATOL = 0.5
+
+
+def _hf_name(model_name):
+    """SentenceTransformer shorthand ('all-MiniLM-L6-v2') -> Hugging Face hub id."""
+    return model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+
+
+def _require_deps():
+    if ort is None:
+        raise ImportError(
+            "onnxruntime is required for the ONNX backend. "
+            "Install it with `pip install onnxruntime`."
+        )
+    if torch is None:
+        raise ImportError("torch and transformers are required to export models to ONNX.")
+
+
+def export_model(model_name, task, cache_dir=ONNX_CACHE_DIR, quantize=True):
+    """
+    Exports `model_name` to ONNX (and an int8 dynamically quantized copy).
+    task: "feature-extraction" (sentence encoder) or "sequence-classification" (NLI).
+    Returns the path of the model file to load. Existing exports are reused.
+
+    The int8 copy is validated against PyTorch once and the report is cached
+    next to it; if it failed, the fp32 model is returned instead.
+    """
+    _require_deps()
+    hf_name = _hf_name(model_name) if task == "feature-extraction" else model_name
+    out_dir = os.path.join(cache_dir, hf_name.replace("/", "__"))
+    fp32_path = os.path.join(out_dir, "model.onnx")
+    int8_path = os.path.join(out_dir, "model.int8.onnx")
+    report_path = os.path.join(out_dir, "model.int8.validation.json")
+
+    os.makedirs(out_dir, exist_ok=True)
+    if not os.path.exists(fp32_path):
+        print(f"Exporting {hf_name} to ONNX...")
+        tokenizer = AutoTokenizer.from_pretrained(hf_name)
+        model_cls = AutoModel if task == "feature-extraction" else AutoModelForSequenceClassification
+        model = model_cls.from_pretrained(hf_name)
+        model.config.return_dict = False
+        model.eval()
+
+        encoded = tokenizer(VALIDATION_TEXTS[:2], padding=True, return_tensors="pt")
+        input_names = [n for n in INPUT_NAMES if n in encoded]
+        output_name = "last_hidden_state" if task == "feature-extraction" else "logits"
+        dynamic_axes = {n: {0: "batch", 1: "sequence"} for n in input_names}
+        dynamic_axes[output_name] = {0: "batch"}
+
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                tuple(encoded[n] for n in input_names),
+                fp32_path,
+                input_names=input_names,
+                output_names=[output_name],
+                dynamic_axes=dynamic_axes,
+                opset_version=14,
+            )
+        tokenizer.save_pretrained(out_dir)
+
+    if not quantize:
+        return fp32_path
+
+    if os.path.exists(report_path):
+        with open(report_path, 'r') as f:
+            report = json.load(f)
+    else:
+        if not os.path.exists(int8_path):
+            print(f"Quantizing {hf_name} to int8...")
+            quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+        report = validate_quantized(hf_name, task, int8_path)
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if report["passed"]:
+        return int8_path
+    print(f"  [ONNX] int8 {hf_name} failed validation against PyTorch ({report}); using the fp32 model.")
+    return fp32_path
+
+
+def _mean_pool(hidden, attention_mask):
+    """Mean pooling over non-padding tokens followed by L2 normalisation."""
+    mask = attention_mask[..., None].astype(np.float32)
+    pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+
+def validate_quantized(hf_name, task, int8_path, min_cosine=MIN_EMBEDDING_COSINE, logit_atol=NLI_LOGIT_ATOL):
+    """
+    Compares the raw outputs of the int8 ONNX model with the PyTorch model on
+    VALIDATION_TEXTS. Returns a report dict whose "passed" key says whether the
+    quantized model may be used.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(os.path.dirname(int8_path))
+    model_cls = AutoModel if task == "feature-extraction" else AutoModelForSequenceClassification
+    model = model_cls.from_pretrained(hf_name)
+    model.eval()
+
+    if task == "feature-extraction":
+        encoded = tokenizer(VALIDATION_TEXTS, padding=True, return_tensors="np")
+    else:
+        encoded = tokenizer([VALIDATION_TEXTS[0]] * (len(VALIDATION_TEXTS) - 1), VALIDATION_TEXTS[1:],
+                            padding=True, return_tensors="np")
+    session = _make_session(int8_path)
+    feeds = {k: v.astype(np.int64) for k, v in encoded.items() if k in {i.name for i in session.get_inputs()}}
+
+    with torch.no_grad():
+        ref = model(**{k: torch.from_numpy(v) for k, v in feeds.items()}, return_dict=False)[0].numpy()
+    out = session.run(None, feeds)[0]
+
+    if task == "feature-extraction":
+        cosines = (_mean_pool(ref, encoded["attention_mask"]) * _mean_pool(out, encoded["attention_mask"])).sum(axis=1)
+        report = {"min_embedding_cosine": float(cosines.min())}
+        report["passed"] = report["min_embedding_cosine"] >= min_cosine
+    else:
+        report = {
+            "max_logit_abs_diff": float(np.abs(ref - out).max()),
+            "label_agreement": float((ref.argmax(axis=1) == out.argmax(axis=1)).mean()),
+        }
+        report["passed"] = report["max_logit_abs_diff"] <= logit_atol and report["label_agreement"] == 1.0
+    return report
+
+
+def _make_session(model_path, num_threads=None):
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+class OnnxSentenceEncoder:
+    """Drop-in for SentenceTransformer.encode (mean pooling + L2 normalisation)."""
+
+    def __init__(self, model_name="all-MiniLM-L6-v2", quantize=True, max_length=256, num_threads=None):
+        model_path = export_model(model_name, "feature-extraction", quantize=quantize)
+        self.tokenizer = AutoTokenizer.from_pretrained(os.path.dirname(model_path))
+        self.session = _make_session(model_path, num_threads)
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.max_length = max_length
+
+    def encode(self, sentences, batch_size=32, convert_to_tensor=False, convert_to_numpy=True, **kwargs):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            encoded = self.tokenizer(
+                sentences[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np",
+            )
+            feeds = {k: v.astype(np.int64) for k, v in encoded.items() if k in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+            batches.append(_mean_pool(hidden, encoded["attention_mask"]))
+
+        embeddings = np.concatenate(batches, axis=0) if batches else np.zeros((0, 0), dtype=np.float32)
+        if single:
+            embeddings = embeddings[0]
+        if convert_to_tensor:
+            return torch.from_numpy(embeddings)
+        return embeddings
+
+
+class OnnxCrossEncoder:
+    """Drop-in for CrossEncoder.predict on multi-label (NLI) heads: returns raw logits."""
+
+    def __init__(self, model_name="cross-encoder/nli-deberta-v3-base", quantize=True, max_length=512, num_threads=None):
+        model_path = export_model(model_name, "sequence-classification", quantize=quantize)
+        self.tokenizer = AutoTokenizer.from_pretrained(os.path.dirname(model_path))
+        self.session = _make_session(model_path, num_threads)
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.max_length = max_length
+
+    def predict(self, sentence_pairs, batch_size=32, **kwargs):
+        single = isinstance(sentence_pairs[0], str)
+        if single:
+            sentence_pairs = [sentence_pairs]
+
+        batches = []
+        for start in range(0, len(sentence_pairs), batch_size):
+            chunk = sentence_pairs[start:start + batch_size]
+            encoded = self.tokenizer(
+                [p[0] for p in chunk],
+                [p[1] for p in chunk],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np",
+            )
+            feeds = {k: v.astype(np.int64) for k, v in encoded.items() if k in self.input_names}
+            batches.append(self.session.run(None, feeds)[0])
+
+        logits = np.concatenate(batches, axis=0)
+        return logits[0] if single else logits
+
+
+def load_sim_model(model_name="all-MiniLM-L6-v2", device="cpu", backend="torch", num_threads=None):
+    """`num_threads` caps the ONNX session's intra-op threads; torch threads are set per process."""
+    if backend == "onnx":
+        return OnnxSentenceEncoder(model_name, num_threads=num_threads)
+    if backend != "torch":
+        raise ValueError(f"Unknown inference backend '{backend}' (expected 'torch' or 'onnx').")
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name, device=device)
+
+
+def load_nli_model(model_name="cross-encoder/nli-deberta-v3-base", device="cpu", backend="torch", num_threads=None):
+    if backend == "onnx":
+        return OnnxCrossEncoder(model_name, num_threads=num_threads)
+    if backend != "torch":
+        raise ValueError(f"Unknown inference backend '{backend}' (expected 'torch' or 'onnx').")
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(model_name, device=device)
+
+
+def validate_backend(sim_model_name="all-MiniLM-L6-v2", nli_model_name="cross-encoder/nli-deberta-v3-base",
+                     texts=None, min_cosine=MIN_EMBEDDING_COSINE, logit_atol=NLI_LOGIT_ATOL):
+    """
+    Compares the quantized ONNX models against the PyTorch reference.
+
+    Passes when every ONNX embedding has cosine >= `min_cosine` with its
+    PyTorch counterpart, NLI logits agree within `logit_atol`, and every NLI
+    argmax label matches. Returns a report dict; raises ValueError on failure.
+    """
+    texts = texts or VALIDATION_TEXTS
+    pairs = [(texts[0], t) for t in texts[1:]]
+
+    ref_emb = load_sim_model(sim_model_name, backend="torch").encode(texts, convert_to_numpy=True)
+    onnx_emb = load_sim_model(sim_model_name, backend="onnx").encode(texts)
+    ref_emb = ref_emb / np.linalg.norm(ref_emb, axis=1, keepdims=True)
+    cosines = (ref_emb * onnx_emb).sum(axis=1)
+
+    ref_logits = np.asarray(load_nli_model(nli_model_name, backend="torch").predict(pairs))
+    onnx_logits = load_nli_model(nli_model_name, backend="onnx").predict(pairs)
+
+    report = {
+        "min_embedding_cosine": float(cosines.min()),
+        "max_logit_abs_diff": float(np.abs(ref_logits - onnx_logits).max()),
+        "label_agreement": float((ref_logits.argmax(axis=1) == onnx_logits.argmax(axis=1)).mean()),
+    }
+    report["passed"] = (
+        report["min_embedding_cosine"] >= min_cosine
+        and report["max_logit_abs_diff"] <= logit_atol
+        and report["label_agreement"] == 1.0
+    )
+    if not report["passed"]:
+        raise ValueError(f"ONNX backend failed validation against PyTorch: {report}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export, quantize and validate the ONNX encoders")
+    parser.add_argument("--sim_model", type=str, default="all-MiniLM-L6-v2")
+    parser.add_argument("--nli_model", type=str, default="cross-encoder/nli-deberta-v3-base")
+    parser.add_argument("--min_cosine", type=float, default=MIN_EMBEDDING_COSINE)
+    parser.add_argument("--logit_atol", type=float, default=NLI_LOGIT_ATOL)
+    args = parser.parse_args()
+
+    print(validate_backend(args.sim_model, args.nli_model, min_cosine=args.min_cosine, logit_atol=args.logit_atol))
@@ -0,0 +1,270 @@
+"""
+Low-overhead sampling profiler for long generation and evaluation runs.
+
+A daemon thread samples every other thread's stack with
+sys._current_frames() at `hz` samples per second. Each sample is tagged with
+a named stage: the innermost frame matching STAGE_RULES (deepcopy in the
+turn loop, llama_v2_prompt, word_tokenize in the judges, encoder forward
+passes).
+
+Every `flush_every` seconds (and on stop) the profile is rewritten to
+    <path>.collapsed          collapsed stacks (flamegraph.pl / speedscope / inferno)
+    <path>.speedscope.json    speedscope "sampled" profile
+so a multi-hour run can be inspected while it is still going.
+
+Profiling starts via start(path), the PROFILE_FILE environment variable,
+or SIGUSR1 once install_signal_handler(path) has been called; a second SIGUSR1
+stops it and writes the final profile. The signal handler only wakes a control
+thread, which does the starting, stopping and file writing. Worker processes
+call resume_in_worker() and write to `<path>.<pid>.*`.
+"""
+import atexit
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+
+DEFAULT_HZ = 100
+DEFAULT_FLUSH_EVERY = 60.0
+
+# (function name, filename substring or None, stage). The innermost matching frame wins.
+STAGE_RULES = [
+    ("deepcopy", "copy.py", "deepcopy"),
+    ("llama_v2_prompt", None, "llama_v2_prompt"),
+    ("word_tokenize", None, "word_tokenize"),
+    ("sent_tokenize", None, "word_tokenize"),
+    ("forward", "torch", "encoder_forward"),
+    ("run", "onnxruntime", "encoder_forward"),
+    ("encode", "sentence_transformers", "encoder_forward"),
+    ("predict", "sentence_transformers", "encoder_forward"),
+    ("encode", "onnx_backend", "encoder_forward"),
+    ("predict", "onnx_backend", "encoder_forward"),
+    ("urlopen", None, "network"),
+    ("_request", "httpx", "network"),
+    # C-level sleeps have no frame of their own, so poll waits land on the caller.
+    ("generate_with_replicate", None, "replicate_wait"),
+    ("replicate_generate", None, "replicate_wait"),
+    ("wait", "threading.py", "idle"),
+    ("_wait_for_tstate_lock", "threading.py", "idle"),
+]
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+_classified = {}
+
+
+def _classify(codes):
+    name = _classified.get(codes)
+    if name is None:
+        name = next(
+            (
+                rule_stage
+                for code in reversed(codes)
+                for func, file_part, rule_stage in STAGE_RULES
+                if code.co_name == func and (file_part is None or file_part in code.co_filename)
+            ),
+            "other",
+        )
+        _classified[codes] = name
+    return name
+
+
+class SamplingProfiler:
+    def __init__(self, path, hz=DEFAULT_HZ, flush_every=DEFAULT_FLUSH_EVERY):
+        self.path = path
+        self.interval = 1.0 / hz
+        self.flush_every = flush_every
+        self.counts = Counter()
+        self.stage_counts = Counter()
+        self.samples = 0
+        self.started = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._loop, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        print(f"[profiler] Sampling at {1 / self.interval:.0f} Hz -> {self.path}.collapsed")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+        print(f"[profiler] {self.samples} samples written to {self.path}.collapsed / .speedscope.json")
+        print(self.stage_report())
+
+    def _loop(self):
+        own = threading.get_ident()
+        names = {}
+        last_flush = time.monotonic()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            with self._lock:
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    codes = []
+                    while frame is not None:
+                        codes.append(frame.f_code)
+                        frame = frame.f_back
+                    codes = tuple(reversed(codes))
+                    stage_name = _classify(codes)
+                    self.counts[(stage_name, names.get(ident, "thread"), codes)] += 1
+                    self.stage_counts[stage_name] += 1
+                self.samples += 1
+            if time.monotonic() - last_flush >= self.flush_every:
+                self.write()
+                last_flush = time.monotonic()
+
+    def _stacks(self):
+        with self._lock:
+            items = list(self.counts.items())
+        for (stage_name, thread_name, codes), count in items:
+            yield [f"[{stage_name}]", f"[{thread_name}]"] + [_frame_label(c) for c in codes], count
+
+    def write(self):
+        stacks = list(self._stacks())
+        tmp = f"{self.path}.collapsed.tmp"
+        with open(tmp, "w") as f:
+            for frames, count in stacks:
+                f.write(";".join(frames) + f" {count}\n")
+        os.replace(tmp, f"{self.path}.collapsed")
+
+        frame_index = {}
+        shared_frames, samples, weights = [], [], []
+        for frames, count in stacks:
+            indices = []
+            for label in frames:
+                if label not in frame_index:
+                    frame_index[label] = len(shared_frames)
+                    shared_frames.append({"name": label})
+                indices.append(frame_index[label])
+            samples.append(indices)
+            weights.append(count * self.interval)
+        speedscope = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "exporter": "persona-drift sampling profiler",
+            "name": os.path.basename(self.path),
+            "shared": {"frames": shared_frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": f"pid {os.getpid()}",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+        tmp = f"{self.path}.speedscope.json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(speedscope, f)
+        os.replace(tmp, f"{self.path}.speedscope.json")
+
+    def stage_report(self):
+        total = sum(self.stage_counts.values()) or 1
+        lines = ["[profiler] Thread samples by stage:"]
+        for name, count in self.stage_counts.most_common():
+            lines.append(f"  {name:<18}{count * self.interval:>10.1f}s  {count / total:>6.1%}")
+        return "\n".join(lines)
+
+
+_ACTIVE = None
+_ENV_KEYS = ("PROFILE_FILE", "PROFILE_HZ", "PROFILE_OWNER_PID")
+_saved_env = None
+
+
+def start(path, hz=DEFAULT_HZ, flush_every=DEFAULT_FLUSH_EVERY):
+    """Starts the process-wide profiler (no-op if already running)."""
+    global _ACTIVE, _saved_env
+    if _ACTIVE is None:
+        # Exported so worker processes can profile themselves (see resume_in_worker);
+        # stop() restores the previous values so later workers do not.
+        _saved_env = {key: os.environ.get(key) for key in _ENV_KEYS}
+        os.environ["PROFILE_FILE"] = path
+        os.environ["PROFILE_HZ"] = str(hz)
+        os.environ.setdefault("PROFILE_OWNER_PID", str(os.getpid()))
+        _ACTIVE = SamplingProfiler(path, hz=hz, flush_every=flush_every).start()
+    return _ACTIVE
+
+
+def stop():
+    global _ACTIVE, _saved_env
+    if _ACTIVE is not None:
+        _ACTIVE.stop()
+        _ACTIVE = None
+    if _saved_env is not None:
+        for key, value in _saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        _saved_env = None
+
+
+atexit.register(stop)
+
+
+def start_from_env():
+    path = os.getenv("PROFILE_FILE")
+    if path:
+        start(path, hz=float(os.getenv("PROFILE_HZ", DEFAULT_HZ)))
+
+
+def resume_in_worker():
+    """Starts a per-process profiler in a pool worker if the parent is profiling."""
+    global _ACTIVE
+    path = os.getenv("PROFILE_FILE")
+    if not path or str(os.getpid()) == os.getenv("PROFILE_OWNER_PID"):
+        return
+    if _ACTIVE is not None and _ACTIVE._thread is not None and not _ACTIVE._thread.is_alive():
+        _ACTIVE = None  # sampler thread did not survive fork
+    start(f"{path}.{os.getpid()}", hz=float(os.getenv("PROFILE_HZ", DEFAULT_HZ)))
+
+
+_toggle_requested = threading.Event()
+_control_pid = None
+
+
+def install_signal_handler(path, hz=DEFAULT_HZ, signum=None):
+    """
+    SIGUSR1 toggles profiling of the running process on and off.
+
+    The handler only sets an event; a control thread performs the toggle, so
+    no thread joins, file writes or prints run inside the signal handler.
+    """
+    global _control_pid
+    signum = signum or getattr(signal, "SIGUSR1", None)
+    if signum is None:
+        return
+
+    def control():
+        while True:
+            _toggle_requested.wait()
+            _toggle_requested.clear()
+            if _ACTIVE is None:
+                start(path, hz=hz)
+            else:
+                stop()
+
+    # Threads do not survive fork, so each process starts its own control thread.
+    if _control_pid != os.getpid():
+        _toggle_requested.clear()
+        threading.Thread(target=control, name="profiler-control", daemon=True).start()
+        _control_pid = os.getpid()
+    signal.signal(signum, lambda _signum, _frame: _toggle_requested.set())
@@ -0,0 +1,72 @@
+"""
+Helpers for provider-side prompt (prefix) caching.
+
+Providers cache the longest previously seen prefix of a request, so every
+turn of a conversation can reuse the system prompt and the earlier history
+as long as those messages are re-sent byte-for-byte and in the same order.
+
+- prompt_cache_key(): a routing hint derived from the model and the leading
+  system message. OpenAI uses it (`prompt_cache_key`) to send requests that
+  share a prefix to the same cache. supports_prompt_cache_key() tells whether
+  an endpoint is OpenAI's own API; compatible servers may reject the field.
+- PrefixTracker: remembers the previous request per conversation and
+  estimates how many prompt tokens it shares with the next one. This is how many tokens a
+  prefix cache could serve. It is the only signal for providers that do not
+  report cached tokens (Replicate).
+"""
+import hashlib
+import threading
+from urllib.parse import urlparse
+
+from .context_budget import DEFAULT_ENCODING, message_tokens
+
+OPENAI_API_HOST = "api.openai.com"
+
+
+def prompt_cache_key(messages, model):
+    """Stable key for requests that start with the same system message."""
+    head = messages[0]['content'] if messages and messages[0]['role'] == 'system' else ""
+    return hashlib.sha256(f"{model}\x00{head}".encode("utf-8")).hexdigest()[:32]
+
+
+def supports_prompt_cache_key(base_url):
+    """True for OpenAI's own API (base_url None means the client default)."""
+    return base_url is None or urlparse(str(base_url)).hostname == OPENAI_API_HOST
+
+
+class PrefixTracker:
+    def __init__(self, max_keys=4096):
+        self.max_keys = max_keys
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def shared_prefix_tokens(self, key, messages, model=DEFAULT_ENCODING):
+        """
+        Tokens in the leading messages that are identical to the previous
+        request under `key`, then records `messages` as the new previous one.
+        """
+        current = [(m['role'], m['content']) for m in messages]
+        with self._lock:
+            previous = self._last.pop(key, [])
+            if len(self._last) >= self.max_keys:
+                self._last.pop(next(iter(self._last)))
+            self._last[key] = current
+        shared = 0
+        for msg, (prev, cur) in zip(messages, zip(previous, current)):
+            if prev != cur:
+                break
+            shared += message_tokens(msg, model)
+        return shared
+
+
+_TRACKER = PrefixTracker()
+
+
+def shared_prefix_tokens(messages, model, conversation_id=None):
+    """
+    Process-wide PrefixTracker keyed by conversation. Without a
+    `conversation_id` it falls back to prompt_cache_key(), which is only
+    accurate when one conversation per system prompt is in flight.
+    """
+    key = (model, conversation_id) if conversation_id is not None else prompt_cache_key(messages, model)
+    return _TRACKER.shared_prefix_tokens(key, messages, model)
@@ -0,0 +1,317 @@
+"""
+Client-side throttling shared by the sync and async completion paths:
+a per-(provider, model) adaptive AIMD limiter that reacts to 429s and
+Retry-After, and a retry loop (call_with_limiter / call_with_limiter_async)
+with jittered exponential backoff for transient provider errors.
+
+Setting RATE_LIMIT_DIR shares each adaptive limiter's state through a
+locked file in that directory, so every process on the host paces
+against the same (provider, model) limit. RATE_LIMIT_DISABLE=1 turns pacing
+off entirely (retries still apply), as does a rate of 0 for a provider or model.
+"""
+import asyncio
+import email.utils
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; limiters stay per-process
+    fcntl = None
+
+from .tracing import span
+
+
+# Starting requests per second; overridable per provider ("openai") or per model
+# ("openai:gpt-4o"), where 0 or None disables limiting.
+DEFAULT_RATE_LIMITS = {
+    "openai": 10.0,
+    "replicate": 5.0,
+    # Replicate allows far more status polls than prediction creates.
+    "replicate:predictions.get": 40.0,
+}
+
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
+RETRYABLE_ERROR_NAMES = {
+    "RateLimitError",
+    "URLError",
+    "RemoteDisconnected",
+    "APITimeoutError",
+    "APIConnectionError",
+    "InternalServerError",
+    "Timeout",
+    "TimeoutError",
+    "ConnectionError",
+    "ReadTimeout",
+    "ConnectTimeout",
+}
+
+
+class AdaptiveRateLimiter:
+    """
+    AIMD request pacing for one (provider, model).
+
+    Requests are spaced 1/rate seconds apart. Each success raises the rate
+    additively (by about `increase` requests/s per second of traffic), and a
+    throttling response cuts it multiplicatively by `decrease`, at most once
+    per `cooldown` seconds, so a burst of in-flight 429s counts as one signal.
+    A Retry-After value blocks every caller until it has passed. Sustained
+    throughput therefore settles just under the provider's limit.
+
+    Usable from threads and asyncio tasks. With `state_path` the state lives
+    in a file guarded by flock, so processes on one host share the limit; the
+    async paths then do the locked file I/O in a worker thread.
+
+    There is no ceiling unless `max_rate` is given: the rate keeps growing
+    until the provider actually throttles.
+    """
+
+    def __init__(self, rate, min_rate=None, max_rate=None, increase=0.1, decrease=0.5, cooldown=1.0, state_path=None):
+        self.initial_rate = float(rate)
+        self.min_rate = float(min_rate if min_rate is not None else max(rate / 20.0, 0.05))
+        self.max_rate = float(max_rate) if max_rate is not None else float("inf")
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.state_path = state_path if fcntl is not None else None
+        self._state = self._fresh_state()
+        self._lock = threading.Lock()
+        if self.state_path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+
+    def _fresh_state(self):
+        return {"rate": self.initial_rate, "next_slot": 0.0, "blocked_until": 0.0, "last_decrease": 0.0}
+
+    def _update(self, fn):
+        """Applies fn(state) under the thread lock (and the file lock if shared); returns its result."""
+        with self._lock:
+            if not self.state_path:
+                return fn(self._state)
+            with open(self.state_path, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = dict(self._fresh_state(), **json.loads(f.read() or "{}"))
+                    except ValueError:
+                        state = self._fresh_state()
+                    result = fn(state)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                    return result
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _reserve(self):
+        def reserve(state):
+            # Wall-clock time, so slots are comparable across processes.
+            now = time.time()
+            slot = max(now, state["next_slot"], state["blocked_until"])
+            state["next_slot"] = slot + 1.0 / state["rate"]
+            return slot - now
+
+        return self._update(reserve)
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = await _off_loop(self, self._reserve)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        def grow(state):
+            state["rate"] = min(self.max_rate, state["rate"] + self.increase / state["rate"])
+
+        self._update(grow)
+
+    def on_throttle(self, retry_after=None):
+        """Returns the rate after the decrease."""
+        def shrink(state):
+            now = time.time()
+            if now - state["last_decrease"] >= self.cooldown:
+                state["rate"] = max(self.min_rate, state["rate"] * self.decrease)
+                state["last_decrease"] = now
+            if retry_after:
+                state["blocked_until"] = max(state["blocked_until"], now + retry_after)
+            state["next_slot"] = max(state["next_slot"], state["blocked_until"])
+            return state["rate"]
+
+        return self._update(shrink)
+
+    @property
+    def rate(self):
+        return self._update(lambda state: state["rate"])
+
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def get_limiter(provider, model, rate_limits=None, shared_dir=None):
+    """
+    Process-wide AdaptiveRateLimiter for (provider, model), starting at the
+    configured rate and probing upwards until throttled; None if limiting is
+    disabled (RATE_LIMIT_DISABLE=1 or a rate of 0).
+    State is shared across processes when `shared_dir` or RATE_LIMIT_DIR is set.
+    """
+    if os.getenv("RATE_LIMIT_DISABLE", "").lower() in ("1", "true", "yes"):
+        return None
+    limits = dict(DEFAULT_RATE_LIMITS)
+    limits.update(rate_limits or {})
+    rate = limits.get(f"{provider}:{model}", limits.get(provider))
+    shared_dir = shared_dir or os.getenv("RATE_LIMIT_DIR")
+
+    with _LIMITERS_LOCK:
+        key = (provider, model)
+        if key not in _LIMITERS:
+            state_path = None
+            if rate and shared_dir:
+                digest = hashlib.sha256(f"{provider}:{model}".encode("utf-8")).hexdigest()[:16]
+                state_path = os.path.join(shared_dir, f"{provider}-{digest}.json")
+            _LIMITERS[key] = AdaptiveRateLimiter(rate, state_path=state_path) if rate else None
+        return _LIMITERS[key]
+
+
+def error_status(exc):
+    for attr in ("status_code", "status", "http_status", "code"):
+        status = getattr(exc, attr, None)
+        if isinstance(status, int):
+            return status
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_throttle(exc):
+    """True for provider rate limiting (HTTP 429 or a rate-limit error)."""
+    status = error_status(exc)
+    if status is not None:
+        return status == 429
+    if type(exc).__name__ == "RateLimitError":
+        return True
+    message = str(exc).lower()
+    return "rate limit" in message or "throttled" in message
+
+
+def retry_after_seconds(exc):
+    """Retry-After (seconds or HTTP date) or retry-after-ms from the error's response headers, if any."""
+    headers = getattr(exc, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        millis = headers.get("retry-after-ms")
+        if millis:
+            return max(float(millis) / 1000.0, 0.0)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def _after_failure(limiter, exc, attempt, max_retries, label):
+    """
+    Retry decision shared by call_with_limiter and call_with_limiter_async.
+    Feeds a throttle back into `limiter` and returns the seconds to sleep before
+    the next attempt, or None if `exc` should be re-raised. A throttle with a
+    limiter and a Retry-After needs no sleep, since the limiter already blocks
+    every caller until then; otherwise jittered backoff is the floor, so retries
+    are not spent at the limiter's pacing within a second.
+    """
+    throttled = is_throttle(exc)
+    retry_after = retry_after_seconds(exc)
+    rate = limiter.on_throttle(retry_after) if throttled and limiter else None
+    if not is_retryable(exc) or attempt == max_retries:
+        return None
+    if rate is not None:
+        delay = 0.0 if retry_after else backoff_delay(attempt)
+        print(f"  [{label}] Rate limited; pacing at {rate:.2f} req/s, retrying in {max(delay, retry_after or 0.0):.1f}s ({attempt + 1}/{max_retries})")
+    else:
+        delay = retry_after or backoff_delay(attempt)
+        print(f"  [{label}] Retryable error ({exc}); retrying in {delay:.1f}s ({attempt + 1}/{max_retries})")
+    return delay
+
+
+async def _off_loop(limiter, fn, *args):
+    """Runs fn in a worker thread when it would block the event loop on the limiter's shared state file."""
+    if limiter and limiter.state_path:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+def call_with_limiter(limiter, fn, max_retries=5, label="request"):
+    """
+    Calls fn() paced by `limiter` (may be None), feeding successes and throttles
+    back into it. Throttled and other retryable failures are retried up to
+    `max_retries` times; the last error is re-raised.
+    """
+    for attempt in range(max_retries + 1):
+        if limiter:
+            with span("rate_limit.wait", "wait", label=label):
+                limiter.acquire()
+        try:
+            result = fn()
+        except Exception as e:
+            delay = _after_failure(limiter, e, attempt, max_retries, label)
+            if delay is None:
+                raise
+            if delay > 0:
+                with span("retry.backoff", "wait", label=label):
+                    time.sleep(delay)
+            continue
+        if limiter:
+            limiter.on_success()
+        return result
+
+
+async def call_with_limiter_async(limiter, fn, max_retries=5, label="request"):
+    """Awaitable twin of call_with_limiter; fn() returns a coroutine."""
+    for attempt in range(max_retries + 1):
+        if limiter:
+            with span("rate_limit.wait", "wait", label=label):
+                await limiter.acquire_async()
+        try:
+            result = await fn()
+        except Exception as e:
+            delay = await _off_loop(limiter, _after_failure, limiter, e, attempt, max_retries, label)
+            if delay is None:
+                raise
+            if delay > 0:
+                with span("retry.backoff", "wait", label=label):
+                    await asyncio.sleep(delay)
+            continue
+        if limiter:
+            await _off_loop(limiter, limiter.on_success)
+        return result
+
+
+def is_retryable(exc):
+    """Rate limits, timeouts, dropped connections and 5xx responses are worth retrying."""
+    status = error_status(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    if type(exc).__name__ in RETRYABLE_ERROR_NAMES:
+        return True
+    message = str(exc).lower()
+    return "rate limit" in message or "throttled" in message or "429" in message
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Full-jitter exponential backoff: uniform(0, min(cap, base * 2**attempt))."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
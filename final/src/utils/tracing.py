@@ -0,0 +1,347 @@
+"""
+Lightweight per-stage tracing for generation, guardrail and evaluation runs.
+
+Spans are opened with `span(name, category, **attributes)` and nest through a
+context variable, so a turn span contains its prompt-build, request, poll and
+checkpoint spans. Tracing is off unless `configure()` is called or
+TRACE_FILE is set; a disabled span costs one attribute check.
+
+Two export formats are supported:
+- "jsonl": one flat JSON object per finished span.
+- "otlp":  OTLP/JSON `resourceSpans` batches, one per line (the format of the
+           OpenTelemetry collector's file exporter), loadable by OTel tooling.
+
+Worker processes write to `<stem>.<pid><suffix>` next to the main file.
+`python -m src.utils.tracing summary traces.jsonl` reports where wall-clock
+time goes per span name and per category (network / cpu / disk / wait).
+"""
+import argparse
+import atexit
+import contextvars
+import glob
+import json
+import os
+import secrets
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+
+FLUSH_EVERY = 256
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class _Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.fmt = "jsonl"
+        self.service = "persona-drift"
+        self.resource = {}
+        self._pid = None
+        self._owner_pid = None
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def configure(self, path, fmt="jsonl", service="persona-drift", **resource):
+        if fmt not in ("jsonl", "otlp"):
+            raise ValueError(f"Unknown trace format '{fmt}' (expected 'jsonl' or 'otlp')")
+        self.flush()
+        self.path = path
+        self.fmt = fmt
+        self.service = service
+        self.resource = resource
+        # Exported so spawned workers and subprocesses trace to sibling files.
+        os.environ["TRACE_FILE"] = path
+        os.environ["TRACE_FORMAT"] = fmt
+        self._owner_pid = int(os.environ.setdefault("TRACE_OWNER_PID", str(os.getpid())))
+        self._pid = None
+        self.enabled = True
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def _output_path(self):
+        if os.getpid() == self._owner_pid:
+            return self.path
+        stem, suffix = os.path.splitext(self.path)
+        return f"{stem}.{os.getpid()}{suffix}"
+
+    def record(self, finished):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked child: drop the parent's unflushed spans.
+                self._buffer = []
+                self._pid = os.getpid()
+            self._buffer.append(finished)
+            if len(self._buffer) >= FLUSH_EVERY:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._buffer or not self.path:
+            return
+        spans, self._buffer = self._buffer, []
+        if self.fmt == "jsonl":
+            payload = "".join(json.dumps(s, default=str) + "\n" for s in spans)
+        else:
+            payload = json.dumps(_to_otlp(spans, self.service, self.resource), default=str) + "\n"
+        with open(self._output_path(), "a") as f:
+            f.write(payload)
+
+
+_TRACER = _Tracer()
+atexit.register(_TRACER.flush)
+
+
+def configure(path, fmt="jsonl", service="persona-drift", **resource):
+    """Enables tracing to `path`. Extra keyword arguments become resource attributes."""
+    _TRACER.configure(path, fmt=fmt, service=service, **resource)
+
+
+def enabled():
+    return _TRACER.enabled
+
+
+def flush():
+    _TRACER.flush()
+
+
+def _configure_from_env():
+    path = os.getenv("TRACE_FILE")
+    if path:
+        configure(path, fmt=os.getenv("TRACE_FORMAT", "jsonl"))
+
+
+class Span:
+    __slots__ = ("name", "category", "attributes", "trace_id", "span_id", "parent_id", "start_ns", "status")
+
+    def __init__(self, name, category, attributes, parent):
+        self.name = name
+        self.category = category
+        self.attributes = attributes
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.start_ns = time.time_ns()
+        self.status = "ok"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+@contextmanager
+def span(name, category="other", **attributes):
+    """
+    Times the enclosed block. Attributes such as model, persona_id or turn
+    are inherited from enclosing spans, so only the outermost needs them.
+    """
+    if not _TRACER.enabled:
+        yield _NOOP
+        return
+    parent = _current_span.get()
+    inherited = dict(parent.attributes) if parent else {}
+    inherited.update(attributes)
+    current = Span(name, category, inherited, parent)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.attributes["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        end_ns = time.time_ns()
+        _TRACER.record({
+            "name": current.name,
+            "category": current.category,
+            "trace_id": current.trace_id,
+            "span_id": current.span_id,
+            "parent_id": current.parent_id,
+            "start_ns": current.start_ns,
+            "end_ns": end_ns,
+            "duration_ms": (end_ns - current.start_ns) / 1e6,
+            "status": current.status,
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+            "attributes": current.attributes,
+        })
+
+
+def set_attributes(**attributes):
+    """Adds attributes (e.g. token usage) to the innermost open span."""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def traced(name, category="other"):
+    """Decorator form of span()."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, category):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items() if v is not None]
+
+
+def _to_otlp(spans, service, resource):
+    return {"resourceSpans": [{
+        "resource": {"attributes": _otlp_attributes({"service.name": service, **resource})},
+        "scopeSpans": [{
+            "scope": {"name": "persona-drift.tracing"},
+            "spans": [{
+                "traceId": s["trace_id"],
+                "spanId": s["span_id"],
+                "parentSpanId": s["parent_id"] or "",
+                "name": s["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(s["start_ns"]),
+                "endTimeUnixNano": str(s["end_ns"]),
+                "attributes": _otlp_attributes({
+                    "category": s["category"], "pid": s["pid"], "thread": s["thread"], **s["attributes"]
+                }),
+                "status": {"code": 2 if s["status"] == "error" else 1},
+            } for s in spans],
+        }],
+    }]}
+
+
+def _from_otlp(batch):
+    for resource_spans in batch.get("resourceSpans", []):
+        for scope_spans in resource_spans.get("scopeSpans", []):
+            for s in scope_spans.get("spans", []):
+                attributes = {a["key"]: next(iter(a["value"].values())) for a in s.get("attributes", [])}
+                start, end = int(s["startTimeUnixNano"]), int(s["endTimeUnixNano"])
+                yield {
+                    "name": s["name"],
+                    "category": attributes.pop("category", "other"),
+                    "trace_id": s["traceId"],
+                    "span_id": s["spanId"],
+                    "parent_id": s.get("parentSpanId") or None,
+                    "start_ns": start,
+                    "end_ns": end,
+                    "duration_ms": (end - start) / 1e6,
+                    "status": "error" if s.get("status", {}).get("code") == 2 else "ok",
+                    "attributes": attributes,
+                }
+
+
+def load_spans(paths):
+    """Reads spans from JSONL or OTLP/JSON trace files, including per-process siblings."""
+    files = []
+    for path in paths:
+        stem, suffix = os.path.splitext(path)
+        files.extend([path] + sorted(glob.glob(f"{glob.escape(stem)}.[0-9]*{suffix}")))
+    spans = []
+    for path in dict.fromkeys(files):
+        with open(path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "resourceSpans" in record:
+                    spans.extend(_from_otlp(record))
+                else:
+                    spans.append(record)
+    return spans
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def summarize(spans):
+    """
+    Aggregates spans by name and by category using self time (duration minus
+    direct children), so nested spans are not double counted. Wall clock is
+    the union extent of root spans.
+    """
+    child_ms = defaultdict(float)
+    for s in spans:
+        if s["parent_id"]:
+            child_ms[s["parent_id"]] += s["duration_ms"]
+
+    by_name = defaultdict(lambda: {"count": 0, "errors": 0, "total_ms": 0.0, "self_ms": 0.0, "durations": []})
+    by_category = defaultdict(float)
+    for s in spans:
+        self_ms = max(0.0, s["duration_ms"] - child_ms.get(s["span_id"], 0.0))
+        entry = by_name[s["name"]]
+        entry["category"] = s.get("category", "other")
+        entry["count"] += 1
+        entry["errors"] += s["status"] == "error"
+        entry["total_ms"] += s["duration_ms"]
+        entry["self_ms"] += self_ms
+        entry["durations"].append(s["duration_ms"])
+        by_category[entry["category"]] += self_ms
+
+    roots = [s for s in spans if not s["parent_id"]]
+    wall_ms = (max(s["end_ns"] for s in roots) - min(s["start_ns"] for s in roots)) / 1e6 if roots else 0.0
+    for entry in by_name.values():
+        durations = entry.pop("durations")
+        entry["p50_ms"] = _percentile(durations, 50)
+        entry["p95_ms"] = _percentile(durations, 95)
+    return {"wall_ms": wall_ms, "spans": len(spans), "by_name": dict(by_name), "by_category": dict(by_category)}
+
+
+def format_summary(summary):
+    total_self = sum(summary["by_category"].values()) or 1.0
+    lines = [f"{summary['spans']} spans, wall clock {summary['wall_ms'] / 1000:.1f}s", "", "By category (self time):"]
+    for category, ms in sorted(summary["by_category"].items(), key=lambda kv: -kv[1]):
+        lines.append(f"  {category:<10}{ms / 1000:>10.2f}s  {ms / total_self:>6.1%}")
+    lines += ["", f"  {'span':<24}{'category':<10}{'count':>7}{'self s':>10}{'share':>8}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}"]
+    for name, e in sorted(summary["by_name"].items(), key=lambda kv: -kv[1]["self_ms"]):
+        lines.append(
+            f"  {name:<24}{e['category']:<10}{e['count']:>7}{e['self_ms'] / 1000:>10.2f}"
+            f"{e['self_ms'] / total_self:>8.1%}{e['p50_ms']:>10.1f}{e['p95_ms']:>10.1f}{e['errors']:>8}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Trace utilities")
+    sub = parser.add_subparsers(dest="command", required=True)
+    summary = sub.add_parser("summary", help="Where does wall-clock time go?")
+    summary.add_argument("paths", nargs="+")
+    summary.add_argument("--json", action="store_true", help="Print the summary as JSON.")
+    args = parser.parse_args(argv)
+
+    result = summarize(load_spans(args.paths))
+    print(json.dumps(result, indent=2) if args.json else format_summary(result))
+
+
+_configure_from_env()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ import json
 import openai
 from tqdm import tqdm
 
+from response_cache import ResponseCache
+
 openai.api_key = "OPENAI-API-KEY"
 
 PERSONAS = [
@@ -17,6 +19,9 @@ NUM_CANDIDATES = 10
 OUTPUT_DIR = "/Users/smitpatel/Desktop/personality_datasets"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Set RESPONSE_CACHE_PATH to reuse temperature-0 judgements across re-runs.
+RESPONSE_CACHE = ResponseCache(os.environ["RESPONSE_CACHE_PATH"]) if os.environ.get("RESPONSE_CACHE_PATH") else None
+
 import re
 
 def clean_text(s: str) -> str:
@@ -104,14 +109,23 @@ def select_winner(candidates, persona, history):
         Only return the index number, nothing else.
     """
 
-    response = openai.ChatCompletion.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "system", "content": "You are ranking persona alignment."},
-                  {"role": "user", "content": prompt}],
-        temperature=0
-    )
+    messages = [{"role": "system", "content": "You are ranking persona alignment."},
+                {"role": "user", "content": prompt}]
+
+    def complete():
+        response = openai.ChatCompletion.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0
+        )
+        return response.choices[0].message.content
+
+    if RESPONSE_CACHE is not None:
+        content = RESPONSE_CACHE.get_or_generate("openai", "gpt-4o-mini", messages, {"temperature": 0}, complete)
+    else:
+        content = complete()
     try:
-        idx = int(response.choices[0].message.content.strip())
+        idx = int(content.strip())
     except:
         idx = 0
     return idx
@@ -148,3 +162,6 @@ with open(os.path.join(OUTPUT_DIR, "all_personality_datasets.json"), "w") as f:
     json.dump(final_outputs, f, indent=2)
 
 print("🎉 Dataset generation complete!")
+if RESPONSE_CACHE is not None:
+    stats = RESPONSE_CACHE.stats()
+    print(f"Response cache: {stats['hits']} hits / {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)")
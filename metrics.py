@@ -31,13 +31,48 @@ except ImportError:  # pragma: no cover - torch required for GPU support
     torch = None
 
 try:
-    from bert_score import score as bert_score
+    from bert_score import BERTScorer
     BERTSCORE_AVAILABLE = True
 except ImportError:
     BERTSCORE_AVAILABLE = False
     warnings.warn("bert-score not available. BERTScore metric disabled.")
 
 
+# BERTScore models are large; keep one scorer per (lang, device) for the process lifetime.
+_BERT_SCORERS: Dict[tuple, "BERTScorer"] = {}
+
+
+def _get_bert_scorer(lang: str, device: str, batch_size: int) -> "BERTScorer":
+    key = (lang, device)
+    if key not in _BERT_SCORERS:
+        _BERT_SCORERS[key] = BERTScorer(lang=lang, device=device, batch_size=batch_size)
+    scorer = _BERT_SCORERS[key]
+    scorer.batch_size = batch_size
+    return scorer
+
+
+def _truncate_words(text: str, max_words: Optional[int], policy: str) -> str:
+    """
+    Truncate text to at most max_words whitespace tokens.
+
+    policy: "head" keeps the beginning, "tail" keeps the end, and
+    "head_tail" keeps half of the budget from each end.
+    """
+    if not max_words:
+        return text
+    words = text.split()
+    if len(words) <= max_words:
+        return text
+    if policy == "head":
+        return " ".join(words[:max_words])
+    if policy == "tail":
+        return " ".join(words[-max_words:])
+    if policy == "head_tail":
+        head = max_words // 2
+        return " ".join(words[:head] + words[len(words) - (max_words - head):])
+    raise ValueError(f"Unknown truncation policy: {policy}")
+
+
 class PersonaDriftMetrics:
     """Computes persona drift metrics for conversation analysis."""
     
@@ -180,13 +215,30 @@ class PersonaDriftMetrics:
             warnings.warn(f"Error computing drift index: {e}")
             return [0.0] * len(responses)
     
-    def conversation_quality(self, responses: List[str], references: Optional[List[str]] = None) -> List[float]:
+    def conversation_quality(
+        self,
+        responses: List[str],
+        references: Optional[List[str]] = None,
+        window_size: int = 32,
+        batch_size: int = 16,
+        max_words: Optional[int] = None,
+        truncation: str = "head",
+    ) -> List[float]:
         """
         Compute conversation quality using BERTScore.
         
+        Pairs are sorted by length and scored in windows of `window_size`, so
+        padding stays close to each window's own longest pair and only one
+        window's contextual embeddings are held at a time. The BERTScore model
+        is loaded once per process and reused across calls.
+        
         Args:
             responses: Generated responses
             references: Reference responses (if None, uses previous response as reference)
+            window_size: Number of (response, reference) pairs scored per pass
+            batch_size: BERTScore model batch size within a window
+            max_words: Truncate each text to this many words (None disables)
+            truncation: "head", "tail" or "head_tail" (see _truncate_words)
         
         Returns:
             List of BERTScore F1 scores
@@ -203,6 +255,9 @@ class PersonaDriftMetrics:
             if references is None:
                 references = [responses[0]] + responses[:-1]
             
+            cands = [_truncate_words(r, max_words, truncation) for r in responses]
+            refs = [_truncate_words(r, max_words, truncation) for r in references]
+            
             # Compute BERTScore
             if not self.use_gpu or torch is None:
                 device = "cpu"
@@ -210,15 +265,22 @@ class PersonaDriftMetrics:
                 device = "cuda"
             else:
                 device = "cpu"
-            P, R, F1 = bert_score(
-                responses,
-                references,
-                lang='en',
-                verbose=False,
-                device=device
-            )
+            scorer = _get_bert_scorer('en', device, batch_size)
+            
+            order = sorted(range(len(cands)), key=lambda i: max(len(cands[i]), len(refs[i])))
+            f1_scores = [0.0] * len(cands)
+            for start in range(0, len(order), max(window_size, 1)):
+                window = order[start:start + window_size]
+                _, _, F1 = scorer.score(
+                    [cands[i] for i in window],
+                    [refs[i] for i in window],
+                    verbose=False,
+                    batch_size=batch_size,
+                )
+                for i, f1 in zip(window, F1.tolist()):
+                    f1_scores[i] = f1
             
-            return F1.tolist()
+            return f1_scores
         except Exception as e:
             warnings.warn(f"Error computing BERTScore: {e}")
             return [0.0] * len(responses)
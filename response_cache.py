@@ -0,0 +1,140 @@
+"""
+Opt-in on-disk cache for deterministic (temperature 0) generations.
+
+Responses are keyed by a SHA-256 of the canonical JSON of
+(provider, model, rendered prompt or messages, decoding params) and stored in
+a local SQLite file. Entries expire after `ttl_sec`; when the stored text
+exceeds `max_bytes`, least-recently-used entries are evicted. Only requests
+for which `is_deterministic(params)` holds should be routed through the cache.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+DEFAULT_CACHE_PATH = Path(os.environ.get("RESPONSE_CACHE_PATH", ".cache/responses.sqlite"))
+DEFAULT_TTL_SEC = 30 * 24 * 3600
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+EVICT_CHECK_EVERY = 64
+
+
+def is_deterministic(params: Dict[str, Any]) -> bool:
+    return float(params.get("temperature", 1.0)) == 0.0
+
+
+def cache_key(provider: str, model: str, prompt: Any, params: Dict[str, Any]) -> str:
+    payload = json.dumps(
+        {"provider": provider, "model": model, "prompt": prompt, "params": params},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        path: Path | str = DEFAULT_CACHE_PATH,
+        ttl_sec: Optional[float] = DEFAULT_TTL_SEC,
+        max_bytes: Optional[int] = DEFAULT_MAX_BYTES,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl_sec = ttl_sec
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_sec is not None and now - row[1] > self.ttl_sec:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response.encode("utf-8")), now, now),
+            )
+            self._conn.commit()
+            self._puts += 1
+            if self._puts % EVICT_CHECK_EVERY == 0:
+                self._evict_locked()
+
+    def _evict_locked(self) -> None:
+        if self.ttl_sec is not None:
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_sec,))
+        if self.max_bytes is not None:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # Evict least-recently-used entries down to 90% of the limit.
+                excess = total - int(self.max_bytes * 0.9)
+                rows = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall()
+                doomed = []
+                for key, size in rows:
+                    if excess <= 0:
+                        break
+                    doomed.append((key,))
+                    excess -= size
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+        self._conn.commit()
+
+    def get_or_generate(
+        self,
+        provider: str,
+        model: str,
+        prompt: Any,
+        params: Dict[str, Any],
+        generate: Callable[[], str],
+    ) -> str:
+        key = cache_key(provider, model, prompt, params)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        response = generate()
+        self.put(key, response)
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "path": str(self.path),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
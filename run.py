@@ -1,7 +1,6 @@
 import os
 
 import argparse
-import copy
 import importlib
 import importlib.util
 import json
@@ -16,10 +15,18 @@ from urllib import request as urllib_request
 from urllib.error import HTTPError, URLError
 
 from utils import *
+from conversation_tree import ConversationTree, generation_tag
+from final.src.utils import profiler, rate_limit, tracing
+from final.src.utils.prompt_cache import prompt_cache_key, supports_prompt_cache_key
+from final.src.utils.tracing import span
 
 SELFCHAT_DIR = Path(os.environ.get("SELFCHAT_DIR", "selfchat"))
 SELFCHAT_DIR.mkdir(parents=True, exist_ok=True)
 
+# Point at a local stub (see stub_llm.py) for offline benchmarking.
+REPLICATE_BASE_URL = os.environ.get("REPLICATE_BASE_URL", "https://api.replicate.com").rstrip("/")
+REPLICATE_POLL_INTERVAL = float(os.environ.get("REPLICATE_POLL_INTERVAL", "1.5"))
+
 _full_dataset_available = all(
     importlib.util.find_spec(module_name) is not None
     for module_name in ("nltk", "langdetect", "requests")
@@ -69,8 +76,27 @@ def main(argv: Optional[List[str]] = None):
     parser.add_argument('--seed', type=int, default=42)
     parser.add_argument('--turns', type=int, default=16)
     parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--conversation_tree', type=str, default=None,
+                        help='SQLite prefix tree (e.g. selfchat/conversation_tree.sqlite) used to reuse previously '
+                             'generated turns and probe answers; off by default, so every turn is sampled fresh.')
+    parser.add_argument('--fork_after', type=int, default=0,
+                        help='With --conversation_tree, share the first N turns across seeds; later turns are sampled per seed.')
+    parser.add_argument('--prompt_cache_key', type=str, default='auto', choices=['auto', 'on', 'off'],
+                        help="Send OpenAI's prompt_cache_key routing hint; 'auto' only for api.openai.com, since "
+                             "OpenAI-compatible servers may reject unknown fields.")
+    parser.add_argument('--trace_file', type=str, default=None, help='Write per-stage spans to this file.')
+    parser.add_argument('--trace_format', type=str, default='jsonl', choices=['jsonl', 'otlp'])
+    parser.add_argument('--profile', type=str, default=None, help='Sample stacks into <profile>.collapsed / .speedscope.json.')
+    parser.add_argument('--profile_hz', type=float, default=profiler.DEFAULT_HZ)
     args = parser.parse_args(argv)
 
+    if args.trace_file:
+        tracing.configure(args.trace_file, fmt=args.trace_format, script="run.py")
+    # `kill -USR1 <pid>` toggles profiling of a run that was started without --profile.
+    profiler.install_signal_handler(args.profile or f"profiles/run_{os.getpid()}", hz=args.profile_hz)
+    if args.profile:
+        profiler.start(args.profile, hz=args.profile_hz)
+
     random.seed(args.seed)
 
     def seed_optional(module_name: str, attr_path: str, seed_value: int) -> None:
@@ -102,6 +128,9 @@ def main(argv: Optional[List[str]] = None):
         from openai import OpenAI
 
         client = OpenAI()
+        send_cache_key = args.prompt_cache_key == 'on' or (
+            args.prompt_cache_key == 'auto' and supports_prompt_cache_key(client.base_url)
+        )
     else:
         replicate_model = ENGINE_MAP.get(args.model_name, args.model_name)
         replicate_api_token = os.environ.get("REPLICATE_API_TOKEN")
@@ -113,16 +142,27 @@ def main(argv: Optional[List[str]] = None):
             "Authorization": f"Token {replicate_api_token}",
             "Content-Type": "application/json",
         }
-        create_url = f"https://api.replicate.com/v1/models/{replicate_model}/predictions"
+        create_url = f"{REPLICATE_BASE_URL}/v1/models/{replicate_model}/predictions"
+
+        # Prediction creates and status polls are paced separately; both back off on 429s
+        # (set RATE_LIMIT_DIR to share the limits between concurrent runs on this host).
+        create_limiter = rate_limit.get_limiter("replicate", replicate_model)
+        poll_limiter = rate_limit.get_limiter("replicate", "predictions.get")
 
         def replicate_request(method: str, url: str, payload: dict | None = None) -> dict:
             data = None
             if payload is not None:
                 data = json.dumps(payload).encode("utf-8")
-            req = urllib_request.Request(url, data=data, headers=headers, method=method)
-            try:
+
+            def send() -> dict:
+                req = urllib_request.Request(url, data=data, headers=headers, method=method)
                 with urllib_request.urlopen(req, timeout=120) as resp:
                     return json.loads(resp.read().decode("utf-8"))
+
+            try:
+                return rate_limit.call_with_limiter(
+                    create_limiter if method == "POST" else poll_limiter, send, label="replicate"
+                )
             except HTTPError as err:
                 error_body = err.read().decode("utf-8", errors="ignore")
                 raise RuntimeError(
@@ -132,30 +172,35 @@ def main(argv: Optional[List[str]] = None):
                 raise RuntimeError(f"Replicate API request failed: {err.reason}") from err
 
         def generate_with_replicate(prompt_text: str) -> str:
-            prediction = replicate_request(
-                "POST",
-                create_url,
-                {
-                    "input": {
-                        "prompt": prompt_text,
-                        "max_tokens": 400,
-                        "temperature": 1.0,
-                        "top_p": 0.9,
-                        "presence_penalty": 0,
-                        "frequency_penalty": 0,
-                    }
-                },
-            )
+            with span("llm.request", "network", provider="replicate"):
+                prediction = replicate_request(
+                    "POST",
+                    create_url,
+                    {
+                        "input": {
+                            "prompt": prompt_text,
+                            "max_tokens": 400,
+                            "temperature": 1.0,
+                            "top_p": 0.9,
+                            "presence_penalty": 0,
+                            "frequency_penalty": 0,
+                        }
+                    },
+                )
             prediction_id = prediction["id"]
             status = prediction.get("status", "")
 
-            while status not in {"succeeded", "failed", "canceled"}:
-                time.sleep(1.5)
-                prediction = replicate_request(
-                    "GET",
-                    f"https://api.replicate.com/v1/predictions/{prediction_id}",
-                )
-                status = prediction.get("status", "")
+            with span("llm.poll_wait", "network", provider="replicate") as poll_span:
+                polls = 0
+                while status not in {"succeeded", "failed", "canceled"}:
+                    time.sleep(REPLICATE_POLL_INTERVAL)
+                    prediction = replicate_request(
+                        "GET",
+                        f"{REPLICATE_BASE_URL}/v1/predictions/{prediction_id}",
+                    )
+                    status = prediction.get("status", "")
+                    polls += 1
+                poll_span.set(polls=polls, status=status)
 
             if status != "succeeded":
                 error_message = prediction.get("error", "unknown error")
@@ -199,47 +244,94 @@ def main(argv: Optional[List[str]] = None):
             "user": user,
         }
     
-    for turn in range(len(pkl["history"])+1, args.turns+1):
-        pkl_copy = copy.deepcopy(pkl)
-        tick = time.time()
-        messages = pkl2dict(pkl_copy)
-        prompt = llama_v2_prompt(messages)
-        print("@"*100)
-        print(f"Prompting for the {turn}-th (one-based) turn with prompt:\n{prompt}")
+    # With --conversation_tree, turns are stored in a prefix tree shared across runs, seeds and
+    # probes, and existing turns are reused instead of re-sampled. Turns up to --fork_after are
+    # shared by every seed; later turns and probes are sampled per seed.
+    tree = ConversationTree(args.conversation_tree) if args.conversation_tree else None
+    decoding = {"temperature": 1.0, "top_p": 0.9, "max_tokens": 400}
+
+    def turn_tag(turn: int) -> str:
+        return generation_tag(args.model_name, decoding, "" if turn <= args.fork_after else f"seed={args.seed}")
+
+    def probe_tag(run: int) -> str:
+        return generation_tag(args.model_name, decoding, f"seed={args.seed}/probe{run}")
+
+    def generate(messages: list, prompt: str) -> str:
         if use_api:
-            completion = client.chat.completions.create(model=args.model_name, messages=messages)
-            sequence = completion.choices[0].message.content
-        else:
-            sequence = generate_with_replicate(prompt)
-        pkl["history"].append(process_answer(sequence))
-        tok = time.time()
-        print(f"Time taken for turn {turn}: {tok-tick:.2f} seconds")
-        if len(pkl["history"]) % 2 == 0:
-            with output_path.open("wb") as handle:
-                pickle.dump(pkl, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            # Same key for every request with this system prompt, so OpenAI routes them to one prefix cache.
+            hints = {"extra_body": {"prompt_cache_key": prompt_cache_key(messages, args.model_name)}} if send_cache_key else {}
+            with span("llm.request", "network", provider="openai") as request_span:
+                completion = client.chat.completions.create(model=args.model_name, messages=messages, **hints)
+                usage = completion.usage
+                if usage is not None:
+                    details = getattr(usage, "prompt_tokens_details", None)
+                    request_span.set(
+                        prompt_tokens=usage.prompt_tokens,
+                        cached_tokens=(getattr(details, "cached_tokens", None) or 0) if details else 0,
+                    )
+            return process_answer(completion.choices[0].message.content)
+        return process_answer(generate_with_replicate(prompt))
+
+    def continue_from(parent, tag: str, messages: list, prompt: str):
+        """(node, text, reused); without a tree every call samples a new answer."""
+        if tree is None:
+            return None, generate(messages, prompt), False
+        return tree.extend(parent, tag, lambda: generate(messages, prompt))
+
+    node = None
+    turn_nodes = {}
+    if tree is not None:
+        node = turn_nodes[1] = tree.append(tree.root(args.model_name, persona, user), topic)
+        for turn, text in enumerate(pkl["history"][1:], start=2):  # register resumed turns
+            node = turn_nodes[turn] = tree.record(node, turn_tag(turn), text)
+
+    for turn in range(len(pkl["history"])+1, args.turns+1):
+        with span("turn", model=args.model_name, persona_id=args.agent, user_id=args.user, turn=turn) as turn_span:
+            with span("prompt.build", "cpu"):
+                tick = time.time()
+                # pkl2dict only reads the dict, so no copy of the history is needed.
+                messages = pkl2dict({"persona": persona, "user": user, "history": pkl["history"]})
+                prompt = llama_v2_prompt(messages)
+            print("@"*100)
+            print(f"Prompting for the {turn}-th (one-based) turn with prompt:\n{prompt}")
+            node, text, reused = continue_from(node, turn_tag(turn), messages, prompt)
+            turn_span.set(reused=reused)
+            turn_nodes[turn] = node
+            pkl["history"].append(text)
+            tok = time.time()
+            print(f"Time taken for turn {turn}: {tok-tick:.2f} seconds" + (" (reused)" if reused else ""))
+            if len(pkl["history"]) % 2 == 0:
+                with span("checkpoint.write", "disk"), output_path.open("wb") as handle:
+                    pickle.dump(pkl, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
     for turn in range(2, args.turns+1, 2):  # for 2, 4, 6, 8, 10, ...
-        runs_to_run = args.runs - len(pkl["probed_history_per_turn"][turn])
+        done = pkl["probed_history_per_turn"][turn]
+        probe_node = None
+        if tree is not None:
+            probe_node = tree.append(turn_nodes[turn], probe_str)
+            for run, text in enumerate(done):  # register resumed probe answers
+                tree.record(probe_node, probe_tag(run), text)
+        runs_to_run = args.runs - len(done)
         for _ in range(runs_to_run):
-            temp_pkl = copy.deepcopy(pkl)
-            temp_pkl["history"] = temp_pkl["history"][:turn]
-            temp_pkl["history"].append(probe_str)
-            pkl_copy = copy.deepcopy(temp_pkl)
-            tick = time.time()
-            messages = pkl2dict(pkl_copy)
-            prompt = llama_v2_prompt(messages)
-            if use_api:
-                completion = client.chat.completions.create(model=args.model_name, messages=messages)
-                sequence = completion.choices[0].message.content
-            else:
-                sequence = generate_with_replicate(prompt)
-            pkl["probed_history_per_turn"][turn].append(process_answer(sequence))
-            tok = time.time()
-            print(f"Time taken for probe turn {turn} ({_+1}/{runs_to_run}): {tok-tick:.2f} seconds")
+            run = len(done)
+            with span("probe", model=args.model_name, persona_id=args.agent, turn=turn, run=run) as probe_span:
+                with span("prompt.build", "cpu"):
+                    tick = time.time()
+                    messages = pkl2dict({"persona": persona, "user": user, "history": pkl["history"][:turn] + [probe_str]})
+                    prompt = llama_v2_prompt(messages)
+                _node, text, reused = continue_from(probe_node, probe_tag(run), messages, prompt)
+                probe_span.set(reused=reused)
+                done.append(text)
+                tok = time.time()
+                print(f"Time taken for probe turn {turn} ({_+1}/{runs_to_run}): {tok-tick:.2f} seconds")
 
-        with output_path.open("wb") as handle:
+        with span("checkpoint.write", "disk"), output_path.open("wb") as handle:
             pickle.dump(pkl, handle, protocol=pickle.HIGHEST_PROTOCOL)
-            
+
+    if tree is not None:
+        stats = tree.stats()
+        print(f"Conversation tree: {stats['generated']} generated, {stats['reused']} reused turns ({stats['nodes']} nodes)")
+        tree.close()
     pprint(f"Saved to {output_path}")
 
 if __name__ == '__main__':
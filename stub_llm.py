@@ -0,0 +1,352 @@
+"""
+Local stand-in for the Replicate and OpenAI endpoints, for offline benchmarking.
+
+`StubLLM` is an in-process fake that produces seeded canned completions with a
+configurable latency distribution, token rate and error injection.
+`StubLLMServer` exposes it over HTTP speaking the subset of the Replicate
+prediction API and the OpenAI chat/embeddings schema that this repo uses, so
+the unmodified drivers can run against it:
+
+    python stub_llm.py --port 8089 --latency lognormal:-0.7,0.5 --tokens_per_sec 60 --error_rate 0.02
+
+    # run.py / baseline_run.py and the replicate SDK
+    export REPLICATE_BASE_URL=http://127.0.0.1:8089 REPLICATE_API_TOKEN=stub
+    # final/ (openai SDK)
+    export OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=stub
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+
+DEFAULT_CANNED = [
+    "That is a fascinating question, and I have thought about it a great deal.",
+    "Honestly, I think it depends on who you ask and what they value most.",
+    "Let me tell you a story from my own experience that might shed some light on this.",
+    "I would say the benefits outweigh the drawbacks, though not by much.",
+    "Many people overlook the practical side of it, which matters more than the theory.",
+    "What do you think about it yourself? I am curious to hear your perspective.",
+    "There is no simple answer, but I lean towards a cautious optimism.",
+    "In my view, tradition and progress are not as opposed as they seem.",
+    "I remember a time when nobody would have even asked that question.",
+    "Perhaps the real issue is how we choose to talk about it.",
+]
+
+
+def parse_latency(spec: str):
+    """
+    Latency distribution spec -> sampler(rng) in seconds.
+    fixed:S | uniform:LO,HI | exp:MEAN | lognormal:MU,SIGMA
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1.0 / values[0])
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(values[0], values[1])
+    raise ValueError(f"Unknown latency spec '{spec}'")
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class StubError(Exception):
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+@dataclass
+class StubLLM:
+    seed: int = 0
+    latency: str = "fixed:0.0"
+    tokens_per_sec: float = 0.0
+    error_rate: float = 0.0
+    error_kinds: Tuple[str, ...] = ("429", "500")
+    retry_after: float = 1.0
+    response_words: int = 60
+    canned: List[str] = field(default_factory=lambda: list(DEFAULT_CANNED))
+
+    def __post_init__(self):
+        self._latency = parse_latency(self.latency)
+        self._rng = random.Random(self.seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0}
+
+    def _text_for(self, prompt: str, max_tokens: Optional[int], temperature: float) -> str:
+        # Same prompt + seed (+ temperature) -> same text, independent of request order.
+        digest = hashlib.sha256(f"{self.seed}|{temperature}|{prompt}".encode("utf-8")).hexdigest()
+        rng = random.Random(int(digest[:16], 16))
+        budget = self.response_words
+        if max_tokens:
+            budget = min(budget, max(1, int(max_tokens * 0.75)))
+        words: List[str] = []
+        while len(words) < budget:
+            words.extend(rng.choice(self.canned).split())
+        return " ".join(words[:budget])
+
+    def plan(self, prompt: str, *, max_tokens: Optional[int] = None, temperature: float = 0.7) -> Tuple[str, float]:
+        """
+        Decides the outcome of one request: returns (text, latency_sec) or
+        raises StubError for an injected failure. Does not sleep.
+        """
+        with self._lock:
+            self.stats["requests"] += 1
+            inject = self._rng.random() < self.error_rate
+            kind = self._rng.choice(self.error_kinds) if inject else None
+            latency = max(0.0, self._latency(self._rng))
+        if kind is not None:
+            with self._lock:
+                self.stats["errors"] += 1
+            if kind == "429":
+                raise StubError(429, "Request was throttled.", retry_after=self.retry_after)
+            raise StubError(int(kind) if kind.isdigit() else 500, "Injected server error.")
+
+        text = self._text_for(prompt, max_tokens, temperature)
+        if self.tokens_per_sec > 0:
+            latency += estimate_tokens(text) / self.tokens_per_sec
+        return text, latency
+
+    def complete(self, prompt: str, *, max_tokens: Optional[int] = None, temperature: float = 0.7) -> str:
+        """Blocking in-process completion, sleeping for the simulated latency."""
+        text, latency = self.plan(prompt, max_tokens=max_tokens, temperature=temperature)
+        time.sleep(latency)
+        return text
+
+    def embed(self, text: str, dim: int = 64) -> List[float]:
+        digest = hashlib.sha256(f"{self.seed}|{text}".encode("utf-8")).hexdigest()
+        rng = random.Random(int(digest[:16], 16))
+        vec = [rng.gauss(0.0, 1.0) for _ in range(dim)]
+        norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+        return [v / norm for v in vec]
+
+
+def messages_to_prompt(messages: List[Dict[str, Any]]) -> str:
+    return "\n".join(f"{m.get('role')}: {m.get('content')}" for m in messages)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "StubLLMServer"
+
+    def log_message(self, format, *args):  # noqa: A002 - silence default stderr logging
+        pass
+
+    def _send(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_error(self, err: StubError):
+        headers = {"Retry-After": f"{err.retry_after:g}"} if err.retry_after else None
+        self._send(err.status, {"detail": str(err), "error": {"message": str(err), "code": err.status}}, headers)
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_POST(self):
+        body = self._read_json()
+        path = self.path.rstrip("/")
+        if path.endswith("/chat/completions"):
+            return self._chat(body)
+        if path.endswith("/embeddings"):
+            return self._embeddings(body)
+        match = re.fullmatch(r"/v1/models/([^/]+/[^/]+)/predictions", path)
+        if match or path == "/v1/predictions":
+            return self._create_prediction(match.group(1) if match else body.get("version", "stub"), body)
+        self._send(404, {"detail": f"Unknown endpoint {self.path}"})
+
+    def do_GET(self):
+        match = re.fullmatch(r"/v1/predictions/([\w-]+)", self.path.rstrip("/"))
+        if not match:
+            return self._send(404, {"detail": f"Unknown endpoint {self.path}"})
+        prediction = self.server.predictions.get(match.group(1))
+        if prediction is None:
+            return self._send(404, {"detail": "Prediction not found"})
+        self._send(200, self.server.prediction_view(prediction))
+
+    def _chat(self, body: Dict[str, Any]):
+        prompt = messages_to_prompt(body.get("messages", []))
+        try:
+            text, latency = self.server.llm.plan(
+                prompt, max_tokens=body.get("max_tokens"), temperature=body.get("temperature", 1.0)
+            )
+        except StubError as err:
+            return self._send_error(err)
+        time.sleep(latency)
+        prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(text)
+        self._send(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0},
+            },
+        })
+
+    def _embeddings(self, body: Dict[str, Any]):
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        data = [
+            {"object": "embedding", "index": i, "embedding": self.server.llm.embed(text)}
+            for i, text in enumerate(inputs)
+        ]
+        tokens = sum(estimate_tokens(t) for t in inputs)
+        self._send(200, {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "stub"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    def _create_prediction(self, model: str, body: Dict[str, Any]):
+        inputs = body.get("input", {})
+        try:
+            text, latency = self.server.llm.plan(
+                str(inputs.get("prompt", "")),
+                max_tokens=inputs.get("max_tokens") or inputs.get("max_new_tokens"),
+                temperature=inputs.get("temperature", 0.7),
+            )
+        except StubError as err:
+            return self._send_error(err)
+        prediction = {
+            "id": uuid.uuid4().hex,
+            "model": model,
+            "version": body.get("version"),
+            "input": inputs,
+            "output_text": text,
+            "created": time.time(),
+            "ready_at": time.time() + latency,
+        }
+        self.server.predictions[prediction["id"]] = prediction
+        self._send(201, self.server.prediction_view(prediction))
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, llm: StubLLM, host: str = "127.0.0.1", port: int = 8089):
+        super().__init__((host, port), _Handler)
+        self.llm = llm
+        self.predictions: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def prediction_view(self, prediction: Dict[str, Any]) -> Dict[str, Any]:
+        done = time.time() >= prediction["ready_at"]
+        text = prediction["output_text"]
+        tokens = text.split(" ")
+        return {
+            "id": prediction["id"],
+            "model": prediction["model"],
+            "version": prediction["version"],
+            "input": prediction["input"],
+            "status": "succeeded" if done else "processing",
+            "output": [t if i == 0 else f" {t}" for i, t in enumerate(tokens)] if done else None,
+            "error": None,
+            "logs": "",
+            "metrics": {
+                "input_token_count": estimate_tokens(str(prediction["input"].get("prompt", ""))),
+                "output_token_count": estimate_tokens(text),
+                "predict_time": prediction["ready_at"] - prediction["created"],
+            } if done else {},
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(prediction["created"])),
+            "urls": {
+                "get": f"{self.base_url}/v1/predictions/{prediction['id']}",
+                "cancel": f"{self.base_url}/v1/predictions/{prediction['id']}/cancel",
+            },
+        }
+
+    def start_in_thread(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Local stub for the Replicate and OpenAI APIs")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=str, default="fixed:0.0", help="fixed:S | uniform:LO,HI | exp:MEAN | lognormal:MU,SIGMA")
+    parser.add_argument("--tokens_per_sec", type=float, default=0.0, help="Simulated decode speed (0 = instant).")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Probability of an injected error per request.")
+    parser.add_argument("--error_kinds", type=str, default="429,500", help="Comma-separated HTTP statuses to inject.")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After seconds sent with injected 429s.")
+    parser.add_argument("--response_words", type=int, default=60)
+    parser.add_argument("--canned", type=str, default=None, help="JSON list or newline-separated file of canned sentences.")
+    return parser
+
+
+def llm_from_args(args: argparse.Namespace) -> StubLLM:
+    canned = list(DEFAULT_CANNED)
+    if args.canned:
+        with open(args.canned, "r") as handle:
+            raw = handle.read()
+        try:
+            canned = json.loads(raw)
+        except json.JSONDecodeError:
+            canned = [line for line in raw.splitlines() if line.strip()]
+    return StubLLM(
+        seed=args.seed,
+        latency=args.latency,
+        tokens_per_sec=args.tokens_per_sec,
+        error_rate=args.error_rate,
+        error_kinds=tuple(k.strip() for k in args.error_kinds.split(",") if k.strip()),
+        retry_after=args.retry_after,
+        response_words=args.response_words,
+        canned=canned,
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = build_parser().parse_args(argv)
+    server = StubLLMServer(llm_from_args(args), host=args.host, port=args.port)
+    print(f"Stub LLM listening on {server.base_url} (seed={args.seed}, latency={args.latency})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Served {server.llm.stats['requests']} requests ({server.llm.stats['errors']} injected errors)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,523 @@
+"""
+Budget-aware sweep scheduler for run.py / baseline_run.py.
+
+Expands a grid of (agent, user, topic, decoding, seed) conversations, estimates
+each conversation's prompt and completion tokens from the `turn_stats` of
+earlier baseline_run.py pickles, and launches them in coverage order: every
+step picks the job with the most new persona/topic coverage per projected
+dollar (or token). A job is only launched if the spend so far plus the
+projected cost of running jobs and of the job itself stays within
+--budget_usd / --budget_tokens. Launching is throttled when spend runs ahead
+of --max_usd_per_hour or --max_tokens_per_hour. Progress lines and the final
+report show spend per second next to conversations and turns per second.
+
+    python sweep.py --script baseline_run --model_name meta/llama-4-scout-instruct \\
+        --agents 0-19 --users 0-19 --topics 0-4 --decodings greedy,best_of_n --best_of_n 8 \\
+        --price_in 0.17 --price_out 0.66 --budget_usd 25 --workers 4 --dry_run
+"""
+
+from __future__ import annotations
+
+import argparse
+import heapq
+import itertools
+import json
+import os
+import pickle
+import subprocess
+import sys
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SELFCHAT_DIR = Path(os.environ.get("SELFCHAT_DIR", "selfchat"))
+
+# Used until finished conversations provide turn_stats.
+DEFAULT_BASE_PROMPT_TOKENS = 250.0
+DEFAULT_RESPONSE_FRACTION = 0.5  # of --max_tokens
+
+
+def parse_ids(spec: str) -> List[int]:
+    """'0-4,7,9' -> [0, 1, 2, 3, 4, 7, 9]"""
+    ids: List[int] = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            ids.extend(range(int(lo), int(hi) + 1))
+        else:
+            ids.append(int(part))
+    return ids
+
+
+@dataclass
+class CostModel:
+    """
+    Prompt tokens of turn t are modelled as base_prompt + prompt_per_turn * (t - 1),
+    since the whole history is re-sent, and every call returns about `response` tokens.
+    """
+
+    base_prompt: float
+    prompt_per_turn: float
+    response: float
+    samples: int = 0
+
+    @classmethod
+    def default(cls, max_tokens: int) -> "CostModel":
+        response = DEFAULT_RESPONSE_FRACTION * max_tokens
+        return cls(base_prompt=DEFAULT_BASE_PROMPT_TOKENS, prompt_per_turn=response, response=response)
+
+    @classmethod
+    def from_history(cls, paths: Iterable[Path], max_tokens: int) -> "CostModel":
+        turns: List[float] = []
+        prompts: List[float] = []
+        responses: List[float] = []
+        for path in paths:
+            try:
+                with path.open("rb") as handle:
+                    pkl = pickle.load(handle)
+            except Exception:
+                continue
+            if not isinstance(pkl, dict):
+                continue
+            for stat in pkl.get("turn_stats", []):
+                if stat.get("prompt_tokens_est") is None or stat.get("response_tokens_est") is None:
+                    continue
+                turns.append(float(stat["turn"]))
+                prompts.append(float(stat["prompt_tokens_est"]))
+                responses.append(float(stat["response_tokens_est"]))
+        if len(turns) < 2:
+            return cls.default(max_tokens)
+
+        # Least-squares line through (turn, prompt tokens).
+        mean_t = sum(turns) / len(turns)
+        mean_p = sum(prompts) / len(prompts)
+        var_t = sum((t - mean_t) ** 2 for t in turns)
+        slope = sum((t - mean_t) * (p - mean_p) for t, p in zip(turns, prompts)) / var_t if var_t else 0.0
+        slope = max(slope, 0.0)
+        return cls(
+            base_prompt=max(mean_p - slope * (mean_t - 1), 0.0),
+            prompt_per_turn=slope,
+            response=sum(responses) / len(responses),
+            samples=len(turns),
+        )
+
+    def prompt_tokens(self, turn: int) -> float:
+        return self.base_prompt + self.prompt_per_turn * (turn - 1)
+
+    def estimate(self, script: str, turns: int, calls_per_turn: int = 1, probe_runs: int = 0) -> Tuple[int, int]:
+        """(prompt tokens, completion tokens) for one conversation."""
+        prompt = sum(self.prompt_tokens(t) for t in range(1, turns + 1)) * calls_per_turn
+        calls = turns * calls_per_turn
+        if script == "run":
+            # run.py also probes every even turn `runs` times.
+            probe_turns = range(2, turns + 1, 2)
+            prompt += sum(self.prompt_tokens(t) for t in probe_turns) * probe_runs
+            calls += len(probe_turns) * probe_runs
+        return int(prompt), int(calls * self.response)
+
+
+@dataclass
+class Prices:
+    """USD per million prompt / completion tokens."""
+
+    prompt: float = 0.0
+    completion: float = 0.0
+
+    def cost(self, prompt_tokens: float, completion_tokens: float) -> float:
+        return (prompt_tokens * self.prompt + completion_tokens * self.completion) / 1e6
+
+
+@dataclass
+class SweepJob:
+    script: str
+    agent: int
+    user: int
+    topic: int
+    decoding: str
+    seed: int
+    argv: List[str]
+    output_path: Optional[Path] = None
+    est_prompt_tokens: int = 0
+    est_completion_tokens: int = 0
+    status: str = "pending"
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    usage_source: str = ""
+    turns_run: int = 0
+    # turn_stats already in the output pickle when the job started (a resumed run).
+    turns_before: int = 0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    returncode: Optional[int] = None
+
+    @property
+    def label(self) -> str:
+        return f"{self.script}:{self.decoding}:a{self.agent}-u{self.user}-t{self.topic}-s{self.seed}"
+
+    @property
+    def est_tokens(self) -> int:
+        return self.est_prompt_tokens + self.est_completion_tokens
+
+
+def build_jobs(args: argparse.Namespace, cost_model: CostModel) -> List[SweepJob]:
+    jobs: List[SweepJob] = []
+    decodings = args.decodings.split(",") if args.script == "baseline_run" else ["nucleus"]
+    for agent, user, topic, decoding, seed in itertools.product(
+        parse_ids(args.agents), parse_ids(args.users), parse_ids(args.topics), decodings, parse_ids(args.seeds)
+    ):
+        argv = [
+            "--model_name", args.model_name,
+            "--agent", str(agent), "--user", str(user), "--topic", str(topic),
+            "--seed", str(seed), "--turns", str(args.turns),
+        ]
+        output_path = None
+        calls_per_turn = 1
+        if args.script == "baseline_run":
+            argv += ["--decoding", decoding, "--max_tokens", str(args.max_tokens)]
+            argv += ["--top_p", str(args.top_p), "--temperature", str(args.temperature)]
+            if decoding == "best_of_n":
+                argv += ["--best_of_n", str(args.best_of_n)]
+                calls_per_turn = args.best_of_n
+            output_path = SELFCHAT_DIR / (
+                f"{args.model_name.replace('/', '_')}_agent_{agent}_user_{user}_"
+                f"turn_{args.turns}_{strategy_name(decoding, args)}_seed_{seed}.pkl"
+            )
+        else:
+            argv += ["--runs", str(args.runs)]
+        argv += args.extra
+        prompt, completion = cost_model.estimate(args.script, args.turns, calls_per_turn, args.runs)
+        jobs.append(SweepJob(
+            script=args.script, agent=agent, user=user, topic=topic, decoding=decoding, seed=seed,
+            argv=argv, output_path=output_path, est_prompt_tokens=prompt, est_completion_tokens=completion,
+        ))
+    return jobs
+
+
+def strategy_name(decoding: str, args: argparse.Namespace) -> str:
+    """Mirrors the DecodingStrategy names baseline_run.py puts in its output file names."""
+    if decoding == "greedy":
+        return "greedy"
+    if decoding == "best_of_n":
+        return f"bestof{args.best_of_n}_p{args.top_p}_t{args.temperature}"
+    return f"nucleus_p{args.top_p}_t{args.temperature}"
+
+
+def order_for_coverage(jobs: List[SweepJob], cost) -> List[SweepJob]:
+    """
+    Greedy max-coverage ordering: repeatedly takes the job whose persona and
+    topic coverage gain per unit cost is highest. Gains only shrink as values
+    get covered, so stale heap entries are re-scored lazily when popped.
+    """
+    agents: Counter = Counter()
+    users: Counter = Counter()
+    topics: Counter = Counter()
+
+    def score(job: SweepJob) -> float:
+        gain = 1.0 / (1 + agents[job.agent]) + 1.0 / (1 + topics[job.topic]) + 0.5 / (1 + users[job.user])
+        return gain / max(cost(job), 1e-9)
+
+    heap = [(-score(job), index) for index, job in enumerate(jobs)]
+    heapq.heapify(heap)
+    ordered: List[SweepJob] = []
+    while heap:
+        _, index = heapq.heappop(heap)
+        job = jobs[index]
+        fresh = -score(job)
+        if heap and fresh > heap[0][0]:
+            heapq.heappush(heap, (fresh, index))
+            continue
+        ordered.append(job)
+        agents[job.agent] += 1
+        users[job.user] += 1
+        topics[job.topic] += 1
+    return ordered
+
+
+def load_output(job: SweepJob) -> Optional[dict]:
+    if job.output_path is None or not job.output_path.exists():
+        return None
+    try:
+        with job.output_path.open("rb") as handle:
+            pkl = pickle.load(handle)
+    except Exception:
+        return None
+    return pkl if isinstance(pkl, dict) else None
+
+
+def count_turn_stats(job: SweepJob) -> int:
+    pkl = load_output(job)
+    return len(pkl.get("turn_stats", [])) if pkl is not None else 0
+
+
+def read_usage(job: SweepJob, best_of_n: int) -> Optional[Tuple[int, int, int]]:
+    """
+    (prompt tokens, completion tokens, turns) from a finished baseline_run.py
+    pickle, counting only the turns added since the job started.
+    """
+    pkl = load_output(job)
+    if pkl is None:
+        return None
+    stats = pkl.get("turn_stats", [])[job.turns_before:]
+    calls = best_of_n if job.decoding == "best_of_n" else 1
+    prompt = sum(int(stat.get("prompt_tokens_est", 0)) for stat in stats if not stat.get("cache_hit")) * calls
+    completion = sum(int(stat.get("response_tokens_est", 0)) for stat in stats if not stat.get("cache_hit")) * calls
+    return prompt, completion, len(stats)
+
+
+def is_complete(job: SweepJob, turns: int) -> bool:
+    pkl = load_output(job)
+    if pkl is None:
+        return False
+    return pkl.get("summary", {}).get("total_turns", 0) >= turns
+
+
+@dataclass
+class Ledger:
+    prices: Prices
+    budget_usd: Optional[float] = None
+    budget_tokens: Optional[int] = None
+    spent_usd: float = 0.0
+    spent_tokens: int = 0
+    reserved_usd: float = 0.0
+    reserved_tokens: int = 0
+    # Running ratio of actual to estimated tokens, applied to later projections.
+    correction: float = 1.0
+    corrections: int = 0
+    turns: int = 0
+    conversations: int = 0
+    started_at: float = field(default_factory=time.time)
+
+    def projected(self, job: SweepJob) -> Tuple[float, int]:
+        prompt = job.est_prompt_tokens * self.correction
+        completion = job.est_completion_tokens * self.correction
+        return self.prices.cost(prompt, completion), int(prompt + completion)
+
+    def fits(self, job: SweepJob) -> bool:
+        usd, tokens = self.projected(job)
+        if self.budget_usd is not None and self.spent_usd + self.reserved_usd + usd > self.budget_usd:
+            return False
+        if self.budget_tokens is not None and self.spent_tokens + self.reserved_tokens + tokens > self.budget_tokens:
+            return False
+        return True
+
+    def reserve(self, job: SweepJob) -> None:
+        usd, tokens = self.projected(job)
+        self.reserved_usd += usd
+        self.reserved_tokens += tokens
+
+    def settle(self, job: SweepJob, reserved: Tuple[float, int]) -> None:
+        self.reserved_usd -= reserved[0]
+        self.reserved_tokens -= reserved[1]
+        prompt, completion = job.prompt_tokens or 0, job.completion_tokens or 0
+        self.spent_usd += self.prices.cost(prompt, completion)
+        self.spent_tokens += prompt + completion
+        self.turns += job.turns_run
+        self.conversations += 1
+        # A resumed job only ran part of the turns its estimate covers.
+        if job.usage_source == "turn_stats" and job.est_tokens and job.turns_run and not job.turns_before:
+            self.corrections += 1
+            self.correction += ((prompt + completion) / job.est_tokens - self.correction) / self.corrections
+
+    def rates(self) -> Dict[str, float]:
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        return {
+            "elapsed_sec": elapsed,
+            "usd_per_sec": self.spent_usd / elapsed,
+            "tokens_per_sec": self.spent_tokens / elapsed,
+            "conversations_per_sec": self.conversations / elapsed,
+            "turns_per_sec": self.turns / elapsed,
+        }
+
+    def throttle_delay(self, max_usd_per_hour: Optional[float], max_tokens_per_hour: Optional[float]) -> float:
+        """Seconds to wait until the average spend rate is back under the limits."""
+        elapsed = time.time() - self.started_at
+        delay = 0.0
+        if max_usd_per_hour:
+            delay = max(delay, (self.spent_usd + self.reserved_usd) / max_usd_per_hour * 3600 - elapsed)
+        if max_tokens_per_hour:
+            delay = max(delay, (self.spent_tokens + self.reserved_tokens) / max_tokens_per_hour * 3600 - elapsed)
+        return delay
+
+    def progress(self, done: int, total: int) -> str:
+        rates = self.rates()
+        budget = f" of ${self.budget_usd:.2f}" if self.budget_usd is not None else ""
+        return (
+            f"[sweep] {done}/{total} jobs | {self.spent_tokens:,} tok | ${self.spent_usd:.4f}"
+            f" (+${self.reserved_usd:.4f} in flight{budget}) | ${rates['usd_per_sec']:.6f}/s"
+            f" | {rates['tokens_per_sec']:.1f} tok/s | {rates['conversations_per_sec']:.4f} conv/s"
+            f" | {rates['turns_per_sec']:.3f} turns/s"
+        )
+
+
+def run_sweep(args: argparse.Namespace, jobs: List[SweepJob], ledger: Ledger) -> None:
+    log_dir = Path(args.log_dir)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    script = Path(__file__).resolve().parent / f"{args.script}.py"
+    pending = list(jobs)
+    running: Dict[int, Tuple[SweepJob, subprocess.Popen, Tuple[float, int], object]] = {}
+    finished = 0
+
+    while pending or running:
+        while pending and len(running) < args.workers:
+            delay = ledger.throttle_delay(args.max_usd_per_hour, args.max_tokens_per_hour)
+            if delay > 0 and running:
+                break  # let in-flight jobs finish before deciding again
+            if delay > 0:
+                print(f"[sweep] Spend rate above limit; pausing {delay:.0f}s")
+                time.sleep(delay)
+            index = next((i for i, job in enumerate(pending) if ledger.fits(job)), None)
+            if index is None and running:
+                break  # in-flight jobs may settle below their reservation
+            if index is None:
+                for job in pending:
+                    job.status = "over_budget"
+                print(f"[sweep] Budget reached; {len(pending)} job(s) not started.")
+                pending = []
+                break
+            job = pending.pop(index)
+            reserved = ledger.projected(job)
+            ledger.reserve(job)
+            log_file = (log_dir / f"{job.label.replace(':', '_')}.log").open("w")
+            job.turns_before = count_turn_stats(job)
+            job.started_at = time.time()
+            job.status = "running"
+            process = subprocess.Popen(
+                [sys.executable, str(script)] + job.argv, stdout=log_file, stderr=subprocess.STDOUT
+            )
+            running[process.pid] = (job, process, reserved, log_file)
+            print(f"[sweep] Started {job.label} (≈{reserved[1]:,} tok, ≈${reserved[0]:.4f})")
+
+        time.sleep(args.poll_interval)
+        for pid, (job, process, reserved, log_file) in list(running.items()):
+            if process.poll() is None:
+                continue
+            del running[pid]
+            log_file.close()
+            job.finished_at = time.time()
+            job.returncode = process.returncode
+            job.status = "done" if process.returncode == 0 else "failed"
+            usage = read_usage(job, args.best_of_n)
+            if usage is not None:
+                job.prompt_tokens, job.completion_tokens, job.turns_run = usage
+                job.usage_source = "turn_stats"
+            else:
+                # run.py keeps no per-turn token stats; charge the corrected estimate.
+                job.prompt_tokens = int(job.est_prompt_tokens * ledger.correction)
+                job.completion_tokens = int(job.est_completion_tokens * ledger.correction)
+                job.turns_run = args.turns if job.status == "done" else 0
+                job.usage_source = "estimate"
+            ledger.settle(job, reserved)
+            finished += 1
+            print(f"[sweep] {job.status} {job.label} (exit {process.returncode})")
+            print(ledger.progress(finished, len(jobs)))
+
+
+def build_report(args: argparse.Namespace, jobs: List[SweepJob], ledger: Ledger, cost_model: CostModel) -> dict:
+    done = [job for job in jobs if job.status == "done"]
+    jobs_out = []
+    for job in jobs:
+        record = asdict(job)
+        record["output_path"] = str(job.output_path) if job.output_path else None
+        jobs_out.append(record)
+    return {
+        "config": vars(args),
+        "cost_model": asdict(cost_model),
+        "correction": ledger.correction,
+        "spent_usd": ledger.spent_usd,
+        "spent_tokens": ledger.spent_tokens,
+        "rates": ledger.rates(),
+        "status": dict(Counter(job.status for job in jobs)),
+        "coverage": {
+            "agents": sorted({job.agent for job in done}),
+            "users": sorted({job.user for job in done}),
+            "topics": sorted({job.topic for job in done}),
+        },
+        "jobs": jobs_out,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Budgeted, coverage-ordered self-chat sweep")
+    parser.add_argument("--script", type=str, default="baseline_run", choices=["baseline_run", "run"])
+    parser.add_argument("--model_name", type=str, default="meta/llama-4-scout-instruct")
+    parser.add_argument("--agents", type=str, default="0-4", help="Agent persona ids, e.g. '0-9,12'.")
+    parser.add_argument("--users", type=str, default="0-4", help="User persona ids.")
+    parser.add_argument("--topics", type=str, default="0", help="Topic ids.")
+    parser.add_argument("--seeds", type=str, default="42", help="Seeds.")
+    parser.add_argument("--decodings", type=str, default="greedy", help="baseline_run decodings, comma separated.")
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=1, help="Probe runs per even turn (run.py).")
+    parser.add_argument("--max_tokens", type=int, default=400)
+    parser.add_argument("--best_of_n", type=int, default=3)
+    parser.add_argument("--top_p", type=float, default=0.9, help="baseline_run nucleus/best-of-n setting.")
+    parser.add_argument("--temperature", type=float, default=0.7, help="baseline_run nucleus/best-of-n setting.")
+    parser.add_argument("--price_in", type=float, default=0.0, help="USD per million prompt tokens.")
+    parser.add_argument("--price_out", type=float, default=0.0, help="USD per million completion tokens.")
+    parser.add_argument("--budget_usd", type=float, default=None, help="Stop launching once projected spend exceeds this.")
+    parser.add_argument("--budget_tokens", type=int, default=None, help="Stop launching once projected tokens exceed this.")
+    parser.add_argument("--max_usd_per_hour", type=float, default=None, help="Throttle launches above this spend rate.")
+    parser.add_argument("--max_tokens_per_hour", type=float, default=None, help="Throttle launches above this token rate.")
+    parser.add_argument("--workers", type=int, default=1, help="Conversations to run at once.")
+    parser.add_argument("--poll_interval", type=float, default=1.0)
+    parser.add_argument("--history", type=str, default=str(SELFCHAT_DIR), help="Directory of earlier pickles with turn_stats.")
+    parser.add_argument("--log_dir", type=str, default="sweep_logs")
+    parser.add_argument("--report", type=str, default="sweep_report.json")
+    parser.add_argument("--dry_run", action="store_true", help="Print the ordered plan and projected spend only.")
+    parser.add_argument("extra", nargs=argparse.REMAINDER, help="Arguments after -- are passed to every job.")
+    args = parser.parse_args(argv)
+    if args.extra and args.extra[0] == "--":
+        args.extra = args.extra[1:]
+
+    cost_model = CostModel.from_history(sorted(Path(args.history).rglob("*.pkl")), args.max_tokens)
+    print(
+        f"[sweep] Cost model from {cost_model.samples} turns: prompt ≈ {cost_model.base_prompt:.0f} + "
+        f"{cost_model.prompt_per_turn:.0f}·(turn-1), response ≈ {cost_model.response:.0f} tokens"
+    )
+    prices = Prices(prompt=args.price_in, completion=args.price_out)
+    ledger = Ledger(prices=prices, budget_usd=args.budget_usd, budget_tokens=args.budget_tokens)
+
+    jobs = build_jobs(args, cost_model)
+    for job in jobs:
+        if is_complete(job, args.turns):
+            job.status = "skipped"
+    todo = [job for job in jobs if job.status == "pending"]
+    if prices.prompt or prices.completion:
+        cost = lambda job: prices.cost(job.est_prompt_tokens, job.est_completion_tokens)
+    else:
+        cost = lambda job: job.est_tokens
+    todo = order_for_coverage(todo, cost)
+    print(f"[sweep] {len(todo)} job(s) to run, {len(jobs) - len(todo)} already complete.")
+
+    if args.dry_run:
+        total_usd, total_tokens = 0.0, 0
+        for job in todo:
+            usd, tokens = ledger.projected(job)
+            total_usd += usd
+            total_tokens += tokens
+            within = (args.budget_usd is None or total_usd <= args.budget_usd) and (
+                args.budget_tokens is None or total_tokens <= args.budget_tokens
+            )
+            print(f"  {job.label:<48} ≈{tokens:>9,} tok  ≈${usd:.4f}  cumulative ${total_usd:.4f}{'' if within else '  (over budget)'}")
+        return
+
+    try:
+        run_sweep(args, todo, ledger)
+    finally:
+        report = build_report(args, jobs, ledger, cost_model)
+        with open(args.report, "w") as handle:
+            json.dump(report, handle, indent=2, default=str)
+        rates = report["rates"]
+        print(
+            f"[sweep] Spent ${ledger.spent_usd:.4f} / {ledger.spent_tokens:,} tokens in {rates['elapsed_sec']:.0f}s "
+            f"(${rates['usd_per_sec']:.6f}/s, {rates['conversations_per_sec']:.4f} conv/s, "
+            f"{rates['turns_per_sec']:.3f} turns/s). Report: {args.report}"
+        )
+
+
+if __name__ == "__main__":
+    main()